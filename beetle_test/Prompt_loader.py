@@ -1,32 +1,158 @@
 import yaml
+import asyncio
+import hashlib
 import logging
 import os
+from typing import Dict, NamedTuple, Optional
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_TYPE = 'is_spill'
+
+
+class PromptVersion(NamedTuple):
+    """一个任务类型在某一版配置下的提示词、token 上限和内容哈希"""
+    prompt: str
+    num_predict: Optional[int]
+    version: str
+
+
+class PromptConfig:
+    """一次加载得到的完整配置，加载后不再修改，热更新时整体替换"""
+
+    def __init__(self, config: dict, digest: str):
+        self.config = config
+        self.digest = digest
+        budget = config.get('token_budget') or {}
+        self.types: Dict[str, PromptVersion] = {}
+        for mission_type, prompt in config.items():
+            if mission_type == 'token_budget':
+                continue
+            value = budget.get(mission_type, budget.get('default'))
+            num_predict = int(value) if value else None
+            # 版本 = 提示词 + token 上限的哈希，两者任一变化结果都可能不同
+            version = hashlib.sha256(f"{prompt}\0{num_predict}".encode('utf-8')).hexdigest()[:16]
+            self.types[mission_type] = PromptVersion(str(prompt), num_predict, version)
+
+
+def parse_config(text: str, digest: str) -> PromptConfig:
+    """校验 YAML：顶层是 {任务类型: 非空提示词}，可选 token_budget: {任务类型/default: 正整数}，且包含默认类型"""
+    config = yaml.safe_load(text)
+    if not isinstance(config, dict):
+        raise ValueError("top level must be a mapping of mission type -> prompt")
+    budget = config.get('token_budget') or {}
+    if not isinstance(budget, dict):
+        raise ValueError("token_budget must be a mapping")
+    for key, value in budget.items():
+        # bool 是 int 的子类，true / false 不是合法的 token 数
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+            raise ValueError(f"token_budget.{key} must be a positive integer")
+    for mission_type, prompt in config.items():
+        if mission_type != 'token_budget' and (not isinstance(prompt, str) or not prompt.strip()):
+            raise ValueError(f"prompt for {mission_type} must be a non-empty string")
+    if DEFAULT_TYPE not in config:
+        raise ValueError(f"missing default prompt {DEFAULT_TYPE}")
+    return PromptConfig(config, digest)
+
+
 class PromptLoader:
+    """
+    提示词配置，支持热更新：
+    - watch() 定期检查文件，内容变化时解析 + 校验，通过后整体替换当前配置；进行中的任务继续用它拿到的那一版
+    - YAML 写坏了 (解析失败 / 校验不过) 或文件被删掉时保留上一版好的配置并记录 last_error，不会退化成空配置
+    - 启动时没能加载出任何配置直接抛 ValueError，不带着空提示词运行
+    - 每个任务类型带一个内容哈希版本号，写进结果、也用作推理结论缓存的键
+    """
+
     def __init__(self, file_path='./promot/spill_promot.yaml'):
         self.file_path = file_path
-        self.config = {}
-        self.load_config()
+        self.current = PromptConfig({}, "")
+        self.last_error: Optional[str] = None
+        self._stat = None
+        self._warned_types = set()
+        if not self.load_config():
+            raise ValueError(f"Prompt file {file_path} not loaded: {self.last_error}")
+
+    @property
+    def config(self) -> dict:
+        return self.current.config
 
     #######加载提示词#########
-    def load_config(self):
-        if os.path.exists(self.file_path):
+    def load_config(self) -> bool:
+        """重新读取文件，内容有变化且校验通过时替换当前配置，返回是否替换"""
+        try:
+            stat = os.stat(self.file_path)
+            with open(self.file_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+        except OSError as e:
+            self.last_error = str(e)
+            logger.warning(f"⚠️ Prompt file {self.file_path} not readable: {e}")
+            return False
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if digest == self.current.digest:
+            # 内容没变 (比如删掉后又放回原文件)，之前的错误已不存在
+            self.last_error = None
+            return False
+        try:
+            new = parse_config(text, digest)
+        except Exception as e:
+            self.last_error = str(e)
+            kept = "keeping last good version" if self.current.types else "no prompts loaded"
+            logger.error(f"❌ Prompt file {self.file_path} rejected ({kept}): {e}")
+            return False
+
+        old = self.current
+        self.current = new
+        self.last_error = None
+        changed = sorted(t for t, v in new.types.items() if old.types.get(t) != v)
+        logger.info(f"📝 Prompts loaded from {self.file_path}: "
+                    + ", ".join(f"{t}@{new.types[t].version[:8]}" for t in changed))
+        return True
+    #######加载完成##########
+
+    def reload_if_changed(self) -> bool:
+        """mtime / 大小变了才读文件，watch() 每轮调用"""
+        try:
+            stat = os.stat(self.file_path)
+        except OSError as e:
+            if self._stat is not None:
+                # 只在文件刚消失时报一次，之后每轮不再重复
+                self._stat = None
+                self.last_error = str(e)
+                logger.error(f"❌ Prompt file {self.file_path} missing (keeping last good version): {e}")
+            return False
+        if (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return False
+        return self.load_config()
+
+    async def watch(self, interval: float = 5.0):
+        while True:
+            await asyncio.sleep(interval)
             try:
-                with open(self.file_path, 'r', encoding='utf-8') as f:
-                    self.config = yaml.safe_load(f)
-                logger.info(f"load_config running")
+                # 文件很小，直接在事件循环里读
+                self.reload_if_changed()
             except Exception as e:
-                logger.debug(f"maybe spill_promopt is error,this is {e}")
-        else:
-            logger.warning(f"spill_promot.yaml is not found{self.file_path}")
-    #######加载完成##########
+                logger.error(f"Prompt watch error: {e}")
 
-    def system_prompt_get(self, mission_type:str) -> str:
-        prompt = self.config.get(mission_type)
-        if prompt:
-            return str(prompt)
-        else:
-            return str(self.config.get('is_spill'))
+    def get(self, mission_type: str) -> PromptVersion:
+        """一次取齐提示词 / token 上限 / 版本，保证三者来自同一版配置"""
+        types = self.current.types
+        entry = types.get(mission_type)
+        if entry is not None:
+            return entry
+        if mission_type not in self._warned_types:
+            self._warned_types.add(mission_type)
+            logger.warning(f"⚠️ No prompt for mission type {mission_type}, using {DEFAULT_TYPE}")
+        return types.get(DEFAULT_TYPE) or PromptVersion("", None, "")
+
+    def version_get(self, mission_type: str) -> str:
+        return self.get(mission_type).version
 
+    def token_budget_get(self, mission_type:str):
+        # JSON 输出模式下的 num_predict 上限，未配置时返回 None (不限制)
+        return self.get(mission_type).num_predict
+
+    def system_prompt_get(self, mission_type:str) -> str:
+        return self.get(mission_type).prompt
@@ -0,0 +1,97 @@
+import time
+import math
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+
+class AdmissionDecision:
+    def __init__(self, accepted: bool, backlog: int, eta: Optional[float], retry_after: Optional[float] = None,
+                 reason: str = "", cause: str = ""):
+        self.accepted = accepted
+        self.backlog = backlog
+        self.eta = eta                  # 预计完成时间 (秒)，吞吐未知时为 None
+        self.retry_after = retry_after  # 拒绝时建议的重试间隔 (秒)
+        self.reason = reason
+        self.cause = cause              # 拒绝原因分类：backlog / slo
+
+
+class AdmissionController:
+    """
+    按任务队列积压和近期 worker 吞吐决定是否接收新任务：
+    - 积压 (队列中未完成的消息数，大任务按分片计) 超过 max_backlog 直接拒绝
+    - 预计完成时间 = (积压 + 本次消息数) / 吞吐，超过 slo_seconds 拒绝
+    - 拒绝时给出 retry_after：按当前吞吐，积压降到阈值以下大约需要的时间
+    队列长度每 refresh_interval 秒查一次 Redis，期间本地累加已接收的消息数，突发请求也能被计入。
+    吞吐用最近 window 秒内回来的结果消息数估计。
+    """
+
+    def __init__(self, backlog_fn: Callable[[], Awaitable[int]], max_backlog: int = 10000, slo_seconds: float = 0.0,
+                 window: float = 60.0, refresh_interval: float = 0.5, min_retry_after: float = 1.0,
+                 max_retry_after: float = 300.0, default_retry_after: float = 30.0):
+        self.backlog_fn = backlog_fn  # 返回当前任务积压 (消息数)
+        self.max_backlog = max_backlog
+        self.slo_seconds = slo_seconds
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self.min_retry_after = min_retry_after
+        self.max_retry_after = max_retry_after
+        self.default_retry_after = default_retry_after  # 还没有吞吐样本时的重试间隔
+
+        self._completions = deque()  # (时间戳, 完成消息数)
+        self._backlog = 0
+        self._refreshed_at = 0.0
+        self.stats = {"accepted": 0, "rejected": 0}
+
+    # ---------- 吞吐 ----------
+
+    def record_completed(self, count: int = 1):
+        if count > 0:
+            self._completions.append((time.monotonic(), count))
+
+    def throughput(self) -> Optional[float]:
+        """最近窗口内的完成速率 (消息/秒)；还没有样本时返回 None"""
+        now = time.monotonic()
+        while self._completions and now - self._completions[0][0] > self.window:
+            self._completions.popleft()
+        if not self._completions:
+            return None
+        # 服务刚启动时窗口还没填满，按实际经过的时间算
+        span = max(now - self._completions[0][0], min(self.window, 1.0))
+        return sum(count for _, count in self._completions) / span
+
+    # ---------- 准入 ----------
+
+    async def backlog(self) -> int:
+        now = time.monotonic()
+        if now - self._refreshed_at >= self.refresh_interval:
+            self._backlog = await self.backlog_fn()
+            self._refreshed_at = now
+        return self._backlog
+
+    async def admit(self, messages: int = 1) -> AdmissionDecision:
+        """messages 为本次要入队的消息数 (分片数)；接收时计入本地积压"""
+        backlog = await self.backlog()
+        rate = self.throughput()
+        eta = (backlog + messages) / rate if rate else None
+
+        reason = cause = ""
+        excess = 0.0
+        # 队列为空时总是接收，单个超大任务不会被永远拒绝
+        if self.max_backlog > 0 and backlog > 0 and backlog + messages > self.max_backlog:
+            reason = f"backlog {backlog} + {messages} would exceed limit {self.max_backlog}"
+            excess = backlog + messages - self.max_backlog
+            cause = "backlog"
+        elif self.slo_seconds > 0 and eta is not None and eta > self.slo_seconds:
+            reason = f"estimated completion {eta:.0f}s exceeds SLO {self.slo_seconds:.0f}s"
+            excess = backlog + messages - self.slo_seconds * rate
+            cause = "slo"
+
+        if reason:
+            self.stats["rejected"] += 1
+            retry_after = excess / rate if rate else self.default_retry_after
+            retry_after = math.ceil(min(self.max_retry_after, max(self.min_retry_after, retry_after)))
+            return AdmissionDecision(False, backlog, eta, retry_after, reason, cause)
+
+        self.stats["accepted"] += 1
+        self._backlog += messages
+        return AdmissionDecision(True, backlog, eta)
@@ -0,0 +1,361 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+import httpx
+import uvicorn
+import redis.asyncio as redis
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+from PIL import Image
+
+from timeline import percentile, print_report
+
+# 端到端压测：本地起 Ollama 替身 / 图片站 / 回调接收端，真实的 server_test.py 与 client_test.py 作为子进程，
+# 经 Redis 按目标到达率压任务，统计吞吐、端到端延迟分位数和各阶段耗时。不需要 GPU。
+#
+#   python3 bench_e2e.py --rate 2 --duration 60 --workers 2 --infer-latency lognormal:1.5,0.4
+#
+# 注意：启动时会清空 --redis 指向的库，默认用 6380 的 15 号库，不要指向生产库。
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_latency(spec: str):
+    """
+    延迟分布 -> 返回采样函数 (秒)：
+    fixed:1.5 / uniform:1,3 / lognormal:中位数,sigma / exp:均值
+    """
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        mu, sigma = math.log(values[0]), values[1]
+        return lambda: random.lognormvariate(mu, sigma)
+    if kind == "exp":
+        return lambda: random.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+# --- 替身服务 ---
+
+def make_ollama_app(args) -> FastAPI:
+    """模拟 /api/generate：思考式输出、按分布采样的延迟、失败率，并发槽位与 OLLAMA_NUM_PARALLEL 对齐"""
+    app = FastAPI()
+    latency = parse_latency(args.infer_latency)
+    slots = asyncio.Semaphore(args.ollama_parallel)
+    think = "嗯，先看地面有没有反光的液体痕迹，还要排除阴影和水渍的干扰，" * max(1, args.think_tokens // 30)
+
+    def answer(payload: dict):
+        verdict = random.random() < args.true_ratio
+        if payload.get("format"):
+            body = json.dumps({"reason": "地面有明显的液体反光" if verdict else "未见异常", "result": verdict},
+                              ensure_ascii=False)
+        else:
+            body = f"理由：{'地面有明显的液体反光' if verdict else '未见异常'}\n结果：{'TRUE' if verdict else 'FALSE'}"
+        return f"<think>{think[:args.think_tokens]}</think>{body}"
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        payload = await request.json()
+        if random.random() < args.infer_fail_rate:
+            return Response(status_code=500, content="fake failure")
+        text = answer(payload)
+        total = latency()
+
+        if not payload.get("stream"):
+            async with slots:
+                await asyncio.sleep(total)
+            return {"response": text, "done": True, "eval_count": len(text), "eval_duration": int(total * 1e9)}
+
+        async def chunks():
+            # 首 token 占 10%，其余均摊到每个字符上；客户端提前断开时生成器被取消，槽位随之释放
+            async with slots:
+                await asyncio.sleep(total * 0.1)
+                step = total * 0.9 / len(text)
+                for idx, piece in enumerate(text):
+                    await asyncio.sleep(step)
+                    yield json.dumps({"response": piece, "done": False}, ensure_ascii=False) + "\n"
+                yield json.dumps({"response": "", "done": True, "eval_count": len(text),
+                                  "eval_duration": int(total * 1e9)}) + "\n"
+
+        return StreamingResponse(chunks(), media_type="application/x-ndjson")
+
+    return app
+
+
+def make_images(count: int, width: int, height: int):
+    """生成 count 张内容互不相同的 JPEG，避免推理结论缓存把压测变成缓存命中测试"""
+    images = []
+    for idx in range(count):
+        rng = random.Random(idx)
+        img = Image.new("RGB", (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        for _ in range(20):
+            x, y = rng.randrange(width), rng.randrange(height)
+            img.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+                      (x, y, min(width, x + width // 5), min(height, y + height // 5)))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85)
+        images.append(buf.getvalue())
+    return images
+
+
+def make_image_app(args) -> FastAPI:
+    app = FastAPI()
+    latency = parse_latency(args.download_latency)
+    images = make_images(args.image_pool, args.image_width, args.image_height)
+
+    @app.get("/img/{name}")
+    async def image(name: str):
+        await asyncio.sleep(latency())
+        if random.random() < args.download_fail_rate:
+            return Response(status_code=404)
+        return Response(content=images[hash(name) % len(images)], media_type="image/jpeg")
+
+    return app
+
+
+class CallbackSink:
+    """回调接收端：记录每个任务第一次成功收到回调的时间"""
+
+    def __init__(self, args):
+        self.latency = parse_latency(args.callback_latency)
+        self.fail_rate = args.callback_fail_rate
+        self.received = {}
+        self.attempts = 0
+        self.event = asyncio.Event()
+
+    def app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/callback")
+        async def callback(request: Request):
+            payload = await request.json()
+            self.attempts += 1
+            await asyncio.sleep(self.latency())
+            if random.random() < self.fail_rate:
+                return Response(status_code=500)
+            self.received.setdefault(payload["taskSerial"], time.time())
+            self.event.set()
+            return {"ok": True}
+
+        return app
+
+
+async def serve(app: FastAPI, port: int):
+    """在当前事件循环里起一个 uvicorn，返回 (server, task)，退出时置 should_exit 后等 task 结束"""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()  # 端口被占用等启动失败
+        await asyncio.sleep(0.05)
+    return server, task
+
+
+# --- 被测进程 ---
+
+async def start_processes(args, run_dir: str):
+    env = dict(os.environ,
+               PYTHONPATH=HERE + os.pathsep + os.environ.get("PYTHONPATH", ""),
+               REDIS_URL=args.redis,
+               OLLAMA_URL=f"http://127.0.0.1:{args.ollama_port}/api/generate",
+               OLLAMA_NUM_PARALLEL=str(args.ollama_parallel),
+               VERDICT_CACHE_ENABLED=os.environ.get("VERDICT_CACHE_ENABLED", "0"),
+               WORKER_METRICS_PORT="0")
+    procs = []
+    log = open(os.path.join(run_dir, "server.log"), "wb")  # 子进程继承文件描述符后父进程这边即可关闭
+    procs.append(await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "server_test:beetle_server", "--host", "127.0.0.1",
+        "--port", str(args.server_port), "--log-level", "warning",
+        cwd=run_dir, env=env, stdout=log, stderr=log))
+    log.close()
+    for idx in range(args.workers):
+        log = open(os.path.join(run_dir, f"worker-{idx}.log"), "wb")
+        procs.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(HERE, "client_test.py"),
+            cwd=run_dir, env=dict(env, WORKER_ID=f"bench-worker-{idx}"), stdout=log, stderr=log))
+        log.close()
+    return procs
+
+
+async def wait_server(client: httpx.AsyncClient, base: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(f"{base}/metrics")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("server did not come up, see server.log")
+
+
+# --- 压测主流程 ---
+
+async def drive(args, client: httpx.AsyncClient, base: str, run_id: str):
+    """开环泊松到达：不管前面的任务是否完成，按 --rate 持续提交"""
+    sent = {}
+    counts = {"accepted": 0, "rejected": 0, "errors": 0}
+    types = args.types.split(",")
+
+    async def submit(idx: int):
+        task_serial = f"bench-{run_id}-{idx}"
+        mission = {
+            "taskSerial": task_serial,
+            "type": types[idx % len(types)],
+            "callbackurl": f"http://127.0.0.1:{args.sink_port}/callback",
+            "pictureList": [{"picId": str(p), "downloadUrl": f"http://127.0.0.1:{args.image_port}/img/{task_serial}-{p}"}
+                            for p in range(args.pictures)],
+        }
+        start = time.time()
+        try:
+            resp = await client.post(f"{base}/mission_entry", json=mission)
+            status = resp.json().get("status") if resp.status_code in (200, 429) else resp.status_code
+        except Exception:
+            status = None
+        if status == 200:
+            counts["accepted"] += 1
+            sent[task_serial] = start
+        elif status == 429:
+            counts["rejected"] += 1
+        else:
+            counts["errors"] += 1
+
+    tasks = []
+    idx = 0
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        tasks.append(asyncio.create_task(submit(idx)))
+        idx += 1
+        await asyncio.sleep(random.expovariate(args.rate))
+    await asyncio.gather(*tasks)
+    counts["sent"] = idx
+    return sent, counts
+
+
+async def main(args):
+    run_dir = tempfile.mkdtemp(prefix="beetle-bench-")
+    os.symlink(os.path.join(HERE, "promot"), os.path.join(run_dir, "promot"))
+    run_id = time.strftime("%H%M%S")
+
+    r = redis.from_url(args.redis, decode_responses=True)
+    await r.flushdb()
+    await r.aclose()
+
+    sink = CallbackSink(args)
+    servers = [await serve(make_ollama_app(args), args.ollama_port),
+               await serve(make_image_app(args), args.image_port),
+               await serve(sink.app(), args.sink_port)]
+    procs = await start_processes(args, run_dir)
+    base = f"http://127.0.0.1:{args.server_port}"
+
+    print(f"🚀 端到端压测 | {args.rate} 任务/s x {args.duration}s | 每任务 {args.pictures} 张 | "
+          f"workers: {args.workers} | 推理延迟: {args.infer_latency} | 日志: {run_dir}")
+    print("=" * 60)
+    try:
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            await wait_server(client, base)
+            bench_start = time.time()
+            sent, counts = await drive(args, client, base, run_id)
+
+            # 等已受理的任务全部回调或超时
+            deadline = time.monotonic() + args.drain_timeout
+            while time.monotonic() < deadline and any(ts not in sink.received for ts in sent):
+                sink.event.clear()
+                try:
+                    await asyncio.wait_for(sink.event.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+            window = f"{int(time.time() - bench_start) + 60}s"
+            stages = (await client.get(f"{base}/timeline/report", params={"window": window})).json().get("data") or {}
+    finally:
+        for proc in procs:
+            proc.terminate()
+        await asyncio.gather(*(proc.wait() for proc in procs))
+        for server, _ in servers:
+            server.should_exit = True
+        await asyncio.gather(*(task for _, task in servers))
+
+    latencies = sorted(sink.received[ts] - start for ts, start in sent.items() if ts in sink.received)
+    completed = len(latencies)
+    elapsed = (max(sink.received[ts] for ts in sent if ts in sink.received) - bench_start) if completed else 0.0
+    result = {
+        **counts,
+        "completed": completed,
+        "timed_out": len(sent) - completed,
+        "callback_attempts": sink.attempts,
+        "missions_per_second": round(completed / elapsed, 3) if elapsed else 0.0,
+        "pictures_per_second": round(completed * args.pictures / elapsed, 3) if elapsed else 0.0,
+        "e2e": {name: round(percentile(latencies, q), 3) for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))}
+        if latencies else {},
+        "stages": stages,
+    }
+
+    print(f"提交 {counts['sent']} | 受理 {counts['accepted']} | 429 拒绝 {counts['rejected']} | 错误 {counts['errors']} | "
+          f"完成 {completed} | 超时未完成 {result['timed_out']} | 回调请求 {sink.attempts}")
+    print(f"吞吐: {result['missions_per_second']} 任务/s, {result['pictures_per_second']} 张/s")
+    if latencies:
+        e2e = result["e2e"]
+        print(f"端到端延迟 (提交 -> 收到回调): p50={e2e['p50']:.2f}s  p95={e2e['p95']:.2f}s  "
+              f"p99={e2e['p99']:.2f}s  max={latencies[-1]:.2f}s")
+    print("-" * 60)
+    print("各阶段耗时 (秒，来自 /timeline/report):")
+    print_report(stages)
+    print("=" * 60)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(dict(result, args=vars(args)), f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已写入 {args.out}")
+    if not args.keep_logs:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # 负载
+    parser.add_argument("--rate", type=float, default=1.0, help="目标到达率 (任务/秒，泊松到达)")
+    parser.add_argument("--duration", type=float, default=30, help="持续提交的时间 (秒)")
+    parser.add_argument("--pictures", type=int, default=5, help="每个任务的图片数")
+    parser.add_argument("--types", type=str, default="is_spill", help="任务类型，逗号分隔时轮流使用")
+    parser.add_argument("--drain-timeout", type=float, default=120, help="提交结束后等待剩余任务完成的最长时间 (秒)")
+    parser.add_argument("--workers", type=int, default=1, help="启动的 worker 进程数")
+    # Ollama 替身
+    parser.add_argument("--infer-latency", type=str, default="lognormal:1.0,0.3",
+                        help="单次推理耗时分布：fixed:S / uniform:A,B / lognormal:中位数,sigma / exp:均值")
+    parser.add_argument("--infer-fail-rate", type=float, default=0.0, help="推理返回 HTTP 500 的比例")
+    parser.add_argument("--ollama-parallel", type=int, default=1, help="替身的并行槽位，同时作为 worker 的 OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--think-tokens", type=int, default=80, help="<think> 段的长度 (字符)")
+    parser.add_argument("--true-ratio", type=float, default=0.3, help="结论为 TRUE 的比例")
+    # 图片站与回调接收端
+    parser.add_argument("--download-latency", type=str, default="fixed:0.02", help="图片下载耗时分布")
+    parser.add_argument("--download-fail-rate", type=float, default=0.0, help="图片返回 404 的比例")
+    parser.add_argument("--image-pool", type=int, default=16, help="生成的不同图片数")
+    parser.add_argument("--image-width", type=int, default=1920)
+    parser.add_argument("--image-height", type=int, default=1080)
+    parser.add_argument("--callback-latency", type=str, default="fixed:0", help="回调接收端的响应耗时分布")
+    parser.add_argument("--callback-fail-rate", type=float, default=0.0, help="回调返回 HTTP 500 的比例 (走发件箱重试)")
+    # 环境
+    parser.add_argument("--redis", type=str, default="redis://localhost:6380/15", help="压测用 Redis 库，启动时会被清空")
+    parser.add_argument("--server-port", type=int, default=18000)
+    parser.add_argument("--ollama-port", type=int, default=11435)
+    parser.add_argument("--image-port", type=int, default=18081)
+    parser.add_argument("--sink-port", type=int, default=18090)
+    parser.add_argument("--out", type=str, default="", help="把结果写成 JSON，便于和上一次对比")
+    parser.add_argument("--keep-logs", action="store_true", help="保留临时目录里的 server / worker 日志和数据库")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,101 @@
+import io
+import os
+import time
+import asyncio
+import argparse
+import statistics
+
+from PIL import Image
+
+from image_engine import ImageEngine, preprocess_image, MAX_SIDE
+
+# --- 配置 ---
+TEST_IMAGE_DIR = "./workspace/images"
+
+
+def load_samples(image_dir: str, limit: int):
+    files = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg')))[:limit]
+    samples = []
+    for name in files:
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            samples.append(f.read())
+    return samples
+
+
+def make_small_samples(samples):
+    """生成已在尺寸限制内的 JPEG，用来衡量跳过重编码的收益"""
+    small = []
+    for raw in samples:
+        img = Image.open(io.BytesIO(raw)).convert('RGB')
+        img.thumbnail((MAX_SIDE, MAX_SIDE))
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=85)
+        small.append(buf.getvalue())
+    return small
+
+
+def bench_serial(samples, repeat, **kwargs):
+    """单线程逐张处理，返回每张耗时 (ms) 列表"""
+    costs = []
+    for _ in range(repeat):
+        for raw in samples:
+            t0 = time.perf_counter()
+            preprocess_image(raw, **kwargs)
+            costs.append((time.perf_counter() - t0) * 1000)
+    return costs
+
+
+async def bench_engine(engine: ImageEngine, samples, repeat):
+    """并发提交全部图片，返回吞吐 (张/秒)"""
+    # 预热进程池，不把子进程启动时间算进去
+    await engine.process(samples[0])
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        await asyncio.gather(*[engine.process(raw) for raw in samples])
+    return len(samples) * repeat / (time.perf_counter() - t0)
+
+
+def report(name, costs):
+    costs = sorted(costs)
+    p95 = costs[int(len(costs) * 0.95) - 1] if len(costs) >= 20 else costs[-1]
+    print(f"{name:<28} mean={statistics.mean(costs):7.1f}ms  p50={statistics.median(costs):7.1f}ms  p95={p95:7.1f}ms")
+
+
+async def main(args):
+    samples = load_samples(args.dir, args.n)
+    if not samples:
+        print(f"❌ 找不到图片: {args.dir}")
+        return
+    first = Image.open(io.BytesIO(samples[0]))
+    print(f"🚀 预处理基准 | 图片数: {len(samples)} | 样例尺寸: {first.size} | 目标边长: {MAX_SIDE} | 重复: {args.repeat}")
+    print("=" * 60)
+
+    report("full decode + re-encode", bench_serial(samples, args.repeat, draft=False, skip_reencode=False))
+    report("draft decode", bench_serial(samples, args.repeat, draft=True, skip_reencode=False))
+
+    small = make_small_samples(samples)
+    report("small: re-encode", bench_serial(small, args.repeat, draft=True, skip_reencode=False))
+    report("small: skip re-encode", bench_serial(small, args.repeat, draft=True, skip_reencode=True))
+
+    print("-" * 60)
+    workers = args.workers or os.cpu_count() or 1
+    for backend in ("thread", "process"):
+        for draft in (False, True):
+            engine = ImageEngine(backend=backend, workers=workers, draft=draft)
+            try:
+                tput = await bench_engine(engine, samples, args.repeat)
+            finally:
+                engine.shutdown()
+            print(f"{backend:<8} draft={str(draft):<5} workers={workers:<3} throughput={tput:7.1f} img/s")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", type=str, default=TEST_IMAGE_DIR, help="图片目录")
+    parser.add_argument("-n", type=int, default=30, help="最多使用的图片数")
+    parser.add_argument("--repeat", type=int, default=2, help="每种模式重复次数")
+    parser.add_argument("--workers", type=int, default=0, help="进程池大小，默认 CPU 核数")
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,114 @@
+import json
+import codecs
+from typing import AsyncIterator, Optional, Tuple
+
+# 单条记录解析失败时等待更多数据的上限，超过就判定为坏数据，避免无限缓存
+MAX_ITEM_BYTES = 1024 * 1024
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = " \t\r\n"
+
+
+async def iter_json_items(chunks: AsyncIterator[bytes], max_item_bytes: int = MAX_ITEM_BYTES
+                          ) -> AsyncIterator[Tuple[int, Optional[object], Optional[str]]]:
+    """
+    边接收边解析请求体，逐条产出 (序号, 对象, 错误信息)：
+    - 以 '[' 开头按 JSON 数组解析，数组中出现坏数据时无法定位下一条，报错后结束
+    - 否则按 NDJSON 每行一条解析，坏行只影响自己
+    不需要把整个请求体读进内存。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    mode = None
+    index = 0
+    need_comma = False
+    after_comma = False
+
+    async def more() -> Optional[str]:
+        async for chunk in chunks:
+            text = decoder.decode(chunk)
+            if text:
+                return text
+        return None
+
+    # 判断格式
+    while mode is None:
+        text = await more()
+        if text is None:
+            return
+        buf += text
+        stripped = buf.lstrip(_WHITESPACE)
+        if stripped:
+            mode = "array" if stripped[0] == "[" else "ndjson"
+            buf = stripped
+
+    if mode == "ndjson":
+        eof = False
+        while True:
+            while "\n" in buf:
+                line, buf = buf.split("\n", 1)
+                if line.strip():
+                    yield (index, *_loads(line))
+                    index += 1
+            if eof:
+                break
+            if len(buf) > max_item_bytes:
+                yield index, None, f"line exceeds {max_item_bytes} bytes"
+                return
+            text = await more()
+            if text is None:
+                eof = True
+                buf += "\n"
+            else:
+                buf += text
+        return
+
+    # 数组模式
+    buf = buf[1:]
+    eof = False
+    while True:
+        buf = buf.lstrip(_WHITESPACE)
+        if buf.startswith("]"):
+            if after_comma:
+                yield index, None, "trailing ',' before ']'"
+            return
+        if need_comma and buf:
+            if not buf.startswith(","):
+                yield index, None, "expected ',' between array items"
+                return
+            need_comma = False
+            after_comma = True
+            # 逗号后面必须还有一条，回到循环开头再检查是不是 ']'
+            buf = buf[1:]
+            continue
+        if buf:
+            try:
+                obj, end = _DECODER.raw_decode(buf)
+            except json.JSONDecodeError as e:
+                if eof or len(buf) > max_item_bytes:
+                    yield index, None, f"invalid JSON: {e.msg}"
+                    return
+            else:
+                # 数字可能被截断在块边界上，后面没有分隔符时再等一块
+                if end < len(buf) or eof:
+                    yield index, obj, None
+                    index += 1
+                    need_comma = True
+                    after_comma = False
+                    buf = buf[end:]
+                    continue
+        elif eof:
+            yield index, None, "unexpected end of array"
+            return
+        text = await more()
+        if text is None:
+            eof = True
+        else:
+            buf += text
+
+
+def _loads(line: str) -> Tuple[Optional[object], Optional[str]]:
+    try:
+        return json.loads(line), None
+    except json.JSONDecodeError as e:
+        return None, f"invalid JSON: {e.msg}"
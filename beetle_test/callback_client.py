@@ -0,0 +1,51 @@
+import importlib.util
+import logging
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+def http2_available() -> bool:
+    # h2 是 httpx 的 HTTP/2 依赖，可选安装 (pip install httpx[http2])
+    return importlib.util.find_spec("h2") is not None
+
+
+class CallbackClient:
+    """
+    用户回调的共享 HTTP 客户端，整个应用生命周期只建一个 httpx.AsyncClient：
+    - keep-alive 连接复用，同一客户主机的回调不再每次 DNS + TCP + TLS
+    - 每个主机的并发上限由 CallbackOutbox 统一控制，这里不再重复限制
+    - 可选 HTTP/2 (需要 h2 包，未安装时自动退回 HTTP/1.1)
+    """
+
+    def __init__(self, max_connections: int = 100, timeout: float = 10.0,
+                 connect_timeout: float = 5.0, keepalive_expiry: float = 30.0, http2: bool = False):
+        self.max_connections = max_connections
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self.http2 and not http2_available():
+            logger.warning("HTTP/2 requested for callbacks but 'h2' is not installed, using HTTP/1.1")
+            self.http2 = False
+        self._client = httpx.AsyncClient(
+            http2=self.http2,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_connections,
+                                keepalive_expiry=self.keepalive_expiry),
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def post(self, url: str, json: dict, timeout: Optional[float] = None) -> httpx.Response:
+        if self._client is None:
+            await self.start()
+        return await self._client.post(url, json=json, timeout=timeout or self.timeout)
@@ -0,0 +1,271 @@
+import time
+import json
+import random
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Callable, List, Optional
+from urllib.parse import urlsplit
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS callback_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_serial TEXT,
+        url TEXT,
+        payload TEXT,
+        status TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+OUTBOX_INDEX = "CREATE INDEX IF NOT EXISTS idx_outbox_due ON callback_outbox (status, next_attempt_at)"
+# host 列 (回调地址的 netloc) 由 db_migrations v6 加入，老数据在迁移里回填
+OUTBOX_HOST_BACKFILL = (
+    "UPDATE callback_outbox SET host = substr(substr(url, instr(url, '://') + 3), 1, "
+    "instr(substr(url, instr(url, '://') + 3) || '/', '/') - 1)"
+)
+
+CALLBACK_SECONDS = Histogram("beetle_callback_seconds", "User callback POST latency", ["outcome"])
+CALLBACK_ATTEMPTS = Counter("beetle_callback_attempts_total", "Callback delivery attempts by result", ["result"])
+
+
+class CallbackOutbox:
+    """
+    持久化的回调发件箱。结果落库时同事务写入 callback_outbox，后台 dispatcher 负责投递：
+    - 失败按指数退避 + 抖动重试 (base * 2^attempts，封顶 max_backoff，乘以 0.5~1.5 随机系数)
+    - 每个主机单独限制在途投递数：取待投递行时在 SQL 里排除已饱和的主机，且每个主机每轮最多取 per_host_limit 行，
+      慢/挂掉的客户积压再多也占不满一轮的批次，不会拖住健康客户
+    - 每个主机最多占 global_host_share 个全局名额；上一次投递失败的主机只留 1 个在途投递试探，成功后恢复，
+      挂住的主机在超时前也占不满全局名额
+    - 对方已收到 (2xx) 但状态没写进库时持续重试写库，期间这一行不会被再次投递
+    - 超过 max_attempts 转为 DEAD (死信)，可以通过 replay() 重新投递
+    missions.callback_status 同步为 WAITING -> RETRYING -> SUCCESS / DEAD。
+    """
+
+    def __init__(self, writer, read_pool, client, global_limit: asyncio.Semaphore, max_attempts: int = 8,
+                 base_backoff: float = 2.0, max_backoff: float = 600.0, per_host_limit: int = 10,
+                 batch_size: int = 200, poll_interval: float = 1.0, global_host_share: Optional[int] = None,
+                 on_status: Optional[Callable[[str, str], None]] = None):
+        self.writer = writer
+        self.read_pool = read_pool
+        self.client = client
+        self.global_limit = global_limit
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.per_host_limit = per_host_limit
+        self.global_host_share = global_host_share or per_host_limit
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.on_status = on_status  # 回调状态变化通知 (taskSerial, status)
+
+        self._wake = asyncio.Event()
+        self._inflight = set()
+        self._settled = set()     # 本轮查询期间写完状态的行，查询结果可能还是旧的 PENDING，本轮跳过
+        self._host_inflight = defaultdict(int)
+        self._host_failures = {}  # 主机连续失败次数，成功后清除
+        self._deliveries = set()  # 投递协程的引用，完成后自动移除
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- 入队 ----------
+
+    @staticmethod
+    async def enqueue(db, rows: List[tuple]):
+        """在调用方的事务里写入待投递回调，rows = [(task_serial, url, payload_json), ...]"""
+        now = time.time()
+        await db.executemany(
+            "INSERT INTO callback_outbox (task_serial, url, host, payload, status, attempts, next_attempt_at) "
+            "VALUES (?, ?, ?, ?, 'PENDING', 0, ?)",
+            [(task_serial, url, urlsplit(url).netloc, payload, now) for task_serial, url, payload in rows]
+        )
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+    def notify(self):
+        self._wake.set()
+
+    # ---------- 调度 ----------
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._deliveries):
+            task.cancel()
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * (2 ** attempts))
+        return delay * random.uniform(0.5, 1.5)
+
+    def _host_limit(self, host: str) -> int:
+        """主机当前允许的在途投递数 (每个在途投递占一个全局名额)"""
+        if self._host_failures.get(host):
+            return 1
+        return min(self.per_host_limit, self.global_host_share)
+
+    async def _due_rows(self):
+        saturated = [host for host, count in self._host_inflight.items() if count >= self._host_limit(host)]
+        host_filter = f"AND host NOT IN ({','.join('?' * len(saturated))}) " if saturated else ""
+        async with self.read_pool.connection() as db:
+            # 每个主机最多取 per_host_limit 行 (在途的行仍是 PENDING，也算在内)，积压的主机占不满批次
+            async with db.execute(
+                "SELECT id, task_serial, url, payload, attempts, host FROM ("
+                "SELECT *, ROW_NUMBER() OVER (PARTITION BY host ORDER BY next_attempt_at) AS host_rank "
+                "FROM callback_outbox WHERE status = 'PENDING' AND next_attempt_at <= ? " + host_filter +
+                ") WHERE host_rank <= ? ORDER BY next_attempt_at LIMIT ?",
+                [time.time(), *saturated, self.per_host_limit, self.batch_size + len(self._inflight)]
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def _run(self):
+        logger.info("Callback dispatcher started...")
+        while True:
+            try:
+                self._settled.clear()
+                for row in await self._due_rows():
+                    row_id, host = row[0], row[5]
+                    if row_id in self._inflight or row_id in self._settled:
+                        continue
+                    if self._host_inflight[host] >= self._host_limit(host):
+                        continue
+                    self._inflight.add(row_id)
+                    self._host_inflight[host] += 1
+                    task = asyncio.create_task(self._deliver(row[:5], host))
+                    self._deliveries.add(task)
+                    task.add_done_callback(self._deliveries.discard)
+            except Exception as e:
+                logger.error(f"Dispatcher Error: {e}")
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, row, host: str):
+        row_id, task_serial, url, payload, attempts = row
+        error = None
+        start = time.perf_counter()
+        try:
+            async with self.global_limit:
+                logger.info(f"Callback posting to {url} (attempt {attempts + 1})")
+                resp = await self.client.post(url, json=json.loads(payload))
+            logger.info(f"User response code: {resp.status_code}")
+            # 只要对方回 200 就认为成功
+            if resp.status_code != 200:
+                error = f"HTTP {resp.status_code}"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            logger.error(f"Callback failed: {error}")
+        CALLBACK_SECONDS.observe(time.perf_counter() - start, outcome="ok" if error is None else "error")
+
+        if error is None:
+            self._host_failures.pop(host, None)
+        else:
+            self._host_failures[host] = self._host_failures.get(host, 0) + 1
+        self._host_inflight[host] -= 1
+        if self._host_inflight[host] <= 0:
+            del self._host_inflight[host]
+        # 主机名额空出来了，马上看看有没有同主机的待投递
+        self.notify()
+
+        # 写库完成前这一行一直留在 _inflight 里，不会被重复投递
+        try:
+            delay = 0.5
+            while True:
+                try:
+                    await self._record(row_id, task_serial, attempts + 1, error)
+                    break
+                except Exception as e:
+                    logger.error(f"Outbox update failed for {row_id}, retrying in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30.0)
+        finally:
+            self._inflight.discard(row_id)
+            self._settled.add(row_id)
+
+    async def _record(self, row_id: int, task_serial: str, attempts: int, error: Optional[str]):
+        if error is None:
+            result = "delivered"
+            outbox_sql = ("UPDATE callback_outbox SET status = 'DELIVERED', attempts = ?, last_error = NULL, "
+                          "updated_at = CURRENT_TIMESTAMP WHERE id = ?", (attempts, row_id))
+            mission_status = "SUCCESS"
+        elif attempts >= self.max_attempts:
+            result = "dead"
+            outbox_sql = ("UPDATE callback_outbox SET status = 'DEAD', attempts = ?, last_error = ?, "
+                          "updated_at = CURRENT_TIMESTAMP WHERE id = ?", (attempts, error, row_id))
+            mission_status = "DEAD"
+        else:
+            result = "retry"
+            outbox_sql = ("UPDATE callback_outbox SET attempts = ?, last_error = ?, next_attempt_at = ?, "
+                          "updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                          (attempts, error, time.time() + self.backoff(attempts), row_id))
+            mission_status = "RETRYING"
+
+        async def job(db):
+            await db.execute(*outbox_sql)
+            await db.execute("UPDATE missions SET callback_status = ? WHERE task_serial = ?", (mission_status, task_serial))
+            if error is None:
+                # 生命周期时间线的最后一个阶段
+                await db.execute("UPDATE missions SET callback_delivered_at = ? WHERE task_serial = ?",
+                                 (time.time(), task_serial))
+        await self.writer.run(job)
+        CALLBACK_ATTEMPTS.inc(result=result)
+        if result == "dead":
+            logger.error(f"☠️ Callback for {task_serial} dead after {attempts} attempts: {error}")
+        if self.on_status is not None:
+            self.on_status(task_serial, mission_status)
+
+    # ---------- 死信 ----------
+
+    async def list_dead(self, limit: int = 100) -> List[dict]:
+        async with self.read_pool.connection() as db:
+            async with db.execute(
+                "SELECT id, task_serial, url, attempts, last_error, updated_at FROM callback_outbox "
+                "WHERE status = 'DEAD' ORDER BY id DESC LIMIT ?", (limit,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+        return [
+            {"id": r[0], "taskSerial": r[1], "url": r[2], "attempts": r[3], "lastError": r[4], "updatedAt": r[5]}
+            for r in rows
+        ]
+
+    async def replay(self, ids: Optional[List[int]] = None, task_serial: Optional[str] = None) -> int:
+        """把死信重新置为待投递；不带条件时重放全部死信"""
+        where, params = "status = 'DEAD'", []
+        if ids:
+            where += f" AND id IN ({','.join('?' * len(ids))})"
+            params.extend(ids)
+        if task_serial:
+            where += " AND task_serial = ?"
+            params.append(task_serial)
+
+        async def job(db):
+            async with db.execute(f"SELECT DISTINCT task_serial FROM callback_outbox WHERE {where}", params) as cursor:
+                serials = [row[0] for row in await cursor.fetchall()]
+            cursor = await db.execute(
+                f"UPDATE callback_outbox SET status = 'PENDING', attempts = 0, next_attempt_at = ?, "
+                f"updated_at = CURRENT_TIMESTAMP WHERE {where}", [time.time()] + params
+            )
+            await db.executemany("UPDATE missions SET callback_status = 'WAITING' WHERE task_serial = ?",
+                                 [(serial,) for serial in serials])
+            return cursor.rowcount, serials
+        count, serials = await self.writer.run(job)
+        if self.on_status is not None:
+            for serial in serials:
+                self.on_status(serial, "WAITING")
+        self.notify()
+        return count
+
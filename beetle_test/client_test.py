@@ -1,40 +1,133 @@
-import re
 import asyncio
 import logging
 import os
-import io
-import base64
 import json
-from typing import List, Optional
+import time
+from typing import Dict, List, Optional
 
 import redis.asyncio as redis
 import httpx
-import requests
 import aiofiles
 from pydantic import BaseModel
-from PIL import Image
 
 from Prompt_loader import PromptLoader
+from infer_scheduler import InferScheduler
+from ollama_client import OllamaClient, outcome_of
+from ollama_pool import OllamaPool
+from verdict_cache import VerdictCache
+from image_engine import ImageEngine
+from stream_transport import make_transport, default_consumer_name
+from lanes import LaneScheduler
+from metrics import Collector, Counter, Histogram, start_metrics_server
 
 # --- 配置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - [WORKER] - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Ollama 配置
-OLLAMA_URL = "http://localhost:11434/api/generate"
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/generate")
 OLLAMA_MODEL = "spill-thinking"
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "120"))
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "8"))
+# 多后端：逗号分隔的 Ollama 地址 (如 http://gpu1:11434,http://gpu2:11434)，为空时只用 OLLAMA_URL
+OLLAMA_BACKENDS = [url for url in os.getenv("OLLAMA_BACKENDS", "").split(",") if url.strip()]
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+# 任务类型亲和：同一类型固定打到同一台后端，系统提示词留在那台的 prompt cache 里
+OLLAMA_AFFINITY = os.getenv("OLLAMA_AFFINITY", "0") == "1"
+# 流式生成：解析到结论后立即断开，省掉模型在结论之后继续输出的 token
+OLLAMA_STREAM = os.getenv("OLLAMA_STREAM", "1") != "0"
+# 输出格式：text = 理由/结果 文本 (正则解析)；json = schema 约束 JSON + 按任务类型的 num_predict 上限
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "text")
 IMAGE_SAVE_DIR = "./workspace/images"
 os.makedirs(IMAGE_SAVE_DIR, exist_ok=True)
-SYSTEM_INSTRUCTION = PromptLoader("./promot/spill_promot.yaml")
+SYSTEM_INSTRUCTION = PromptLoader(os.getenv("PROMPT_FILE", "./promot/spill_promot.yaml"))
+# 提示词文件热更新检查间隔 (秒)，0 为关闭
+PROMPT_RELOAD_INTERVAL = float(os.getenv("PROMPT_RELOAD_INTERVAL", "5"))
 
 # Redis 配置 (连接宿主机 6380)
-REDIS_URL = "redis://localhost:6380"
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6380")
 TASK_QUEUE = "queue:missions"
 RESULT_QUEUE = "queue:results"
+# 写进每张图片的阶段时间戳里，用于按 worker 排查慢图
+WORKER_NAME = default_consumer_name()
+
+# 并发配置：同时在途的任务数 / 全局在途图片数（下载完成但尚未推理完的图片也算在内）
+MAX_INFLIGHT_MISSIONS = int(os.getenv("MAX_INFLIGHT_MISSIONS", "2"))
+MAX_INFLIGHT_PICTURES = int(os.getenv("MAX_INFLIGHT_PICTURES", "64"))
+
+# 推理调度：并发上限对齐 Ollama 的并行槽位，OLLAMA_SCHED_ADAPTIVE=0 时固定用满槽位
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "1"))
+OLLAMA_SCHED_ADAPTIVE = os.getenv("OLLAMA_SCHED_ADAPTIVE", "1") != "0"
+OLLAMA_LATENCY_TOLERANCE = float(os.getenv("OLLAMA_LATENCY_TOLERANCE", "1.5"))
+# call_ollama_sync 失败时返回的理由前缀，用于把失败反馈给调度器
+INFER_ERROR_PREFIXES = ("HTTP Error", "Connection Refused", "Timeout", "Exception")
+OLLAMA_POOL = OllamaPool(
+    OLLAMA_BACKENDS, OLLAMA_MODEL,
+    check_interval=OLLAMA_HEALTH_INTERVAL,
+    affinity=OLLAMA_AFFINITY,
+    # 亲和的后端比最空闲的多出一整台的并行槽位时才溢出
+    affinity_slack=int(os.getenv("OLLAMA_AFFINITY_SLACK", str(OLLAMA_NUM_PARALLEL))),
+) if OLLAMA_BACKENDS else None
+OLLAMA_BACKEND_COUNT = len(OLLAMA_POOL) if OLLAMA_POOL else 1
 
 # 资源锁
 GLOBAL_DOWNLOAD_SEM = asyncio.Semaphore(10)
-GLOBAL_OLLAMA_LOCK = asyncio.Lock()
+INFER_SCHEDULER = InferScheduler(
+    # 每台后端 OLLAMA_NUM_PARALLEL 个槽位
+    max_parallel=OLLAMA_NUM_PARALLEL * OLLAMA_BACKEND_COUNT,
+    adaptive=OLLAMA_SCHED_ADAPTIVE,
+    latency_tolerance=OLLAMA_LATENCY_TOLERANCE,
+)
+# 共享连接池的 Ollama 客户端 (keep-alive)，推理不再占用默认线程池
+OLLAMA_CLIENT = OllamaClient(OLLAMA_URL, OLLAMA_MODEL, max_connections=OLLAMA_POOL_SIZE * OLLAMA_BACKEND_COUNT,
+                             timeout=OLLAMA_TIMEOUT, stream=OLLAMA_STREAM, output_format=OUTPUT_FORMAT,
+                             pool=OLLAMA_POOL)
+GLOBAL_MISSION_SEM = asyncio.Semaphore(MAX_INFLIGHT_MISSIONS)
+# 常驻后台协程 (如提示词热更新) 的引用，事件循环只持有弱引用
+BACKGROUND_TASKS = set()
+GLOBAL_PICTURE_SEM = asyncio.Semaphore(MAX_INFLIGHT_PICTURES)
+
+# 图片预处理：默认线程池 + JPEG draft 解码，IMAGE_ENGINE_BACKEND=process 切到进程池
+IMAGE_ENGINE = ImageEngine(
+    backend=os.getenv("IMAGE_ENGINE_BACKEND", "thread"),
+    workers=int(os.getenv("IMAGE_ENGINE_WORKERS", "0")) or None,
+    draft=os.getenv("IMAGE_ENGINE_DRAFT", "1") != "0",
+)
+
+# 推理结论缓存：相同图片 + 提示词 + 模型直接复用结论，L2 存在 Redis 里供多个 worker 共享
+VERDICT_CACHE_ENABLED = os.getenv("VERDICT_CACHE_ENABLED", "1") != "0"
+VERDICT_CACHE = VerdictCache(
+    OLLAMA_MODEL,
+    lru_size=int(os.getenv("VERDICT_CACHE_LRU_SIZE", "2048")),
+    ttl=int(os.getenv("VERDICT_CACHE_TTL", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("VERDICT_CACHE_MAX_ENTRIES", "200000")),
+)
+
+# 图片内存预算：下载的字节直接经队列交给 consumer，超出预算的部分才落盘
+IMAGE_MEMORY_BUDGET = int(os.getenv("IMAGE_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+IMAGE_SPILL_TO_DISK = os.getenv("IMAGE_SPILL_TO_DISK", "1") != "0"
+
+
+# --- 监控指标 (WORKER_METRICS_PORT 上的 /metrics，0 为关闭) ---
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9101"))
+DOWNLOAD_SECONDS = Histogram("beetle_download_seconds", "Image download latency", ["outcome"])
+PREPROCESS_SECONDS = Histogram("beetle_preprocess_seconds", "Image decode/resize/encode latency")
+WORKER_PICTURES = Counter("beetle_worker_pictures_total", "Pictures processed by this worker", ["type", "outcome"])
+WORKER_MISSIONS = Counter("beetle_worker_missions_total", "Missions (or shards) processed by this worker", ["outcome"])
+WORKER_ERRORS = Counter("beetle_worker_errors_total", "Worker errors by stage and reason", ["stage", "reason"])
+Collector("beetle_infer_scheduler", "Inference scheduler state (limit, inflight, waiting, latency, throughput)",
+          "gauge", lambda: {(name,): value for name, value in INFER_SCHEDULER.stats().items()}, ["field"])
+Collector("beetle_verdict_cache_lookups_total", "Verdict cache lookups by result", "counter",
+          lambda: {(name,): VERDICT_CACHE.counters[name] for name in ("l1_hits", "l2_hits", "shared", "misses")},
+          ["result"])
+Collector("beetle_verdict_cache_errors_total", "Verdict cache Redis errors", "counter",
+          lambda: {(): VERDICT_CACHE.counters["errors"]})
+Collector("beetle_image_memory_bytes", "Downloaded image bytes held in memory", "gauge",
+          lambda: {(): IMAGE_MEMORY.used})
+Collector("beetle_ollama_backend_up", "Ollama backend health (1 up, 0 down)", "gauge",
+          lambda: {(b.url,): int(b.healthy) for b in (OLLAMA_POOL.backends if OLLAMA_POOL else [])}, ["backend"])
+Collector("beetle_ollama_backend_outstanding", "Requests in flight per Ollama backend", "gauge",
+          lambda: {(b.url,): b.outstanding for b in (OLLAMA_POOL.backends if OLLAMA_POOL else [])}, ["backend"])
 
 
 # --- 数据结构 (需与服务端一致) ---
@@ -53,149 +146,158 @@ class MissionRequest(BaseModel):
     type: str
     callbackurl: str
     pictureList: List[PictureItem]
+    # 服务端切片后的分片信息，整任务时为 None
+    shardIndex: Optional[int] = None
+    shardCount: Optional[int] = None
+    # 阶段时间戳 (epoch 秒)，服务端入队时写入 enqueued
+    timeline: Optional[Dict[str, float]] = None
 
 
 class CallbackItem(BaseModel):
     picId: str
     result: bool
     reason: str  # 理由字段
+    # 本图各阶段时间戳与处理它的 worker，服务端落库后不会转发给用户
+    timeline: Optional[dict] = None
+    # 推理时用的提示词版本 (内容哈希)，同样只落库
+    promptVersion: Optional[str] = None
 
 
 class CallbackPayload(BaseModel):
     taskSerial: str
     type: str
     data: List[CallbackItem]
+    shardIndex: Optional[int] = None
+    shardCount: Optional[int] = None
+    timeline: Optional[Dict[str, float]] = None
+
+
+class MemoryBudget:
+    """在途图片字节数的记账，超出上限时由调用方决定落盘"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+
+    def try_reserve(self, size: int) -> bool:
+        if self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def force_reserve(self, size: int):
+        self.used += size
+
+    def release(self, size: int):
+        self.used = max(0, self.used - size)
+
+
+IMAGE_MEMORY = MemoryBudget(IMAGE_MEMORY_BUDGET)
 
 
 class QueueItem:
-    def __init__(self, pic_id: str, file_path: str, success: bool):
+    def __init__(self, pic_id: str, file_path: str, success: bool, data: Optional[bytes] = None):
         self.pic_id = pic_id
         self.file_path = file_path
         self.success = success
+        self.data = data  # 内存中的图片字节，落盘时为 None
+        self.download_done = time.time()
+        # producer 为每张图片占了一个 GLOBAL_PICTURE_SEM 名额，处理完只归还一次
+        self.holds_slot = True
+
+    def source(self):
+        return self.data if self.data is not None else self.file_path
+
+    def discard(self):
+        """处理完成后释放内存预算或删除落盘文件"""
+        if self.data is not None:
+            IMAGE_MEMORY.release(len(self.data))
+            self.data = None
+        elif self.file_path:
+            try:
+                os.remove(self.file_path)
+            except OSError:
+                pass
+
+    def release_slot(self):
+        if self.holds_slot:
+            self.holds_slot = False
+            GLOBAL_PICTURE_SEM.release()
 
 
 # --- 图像处理与模型调用 ---
 
-def process_image_sync(file_path: str) -> str:
-    try:
-        img = Image.open(file_path)
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        # 保持比例缩放，限制最大边长 640，防止显存溢出
-        img.thumbnail((640, 640), Image.Resampling.LANCZOS)
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG", quality=85)
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
-    except Exception as e:
-        logger.error(f"Img Error: {e}")
-        return ""
-
-def call_ollama_sync(image_base64: str, current_prompt: str):
-    if not image_base64:
-        logger.error("❌ ABORTING: Image data is empty!")
-        return False, "Image Error: No base64 data"
-
-    # 微调模型不需要太复杂的 Prompt，简单的指令即可触发它的能力
-    user_task = "请分析图像。请先在<think>标签中思考，然后严格按格式回答：\n理由：[理由]\n结果：[TRUE或FALSE]"
-
-    payload = {
-        "model": OLLAMA_MODEL,  # 确保这里是你 ollama list 里的名字
-        "system": current_prompt,   # 传入 yaml 里的提示词
-        "prompt": user_task,
-        "images": [image_base64],
-        "stream": False,
-        "options": {
-            "temperature": 0.1,  # 稍微给一点温度
-            "num_ctx": 8192,     # 【关键】防止长思维链被截断
-            "top_p": 0.9
-        }
-    }
+def process_image_sync(source) -> str:
+    # source 可以是文件路径，也可以是内存中的图片字节；worker 内走 IMAGE_ENGINE.process
+    return IMAGE_ENGINE.process_sync(source)
+
+def is_cacheable(verdict) -> bool:
+    # 调用失败 / 解析失败的结果不进缓存，下次重新推理
+    return not verdict[1].startswith(INFER_ERROR_PREFIXES + ("Parse Error", "Image Error"))
 
-    try:
-        response = requests.post(OLLAMA_URL, json=payload, timeout=120)
-
-        if response.status_code != 200:
-            logger.critical(f"❌ OLLAMA API ERROR: {response.status_code}")
-            return False, f"HTTP Error {response.status_code}"
-
-        response_json = response.json()
-        raw_text = response_json.get("response", "").strip()
-        
-        # 记录原始输出以便调试
-        logger.info(f"🤖 Raw Output: {raw_text[:200]}...") 
-
-        # --- 核心解析逻辑 Start ---
-        
-        # 1. 移除 <think> 标签及其内容
-        # 这是为了防止模型在思考过程中提到 "TRUE" (比如 "Is this TRUE? No.") 导致误判
-        clean_text = re.sub(r'<think>.*?(?:</think>|$)', '', raw_text, flags=re.DOTALL).strip()
-        
-        # 2. 提取结果 (优先匹配标准格式)
-        result_bool = False
-        # 匹配 "结果：TRUE" 或 "Result: TRUE"
-        if re.search(r'(结果|Result)[:：]\s*TRUE', clean_text, re.IGNORECASE):
-            result_bool = True
-        elif re.search(r'(结果|Result)[:：]\s*FALSE', clean_text, re.IGNORECASE):
-            result_bool = False
-        else:
-            # 兜底匹配：只在清洗后的文本中找单词
-            if "TRUE" in clean_text.upper():
-                result_bool = True
-            elif "FALSE" in clean_text.upper():
-                result_bool = False
-            else:
-                logger.warning(f"⚠️ 解析失败: {clean_text[:50]}...")
-                return False, "Parse Error"
-
-        # 3. 提取理由
-        clean_reason = "Model provided no details."
-        # 尝试提取 "理由：" 后面的内容
-        reason_match = re.search(r'(理由|Reason)[:：](.*?)(?=(结果|Result)|$)', clean_text, re.DOTALL | re.IGNORECASE)
-        if reason_match:
-            clean_reason = reason_match.group(2).strip()
-        else:
-            # 如果没找到标准理由格式，就用去掉结果后的剩余文本
-            clean_reason = re.sub(r'(结果|Result)[:：]\s*(TRUE|FALSE)', '', clean_text, flags=re.IGNORECASE).strip()
-
-        # --- 核心解析逻辑 End ---
-
-        return result_bool, clean_reason
-
-    except requests.exceptions.ConnectionError:
-        logger.critical(f"❌ CONNECTION DEAD: Check Ollama.")
-        return False, "Connection Refused"
-    except Exception as e:
-        logger.error(f"❌ CRASH: {str(e)}")
-        return False, f"Exception: {str(e)}"
+
+def call_ollama_sync(image_base64: str, current_prompt: str, num_predict: Optional[int] = None):
+    # 同步薄封装，供 run_test.py 等脚本调用；worker 内走 OLLAMA_CLIENT.generate
+    return OLLAMA_CLIENT.generate_sync(image_base64, current_prompt, num_predict=num_predict)
 
 
 # --- 生产消费流程 ---
 
 async def producer(queue: asyncio.Queue, picture_list: List[PictureItem], taskSerial: str):
-    async def download_one(client, pic):
+    async def fetch_one(client, pic) -> QueueItem:
         url = pic.get_url()
         if not url:
-            await queue.put(QueueItem(pic.picId, "", False))
-            return
+            return QueueItem(pic.picId, "", False)
 
         async with GLOBAL_DOWNLOAD_SEM:
             file_path = os.path.join(IMAGE_SAVE_DIR, f"{taskSerial}_{pic.picId}.jpg")
             # 简单的防重下载逻辑，可根据需要移除
             if os.path.exists(file_path):
-                await queue.put(QueueItem(pic.picId, file_path, True))
-                return
+                return QueueItem(pic.picId, file_path, True)
 
+            start = time.perf_counter()
             try:
                 resp = await client.get(url, timeout=30.0)
+                DOWNLOAD_SECONDS.observe(time.perf_counter() - start,
+                                         outcome="ok" if resp.status_code == 200 else "http_error")
                 if resp.status_code == 200:
-                    async with aiofiles.open(file_path, 'wb') as f:
-                        await f.write(resp.content)
-                    await queue.put(QueueItem(pic.picId, file_path, True))
+                    content = resp.content
+                    if IMAGE_MEMORY.try_reserve(len(content)):
+                        return QueueItem(pic.picId, "", True, data=content)
+                    elif IMAGE_SPILL_TO_DISK:
+                        # 超出内存预算才落盘
+                        async with aiofiles.open(file_path, 'wb') as f:
+                            await f.write(content)
+                        return QueueItem(pic.picId, file_path, True)
+                    else:
+                        # 不允许落盘时仍放在内存里，总量由 GLOBAL_PICTURE_SEM 兜底
+                        IMAGE_MEMORY.force_reserve(len(content))
+                        return QueueItem(pic.picId, "", True, data=content)
                 else:
-                    await queue.put(QueueItem(pic.picId, "", False))
+                    WORKER_ERRORS.inc(stage="download", reason=f"http_{resp.status_code}")
+                    return QueueItem(pic.picId, "", False)
             except Exception as e:
                 logger.error(f"Download error: {e}")
-                await queue.put(QueueItem(pic.picId, "", False))
+                DOWNLOAD_SECONDS.observe(time.perf_counter() - start, outcome="exception")
+                WORKER_ERRORS.inc(stage="download", reason=type(e).__name__)
+                return QueueItem(pic.picId, "", False)
+
+    async def download_one(client, pic):
+        # 先占一个全局图片名额，由 consumer 处理完该图片后释放，
+        # 这样多个任务并行时在途图片总数（磁盘/内存占用）有上限
+        await GLOBAL_PICTURE_SEM.acquire()
+        try:
+            item = await fetch_one(client, pic)
+        except BaseException:
+            # 下载中任务被取消，图片还没交给 consumer，名额在这里归还
+            GLOBAL_PICTURE_SEM.release()
+            raise
+        try:
+            await queue.put(item)
+        except BaseException:
+            item.discard()
+            item.release_slot()
+            raise
 
     async with httpx.AsyncClient(verify=False) as client:
         tasks = [download_one(client, pic) for pic in picture_list]
@@ -203,80 +305,192 @@ async def producer(queue: asyncio.Queue, picture_list: List[PictureItem], taskSe
     await queue.put(None)
 
 
-async def consumer(queue: asyncio.Queue, total_count: int, current_prompt: str) -> List[CallbackItem]:
-    results = []
-    processed_count = 0
-    while processed_count < total_count:
-        item = await queue.get()
-        if item is None:
-            break
-        
-        res_bool = False
-        res_reason = "Download Failed"
-        
+async def handle_picture(item: QueueItem, current_prompt: str, num_predict: Optional[int], mission_type: str,
+                         dequeued: Optional[float], prompt_version: str) -> CallbackItem:
+    """处理一张已下载的图片：预处理 -> (缓存) 推理，结束后归还全局图片名额"""
+    res_bool = False
+    res_reason = "Download Failed"
+    stamps = {"worker": WORKER_NAME, "dequeued": dequeued, "download_done": item.download_done}
+
+    try:
         if item.success:
-            b64 = await asyncio.to_thread(process_image_sync, item.file_path)
+            with PREPROCESS_SECONDS.time():
+                b64 = await IMAGE_ENGINE.process(item.source())
+            stamps["preprocess_done"] = time.time()
+            # 原图已编码成缩略图，推理排队前就归还内存预算
+            item.discard()
             if b64:
-                async with GLOBAL_OLLAMA_LOCK:
-                    logger.info(f"Inference: {item.pic_id}")
-                    # 调用模型，获取 bool 和 string
-                    res_bool, res_reason = await asyncio.to_thread(call_ollama_sync, b64, current_prompt)
-            
-            # 删图
-            try:
-                os.remove(item.file_path)
-            except:
-                pass
-
-        results.append(CallbackItem(picId=item.pic_id, result=res_bool, reason=res_reason))
-        processed_count += 1
-        queue.task_done()
-    return results
-
-
-async def process_mission(mission_data: str, redis_client):
+                async def infer():
+                    async with INFER_SCHEDULER.slot() as ticket:
+                        logger.info(f"Inference: {item.pic_id} (waiting: {INFER_SCHEDULER.queue_depth})")
+                        stamps["inference_start"] = time.time()
+                        # 调用模型，获取 bool 和 string
+                        verdict = await OLLAMA_CLIENT.generate(b64, current_prompt, num_predict=num_predict,
+                                                               affinity=mission_type)
+                        stamps["inference_end"] = time.time()
+                        ticket.ok = not verdict[1].startswith(INFER_ERROR_PREFIXES)
+                        return verdict
+
+                if VERDICT_CACHE_ENABLED:
+                    # 版本号已包含提示词和 token 上限的哈希，不用再对整段提示词做哈希
+                    cache_key = VERDICT_CACHE.make_key(b64, prompt_version or current_prompt, OUTPUT_FORMAT)
+                    res_bool, res_reason = await VERDICT_CACHE.get_or_compute(cache_key, infer, is_cacheable)
+                else:
+                    res_bool, res_reason = await infer()
+    finally:
+        # 释放内存 / 删图
+        item.discard()
+        item.release_slot()
+
+    outcome = outcome_of(res_reason) if item.success else "download_failed"
+    if outcome == "ok":
+        outcome = "true" if res_bool else "false"
+    elif item.success:
+        WORKER_ERRORS.inc(stage="inference", reason=outcome)
+    WORKER_PICTURES.inc(type=mission_type, outcome=outcome)
+    return CallbackItem(picId=item.pic_id, result=res_bool, reason=res_reason, timeline=stamps,
+                        promptVersion=prompt_version or None)
+
+
+async def consumer(queue: asyncio.Queue, picture_list: List[PictureItem], current_prompt: str,
+                   num_predict: Optional[int] = None, mission_type: str = "",
+                   dequeued: Optional[float] = None, prompt_version: str = "") -> List[CallbackItem]:
+    # 每张图片一个协程，同一任务内的图片也能并发预处理 / 推理；
+    # 实际并发由 GLOBAL_PICTURE_SEM (在途图片) 和 INFER_SCHEDULER (推理槽位) 限制
+    items, tasks = [], []
     try:
+        while len(tasks) < len(picture_list):
+            item = await queue.get()
+            if item is None:
+                break
+            items.append(item)
+            tasks.append(asyncio.create_task(
+                handle_picture(item, current_prompt, num_predict, mission_type, dequeued, prompt_version)))
+            queue.task_done()
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # 任务被取消 / 出错时一并取消图片协程；还没开始运行就被取消的协程不会执行 finally，这里兜底归还
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+        for item in items:
+            item.discard()
+            item.release_slot()
+        raise
+    # 下载先完成的图片先处理，回调里仍按原始图片顺序排列
+    order = {pic.picId: i for i, pic in enumerate(picture_list)}
+    return sorted(results, key=lambda r: order.get(r.picId, len(order)))
+
+
+def release_pending(queue: asyncio.Queue):
+    """任务异常退出时，归还队列里尚未被 consumer 处理的图片名额"""
+    while not queue.empty():
+        item = queue.get_nowait()
+        if item is not None:
+            item.discard()
+            item.release_slot()
+
+
+async def process_mission(mission_data: str, transport) -> bool:
+    """处理一个任务并推送结果，成功返回 True (stream 模式下据此决定是否 ACK)"""
+    queue = None
+    consumer_task = None
+    try:
+        dequeued = time.time()
         data = json.loads(mission_data)
         mission = MissionRequest(**data)
 
-        logger.info(f"🚀 Processing: {mission.taskSerial}")
+        shard_tag = f" [shard {mission.shardIndex + 1}/{mission.shardCount}]" if mission.shardCount else ""
+        logger.info(f"🚀 Processing: {mission.taskSerial}{shard_tag}")
 
-        current_prompt = SYSTEM_INSTRUCTION.system_prompt_get(mission.type)
+        # 整个任务用同一版提示词，处理中途热更新不影响它
+        prompt = SYSTEM_INSTRUCTION.get(mission.type)
         queue = asyncio.Queue(maxsize=100)
 
         # 启动消费者
-        consumer_task = asyncio.create_task(consumer(queue, len(mission.pictureList), current_prompt))
+        consumer_task = asyncio.create_task(
+            consumer(queue, mission.pictureList, prompt.prompt, prompt.num_predict, mission.type, dequeued,
+                     prompt.version))
         # 启动生产者
         await producer(queue, mission.pictureList, mission.taskSerial)
 
         # 等待结果
         final_data = await consumer_task
+        consumer_task = None
 
         # 构造回调 Payload
         callback_payload = CallbackPayload(
             taskSerial=mission.taskSerial,
             type=mission.type,
-            data=final_data
+            data=final_data,
+            shardIndex=mission.shardIndex,
+            shardCount=mission.shardCount,
+            timeline=mission.timeline
         )
 
-        await redis_client.lpush(RESULT_QUEUE, callback_payload.json())
-        logger.info(f"✅ Done: {mission.taskSerial}")
+        await transport.push(RESULT_QUEUE, callback_payload.json(exclude_none=True))
+        logger.info(f"✅ Done: {mission.taskSerial} | scheduler: {INFER_SCHEDULER.stats()} | cache: {VERDICT_CACHE.stats()}")
+        WORKER_MISSIONS.inc(outcome="ok")
+        return True
 
     except Exception as e:
         logger.error(f"Mission Error: {e}")
+        WORKER_MISSIONS.inc(outcome="error")
+        WORKER_ERRORS.inc(stage="mission", reason=type(e).__name__)
+        return False
+    finally:
+        if consumer_task is not None:
+            consumer_task.cancel()
+        if queue is not None:
+            release_pending(queue)
+
+
+async def run_mission_slot(message, transport):
+    try:
+        # 处理期间定期续约，避免长任务被其他 worker 当成超时消息接管
+        async with transport.keepalive(message.queue, message):
+            ok = await process_mission(message.data, transport)
+        # 失败的任务不 ACK，空闲超时后由其他 worker 重试，超过次数进入死信
+        if ok:
+            await transport.ack(message.queue, message)
+    except Exception as e:
+        logger.error(f"Ack Error: {e}")
+    finally:
+        GLOBAL_MISSION_SEM.release()
 
 
 async def main():
     redis_client = redis.from_url(REDIS_URL, decode_responses=True)
-    logger.info("🔥 Worker Node Started...")
+    VERDICT_CACHE.bind_redis(redis_client)
+    transport = make_transport(redis_client, group="workers")
+    # 在各优先级通道间加权轮询取任务
+    lanes = LaneScheduler(redis_client, transport, TASK_QUEUE)
+    await start_metrics_server(WORKER_METRICS_PORT)
+    if OLLAMA_POOL is not None:
+        await OLLAMA_POOL.start()
+    if PROMPT_RELOAD_INTERVAL > 0:
+        task = asyncio.create_task(SYSTEM_INSTRUCTION.watch(PROMPT_RELOAD_INTERVAL))
+        BACKGROUND_TASKS.add(task)
+        task.add_done_callback(BACKGROUND_TASKS.discard)
+    logger.info(f"🔥 Worker Node Started... (missions in flight: {MAX_INFLIGHT_MISSIONS}, "
+                f"transport: {type(transport).__name__})")
+    inflight = set()
     while True:
+        # 先拿到任务名额再取任务，名额满时不从 Redis 取任务，留给其他 worker
+        await GLOBAL_MISSION_SEM.acquire()
         try:
-            result = await redis_client.brpop(TASK_QUEUE, timeout=0)
-            if result:
-                await process_mission(result[1], redis_client)
+            message = await lanes.pop()
         except Exception as e:
+            GLOBAL_MISSION_SEM.release()
             logger.error(f"Loop Error: {e}")
             await asyncio.sleep(5)
+            continue
+
+        # 不再等待当前任务结束：下一个任务的下载/预处理与当前任务的推理重叠
+        task = asyncio.create_task(run_mission_slot(message, transport))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import logging
+from typing import List
+
+from callback_outbox import OUTBOX_SCHEMA, OUTBOX_INDEX, OUTBOX_HOST_BACKFILL
+
+logger = logging.getLogger(__name__)
+
+MISSION_COLUMNS = ("task_serial, type, callbackurl, callback_status, status, created_at, updated_at, "
+                   "accepted_at, enqueued_at, result_received_at, callback_delivered_at")
+PICTURE_COLUMNS = ("id, task_serial, pic_id, download_url, result, reason, worker, dequeued_at, "
+                   "download_done_at, preprocess_done_at, inference_start_at, inference_end_at, prompt_version")
+
+# 各阶段时间戳 (epoch 秒)，见 timeline.py
+MISSION_STAGE_COLUMNS = ("accepted_at", "enqueued_at", "result_received_at", "callback_delivered_at")
+PICTURE_STAGE_COLUMNS = ("dequeued_at", "download_done_at", "preprocess_done_at", "inference_start_at", "inference_end_at")
+
+# 版本号记录在 PRAGMA user_version 里，只追加不修改；每个版本一个事务，失败整体回滚
+MIGRATIONS = [
+    (1, "base schema", [
+        """
+        CREATE TABLE IF NOT EXISTS missions (
+            task_serial TEXT PRIMARY KEY,
+            type TEXT,
+            callbackurl TEXT,
+            callback_status TEXT,
+            status TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pictures (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_serial TEXT,
+            pic_id TEXT,
+            download_url TEXT,
+            result BOOLEAN,
+            reason TEXT,
+            FOREIGN KEY(task_serial) REFERENCES missions(task_serial)
+        )
+        """,
+        OUTBOX_SCHEMA,
+        OUTBOX_INDEX,
+    ]),
+    (2, "pictures unique (task_serial, pic_id)", [
+        # 旧版本重复提交会追加重复图片行，保留最新的一行后再建唯一索引
+        "DELETE FROM pictures WHERE id NOT IN (SELECT MAX(id) FROM pictures GROUP BY task_serial, pic_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_pictures_task_pic ON pictures (task_serial, pic_id)",
+    ]),
+    (3, "retention index and archive tables", [
+        "CREATE INDEX IF NOT EXISTS idx_missions_status_updated ON missions (status, updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_task ON callback_outbox (task_serial)",
+        """
+        CREATE TABLE IF NOT EXISTS missions_archive (
+            task_serial TEXT PRIMARY KEY,
+            type TEXT,
+            callbackurl TEXT,
+            callback_status TEXT,
+            status TEXT,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pictures_archive (
+            id INTEGER PRIMARY KEY,
+            task_serial TEXT,
+            pic_id TEXT,
+            download_url TEXT,
+            result BOOLEAN,
+            reason TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pictures_archive_task ON pictures_archive (task_serial)",
+        "CREATE INDEX IF NOT EXISTS idx_missions_archive_archived ON missions_archive (archived_at)",
+    ]),
+    (4, "per-stage timeline columns", [
+        f"ALTER TABLE {table} ADD COLUMN {column} REAL"
+        for table in ("missions", "missions_archive") for column in MISSION_STAGE_COLUMNS
+    ] + [
+        f"ALTER TABLE {table} ADD COLUMN worker TEXT" for table in ("pictures", "pictures_archive")
+    ] + [
+        f"ALTER TABLE {table} ADD COLUMN {column} REAL"
+        for table in ("pictures", "pictures_archive") for column in PICTURE_STAGE_COLUMNS
+    ] + [
+        "CREATE INDEX IF NOT EXISTS idx_missions_accepted ON missions (accepted_at)",
+    ]),
+    (5, "prompt version per picture", [
+        f"ALTER TABLE {table} ADD COLUMN prompt_version TEXT" for table in ("pictures", "pictures_archive")
+    ]),
+    (6, "callback outbox host column", [
+        "ALTER TABLE callback_outbox ADD COLUMN host TEXT",
+        OUTBOX_HOST_BACKFILL,
+    ]),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def migrate(db) -> int:
+    """把数据库升级到最新版本，返回升级前的版本号。db 需以 isolation_level=None 打开"""
+    async with db.execute("PRAGMA user_version") as cursor:
+        current = (await cursor.fetchone())[0]
+    for version, name, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"🗄️ Migrating database to v{version}: {name}")
+        await db.execute("BEGIN")
+        try:
+            for sql in statements:
+                await db.execute(sql)
+            # PRAGMA 不支持参数绑定，version 来自上面的常量
+            await db.execute(f"PRAGMA user_version = {version}")
+            await db.execute("COMMIT")
+        except Exception:
+            await db.execute("ROLLBACK")
+            raise
+    return current
+
+
+async def archive_batch(db, retention_days: float, limit: int) -> int:
+    """
+    把 updated_at 早于 retention_days 天、已完成且没有待投递回调的任务连同图片挪进归档表，
+    返回本批挪走的任务数。在 DB_WRITER 的 job 里调用，每批只处理 limit 条，不长时间占住写连接。
+    """
+    cutoff = f"-{retention_days} days"
+    async with db.execute(
+        "SELECT task_serial FROM missions WHERE status = 'COMPLETED' AND updated_at < datetime('now', ?) "
+        "AND task_serial NOT IN (SELECT task_serial FROM callback_outbox WHERE status = 'PENDING') LIMIT ?",
+        (cutoff, limit)
+    ) as cursor:
+        serials: List[tuple] = await cursor.fetchall()
+    if not serials:
+        return 0
+
+    await db.executemany(
+        f"INSERT OR REPLACE INTO missions_archive ({MISSION_COLUMNS}) "
+        f"SELECT {MISSION_COLUMNS} FROM missions WHERE task_serial = ?", serials
+    )
+    await db.executemany(
+        f"INSERT OR REPLACE INTO pictures_archive ({PICTURE_COLUMNS}) "
+        f"SELECT {PICTURE_COLUMNS} FROM pictures WHERE task_serial = ?", serials
+    )
+    await db.executemany("DELETE FROM pictures WHERE task_serial = ?", serials)
+    # 已投递的回调记录随任务一起清掉，死信保留以便重放
+    await db.executemany("DELETE FROM callback_outbox WHERE task_serial = ? AND status = 'DELIVERED'", serials)
+    await db.executemany("DELETE FROM missions WHERE task_serial = ?", serials)
+    return len(serials)
+
+
+async def purge_archive_batch(db, archive_days: float, limit: int) -> int:
+    """删除归档超过 archive_days 天的任务及其图片，返回删除的任务数"""
+    async with db.execute(
+        "SELECT task_serial FROM missions_archive WHERE archived_at < datetime('now', ?) LIMIT ?",
+        (f"-{archive_days} days", limit)
+    ) as cursor:
+        serials = await cursor.fetchall()
+    if not serials:
+        return 0
+    await db.executemany("DELETE FROM pictures_archive WHERE task_serial = ?", serials)
+    await db.executemany("DELETE FROM missions_archive WHERE task_serial = ?", serials)
+    return len(serials)
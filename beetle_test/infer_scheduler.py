@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class InferTicket:
+    """一次推理占用的名额，调用方在推理失败时把 ok 置为 False"""
+
+    def __init__(self):
+        self.ok = True
+        self.cancelled = False
+        self.start = time.monotonic()
+
+
+class InferScheduler:
+    """
+    推理并发调度器，替代原来的 GLOBAL_OLLAMA_LOCK。
+    并发上限不超过后端的并行槽位 (OLLAMA_NUM_PARALLEL)，运行中按 AIMD 自适应：
+    - 延迟稳定且名额被用满时，加性增加 (每完成 limit 次推理 +1)
+    - 同一并发档位下延迟明显高于该档位的基线，或推理失败时，乘性减少 (limit * backoff)，每个延迟周期最多减一次
+    - 按档位估算吞吐 (Little 定律: 档位 / 延迟)：比低一档还差就退回一档；提升一档没换来吞吐就不再往上加
+    延迟随并发上升是正常的 (后端分时处理多个请求)，只要总吞吐还在涨就不算拥塞，所以不拿单并发时的延迟当基线。
+    档位数据超过 window 秒没有更新就视为过期，重新探测。被取消的推理不计入统计。
+    """
+
+    def __init__(self, max_parallel: int = 1, min_parallel: int = 1, adaptive: bool = True,
+                 latency_tolerance: float = 1.5, backoff: float = 0.7, window: float = 60.0):
+        self.max_parallel = max(1, max_parallel)
+        self.min_parallel = max(1, min(min_parallel, self.max_parallel))
+        self.adaptive = adaptive
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.window = window
+
+        # 自适应模式从最小并发起步，非自适应模式直接用满后端槽位
+        self.limit = float(self.min_parallel if adaptive else self.max_parallel)
+        self.inflight = 0
+        self.waiting = 0
+
+        self.avg_latency = None   # 延迟 EWMA
+        self.base_latency = None  # 基线延迟 (EWMA 的最小值，缓慢上浮以适应模型变化)
+        self._last_decrease = 0.0
+        self._done_times = deque()
+        self._level_latency = {}  # 每个并发档位的延迟 EWMA，用来估算该档位吞吐 (档位 / 延迟)
+        self._level_samples = {}
+        self._level_base = {}     # 每个并发档位的基线延迟 (该档位 EWMA 的最小值)
+        self._level_seen = {}     # 每个并发档位最近一次采样的时间
+        self._cond = asyncio.Condition()
+
+    # ---------- 状态 ----------
+
+    @property
+    def queue_depth(self) -> int:
+        """排队等待推理名额的请求数"""
+        return self.waiting
+
+    def throughput(self) -> float:
+        """最近 window 秒内每秒完成的推理数"""
+        now = time.monotonic()
+        while self._done_times and now - self._done_times[0] > self.window:
+            self._done_times.popleft()
+        if not self._done_times:
+            return 0.0
+        span = max(now - self._done_times[0], 1.0)
+        return len(self._done_times) / span
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "max_parallel": self.max_parallel,
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "avg_latency": round(self.avg_latency or 0.0, 3),
+            "base_latency": round(self.base_latency or 0.0, 3),
+            "throughput": round(self.throughput(), 3),
+        }
+
+    # ---------- 名额 ----------
+
+    async def acquire(self) -> InferTicket:
+        async with self._cond:
+            self.waiting += 1
+            try:
+                await self._cond.wait_for(lambda: self.inflight < int(self.limit))
+            finally:
+                self.waiting -= 1
+            self.inflight += 1
+        return InferTicket()
+
+    async def release(self, ticket: InferTicket):
+        async with self._cond:
+            saturated = self.inflight >= int(self.limit) or self.waiting > 0
+            self.inflight -= 1
+            if not ticket.cancelled:
+                # 任务被取消不代表后端拥塞，不参与自适应
+                self._observe(time.monotonic() - ticket.start, ticket.ok, saturated)
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        ticket = await self.acquire()
+        try:
+            yield ticket
+        except asyncio.CancelledError:
+            ticket.cancelled = True
+            raise
+        except BaseException:
+            ticket.ok = False
+            raise
+        finally:
+            await asyncio.shield(self.release(ticket))
+
+    # ---------- AIMD ----------
+
+    def _observe(self, latency: float, ok: bool, saturated: bool):
+        now = time.monotonic()
+        self._done_times.append(now)
+
+        if ok:
+            self.avg_latency = latency if self.avg_latency is None else 0.8 * self.avg_latency + 0.2 * latency
+            if self.base_latency is None or self.avg_latency < self.base_latency:
+                self.base_latency = self.avg_latency
+            else:
+                self.base_latency *= 1.0001
+
+        if not self.adaptive:
+            return
+
+        level = int(self.limit)
+        if ok and saturated:
+            self._record_level(level, latency, now)
+
+        if not ok:
+            self._decrease(now, "error")
+            return
+
+        base = self._level_base.get(level)
+        if base is not None and self._level_latency[level] > base * self.latency_tolerance:
+            # 同样的并发下延迟变高：后端被别的负载占用或开始排队
+            self._decrease(now, "congestion")
+            return
+
+        tput = self._level_throughput(level, now)
+        lower_tput = self._level_throughput(level - 1, now)
+        if tput is not None and lower_tput is not None and tput < lower_tput * 0.95:
+            # 这一档的吞吐不如低一档，退回去
+            self._set_limit(max(self.min_parallel, level - 1.0), "throughput")
+            return
+
+        if saturated and self.limit < self.max_parallel:
+            if tput is None:
+                return  # 当前档位样本还不够，先别往上加
+            if lower_tput is not None and tput < lower_tput * 1.05:
+                return  # 上一次加并发没换来吞吐提升，保持当前档位
+            upper_tput = self._level_throughput(level + 1, now)
+            if upper_tput is not None and upper_tput < tput * 1.05:
+                return  # 最近试过高一档，吞吐没有变好
+            self._set_limit(min(self.max_parallel, self.limit + 1.0 / self.limit), "increase")
+
+    def _record_level(self, level: int, latency: float, now: float):
+        if now - self._level_seen.get(level, now) > self.window:
+            # 档位数据过期，重新采样
+            for table in (self._level_latency, self._level_samples, self._level_base):
+                table.pop(level, None)
+        self._level_seen[level] = now
+        prev = self._level_latency.get(level)
+        ewma = latency if prev is None else 0.8 * prev + 0.2 * latency
+        self._level_latency[level] = ewma
+        samples = self._level_samples[level] = self._level_samples.get(level, 0) + 1
+        # 刚升档时的前几个请求大部分时间跑在低一档，攒够 level 个样本后再定基线
+        if samples >= level:
+            base = self._level_base.get(level)
+            self._level_base[level] = ewma if base is None or ewma < base else base * 1.0001
+
+    def _level_throughput(self, level: int, now: float):
+        """该档位的估算吞吐 (档位 / 延迟)，样本不足或已过期时返回 None"""
+        if level < 1 or self._level_samples.get(level, 0) < 2 * level or now - self._level_seen[level] > self.window:
+            return None
+        return level / self._level_latency[level]
+
+    def _decrease(self, now: float, reason: str):
+        # 一个延迟周期内只减一次，避免一批慢请求把并发打到底
+        if now - self._last_decrease > (self.avg_latency or 1.0):
+            self._set_limit(max(self.min_parallel, self.limit * self.backoff), reason)
+            self._last_decrease = now
+
+    def _set_limit(self, new_limit: float, reason: str):
+        old = int(self.limit)
+        self.limit = new_limit
+        if int(new_limit) != old:
+            logger.info(f"⚖️ Infer limit {old} -> {int(new_limit)} ({reason}) | {self.stats()}")
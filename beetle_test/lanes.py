@@ -0,0 +1,190 @@
+import os
+import time
+import zlib
+import logging
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+
+
+def parse_weights(spec: str, default: Dict[str, float] = None) -> Dict[str, float]:
+    """"high=8,normal=3,low=1" -> {"high": 8.0, ...}"""
+    weights = dict(default or {})
+    for part in (spec or "").split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            weights[name.strip()] = float(value)
+    return weights
+
+
+# 优先级权重决定各通道被选中的比例，低优先级也总能分到份额，不会饿死
+PRIORITY_WEIGHTS = parse_weights(os.getenv("LANE_PRIORITY_WEIGHTS", ""), {"high": 8, "normal": 3, "low": 1})
+# 按任务类型额外加权，如 LANE_TYPE_WEIGHTS=is_spill=2，未配置的类型为 1
+TYPE_WEIGHTS = parse_weights(os.getenv("LANE_TYPE_WEIGHTS", ""))
+# 调用方按回调主机哈希进有限个桶，通道数不随客户数增长；0 表示不按调用方分通道
+CALLER_BUCKETS = int(os.getenv("LANE_CALLER_BUCKETS", "4"))
+# 超过这么久没有新任务、且已经清空的通道从登记表里移除 (秒)
+LANE_IDLE_TTL = float(os.getenv("LANE_IDLE_TTL", "600"))
+
+
+def normalize_priority(priority: Optional[str]) -> str:
+    return priority if priority in PRIORITIES else DEFAULT_PRIORITY
+
+
+def caller_of(callback_url: str, buckets: int = CALLER_BUCKETS) -> str:
+    """以回调地址的主机作为调用方标识，哈希进 buckets 个桶 (c0..c{n-1})；buckets <= 0 时不区分调用方"""
+    if buckets <= 0:
+        return "all"
+    host = urlsplit(callback_url).netloc or "unknown"
+    return f"c{zlib.crc32(host.encode('utf-8')) % buckets}"
+
+
+def parse_meta(meta: str):
+    """登记表的值 "priority type pushed_at" -> (priority, type, pushed_at)；旧格式没有时间戳，当作 0"""
+    parts = meta.split(" ")
+    priority = parts[0]
+    mission_type = parts[1] if len(parts) > 1 else ""
+    try:
+        pushed_at = float(parts[2]) if len(parts) > 2 else 0.0
+    except ValueError:
+        pushed_at = 0.0
+    return priority, mission_type, pushed_at
+
+
+def lane_weight(priority: str, mission_type: str) -> float:
+    return PRIORITY_WEIGHTS.get(priority, 1.0) * TYPE_WEIGHTS.get(mission_type, 1.0)
+
+
+class LaneRouter:
+    """
+    server 端：按 (优先级, 任务类型, 调用方桶) 把任务放进不同的通道队列 queue:missions:{priority}:{type}:{caller}，
+    通道登记在 Redis hash lanes:queue:missions 里 (通道 -> "priority type pushed_at")，供 worker 发现。
+    pushed_at 至少每 idle_ttl/2 刷新一次，worker 只清理超过 idle_ttl 没有刷新且已清空的通道。
+    """
+
+    def __init__(self, redis_client, transport, base_queue: str, idle_ttl: float = LANE_IDLE_TTL):
+        self.redis_client = redis_client
+        self.transport = transport
+        self.base_queue = base_queue
+        self.registry = f"lanes:{base_queue}"
+        self.idle_ttl = idle_ttl
+        self._registered_at: Dict[str, float] = {}
+
+    def lane(self, priority: Optional[str], mission_type: str, callback_url: str) -> str:
+        return f"{self.base_queue}:{normalize_priority(priority)}:{mission_type}:{caller_of(callback_url)}"
+
+    async def push_many(self, lane: str, datas: List[str], priority: Optional[str], mission_type: str):
+        now = time.time()
+        # 先登记再入队：通道被 worker 清理后，下一次入队会重新登记
+        if now - self._registered_at.get(lane, 0.0) >= self.idle_ttl / 2:
+            await self.redis_client.hset(self.registry, lane, f"{normalize_priority(priority)} {mission_type} {now:.0f}")
+            self._registered_at[lane] = now
+        await self.transport.push_many(lane, datas)
+
+    async def lanes(self) -> List[str]:
+        return list(await self.redis_client.hkeys(self.registry))
+
+    async def backlog(self) -> int:
+        """所有通道 (含旧的单一队列) 的积压之和"""
+        total = await self.transport.backlog(self.base_queue)
+        for lane in await self.lanes():
+            total += await self.transport.backlog(lane)
+        return total
+
+
+class LaneScheduler:
+    """
+    worker 端：平滑加权轮询 (smooth weighted round-robin) 在各通道间挑下一个任务。
+    - 通道权重 = 优先级权重 x 类型权重，同一 (优先级, 类型) 下不同调用方权重相同，大客户的批量任务不会挤占小客户
+    - 选中的通道为空时跳过并清零它的累计额度，空通道不会攒额度后突发
+    - 所有通道都空时阻塞在全部通道上 (BRPOP / XREADGROUP 多 key)，按优先级顺序唤醒
+    - 超过 idle_ttl 没有新任务且已清空的通道从登记表删除 (WATCH 登记表，期间 server 重新登记则放弃)，
+      每次 pop 的轮询开销只和活跃通道数有关
+    旧的单一队列 base_queue 作为 normal 通道一并消费，升级期间残留的任务不会丢。
+    """
+
+    def __init__(self, redis_client, transport, base_queue: str, refresh_interval: float = 2.0,
+                 idle_block: float = 1.0, idle_ttl: float = LANE_IDLE_TTL):
+        self.redis_client = redis_client
+        self.transport = transport
+        self.base_queue = base_queue
+        self.registry = f"lanes:{base_queue}"
+        self.refresh_interval = refresh_interval
+        self.idle_block = idle_block
+        self.idle_ttl = idle_ttl
+
+        self._weights: Dict[str, float] = {base_queue: lane_weight(DEFAULT_PRIORITY, "")}
+        self._current: Dict[str, float] = {}
+        self._refreshed_at = 0.0
+        self.stats: Dict[str, int] = {}
+
+    async def _refresh(self):
+        now = time.monotonic()
+        if now - self._refreshed_at < self.refresh_interval:
+            return
+        self._refreshed_at = now
+        registry = await self.redis_client.hgetall(self.registry)
+        weights = {self.base_queue: lane_weight(DEFAULT_PRIORITY, "")}
+        wall = time.time()
+        for lane, meta in registry.items():
+            priority, mission_type, pushed_at = parse_meta(meta)
+            if wall - pushed_at > self.idle_ttl and await self._prune(lane, meta):
+                continue
+            weights[lane] = lane_weight(priority, mission_type)
+        self._weights = weights
+        for lane in list(self._current):
+            if lane not in weights:
+                del self._current[lane]
+
+    async def _prune(self, lane: str, meta: str) -> bool:
+        """通道已清空且登记值没变时删除登记，返回是否删除"""
+        try:
+            async with self.redis_client.pipeline(transaction=True) as pipe:
+                await pipe.watch(self.registry)
+                if await pipe.hget(self.registry, lane) != meta or await self.transport.backlog(lane) > 0:
+                    return False
+                pipe.multi()
+                pipe.hdel(self.registry, lane)
+                await pipe.execute()
+        except Exception as e:
+            # WatchError: server 刚好登记了通道，下一轮再看
+            logger.debug(f"Lane prune skipped for {lane}: {e}")
+            return False
+        logger.info(f"🧹 Pruned idle lane {lane}")
+        return True
+
+    def _pick(self, candidates: List[str]) -> str:
+        total = 0.0
+        best = None
+        for lane in candidates:
+            weight = self._weights[lane]
+            self._current[lane] = self._current.get(lane, 0.0) + weight
+            total += weight
+            if best is None or self._current[lane] > self._current[best]:
+                best = lane
+        self._current[best] -= total
+        return best
+
+    async def pop(self):
+        while True:
+            await self._refresh()
+            candidates = list(self._weights)
+            while candidates:
+                lane = self._pick(candidates)
+                message = await self.transport.pop_nowait(lane)
+                if message is not None:
+                    self.stats[lane] = self.stats.get(lane, 0) + 1
+                    return message
+                candidates.remove(lane)
+                self._current[lane] = 0.0
+
+            # 全部为空：按权重从高到低阻塞等待，哪个通道先来任务就先处理
+            ordered = sorted(self._weights, key=self._weights.get, reverse=True)
+            message = await self.transport.pop_any(ordered, self.idle_block)
+            if message is not None:
+                self.stats[message.queue] = self.stats.get(message.queue, 0) + 1
+                return message
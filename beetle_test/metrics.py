@@ -0,0 +1,191 @@
+import time
+import asyncio
+import inspect
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 默认延迟分桶 (秒)，覆盖从毫秒级下载到分钟级推理
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """
+    极简的 Prometheus 文本格式注册表，不依赖 prometheus_client。
+    指标在模块导入时注册，server 和 worker 各自暴露自己导入了的那部分。
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric"):
+        if metric.name in self._metrics:
+            raise ValueError(f"Duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = await metric.collect()
+            except Exception as e:
+                logger.warning(f"Metric {metric.name} collect failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_fmt(value)}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    async def collect(self):
+        return [(self.name, _labels(self.labelnames, key), value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 registry: Registry = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values: Dict[Tuple, list] = {}  # key -> [各桶计数..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[idx] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    async def collect(self):
+        samples = []
+        for key, state in self._values.items():
+            cumulative = 0
+            for idx, bound in enumerate(self.buckets):
+                cumulative += state[idx]
+                samples.append((f"{self.name}_bucket", _labels(self.labelnames, key, f'le="{_fmt(bound)}"'), cumulative))
+            samples.append((f"{self.name}_sum", _labels(self.labelnames, key), state[-2]))
+            samples.append((f"{self.name}_count", _labels(self.labelnames, key), state[-1]))
+        return samples
+
+
+class Collector(Metric):
+    """抓取时才计算的指标 (队列深度、缓存计数等)；fn 返回 {标签值元组: 数值}，可以是协程函数"""
+
+    def __init__(self, name: str, help: str, kind: str, fn: Callable, labelnames: Sequence[str] = (),
+                 registry: Registry = REGISTRY):
+        super().__init__(name, help, labelnames, registry)
+        self.kind = kind
+        self.fn = fn
+
+    async def collect(self):
+        values = self.fn()
+        if inspect.isawaitable(values):
+            values = await values
+        return [(self.name, _labels(self.labelnames, key), value) for key, value in values.items()]
+
+
+# --- 没有 HTTP 框架的进程 (worker) 用的最小 /metrics 服务 ---
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, registry: Registry):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split(b" ")[1] if request_line.count(b" ") >= 2 else b""
+        if path.split(b"?")[0] == b"/metrics":
+            body = (await registry.render()).encode()
+            status = b"200 OK"
+        else:
+            body = b"not found\n"
+            status = b"404 Not Found"
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int, host: str = "0.0.0.0", registry: Registry = REGISTRY
+                               ) -> Optional[asyncio.AbstractServer]:
+    if port <= 0:
+        return None
+    try:
+        server = await asyncio.start_server(lambda r, w: _handle(r, w, registry), host, port)
+    except OSError as e:
+        # 同一台机器上跑多个 worker 时端口会冲突，指标不可用不应影响 worker 启动
+        logger.warning(f"⚠️ Metrics server not started on {host}:{port}: {e}")
+        return None
+    logger.info(f"📈 Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,357 @@
+import re
+import time
+import json
+import asyncio
+import logging
+from typing import Optional, Tuple
+
+import httpx
+
+from metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+# 微调模型不需要太复杂的 Prompt，简单的指令即可触发它的能力
+USER_TASK = "请分析图像。请先在<think>标签中思考，然后严格按格式回答：\n理由：[理由]\n结果：[TRUE或FALSE]"
+
+# JSON 输出模式：用 schema 约束 Ollama 只输出 {"reason": ..., "result": bool}
+USER_TASK_JSON = "请分析图像，只输出 JSON：{\"reason\": \"<20字以内的理由>\", \"result\": true 或 false}"
+
+VERDICT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reason": {"type": "string"},
+        "result": {"type": "boolean"}
+    },
+    "required": ["reason", "result"]
+}
+
+INFER_SECONDS = Histogram("beetle_inference_seconds", "Ollama inference latency", ["mode", "outcome"])
+# 流式推理：首 token 耗时 / 解析出结论的耗时 (提前断开时明显短于完整生成)
+INFER_TTFT_SECONDS = Histogram("beetle_inference_ttft_seconds", "Streaming time to first token")
+INFER_TTV_SECONDS = Histogram("beetle_inference_ttv_seconds", "Streaming time to parsed verdict", ["early_stop"])
+INFER_TOKENS = Counter("beetle_inference_tokens_total", "Tokens generated by Ollama", ["mode"])
+INFER_TOKENS_PER_SECOND = Histogram("beetle_inference_tokens_per_second", "Ollama generation speed",
+                                    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300))
+INFER_EARLY_STOPS = Counter("beetle_inference_early_stops_total", "Streams closed as soon as the verdict was parsed")
+
+# 失败理由前缀 -> 指标里的 outcome 标签
+OUTCOME_PREFIXES = (
+    ("HTTP Error", "http_error"),
+    ("Connection Refused", "connection_refused"),
+    ("Timeout", "timeout"),
+    ("Exception", "exception"),
+    ("Parse Error", "parse_error"),
+    ("Image Error", "image_error"),
+)
+
+
+def outcome_of(reason: str) -> str:
+    for prefix, outcome in OUTCOME_PREFIXES:
+        if reason.startswith(prefix):
+            return outcome
+    return "ok"
+
+
+DEFAULT_OPTIONS = {
+    "temperature": 0.1,  # 稍微给一点温度
+    "num_ctx": 8192,     # 【关键】防止长思维链被截断
+    "top_p": 0.9
+}
+
+
+def build_payload(model: str, image_base64: str, current_prompt: str, stream: bool = False,
+                  output_format: str = "text", num_predict: Optional[int] = None) -> dict:
+    payload = {
+        "model": model,  # 确保这里是你 ollama list 里的名字
+        "system": current_prompt,   # 传入 yaml 里的提示词
+        "prompt": USER_TASK,
+        "images": [image_base64],
+        "stream": stream,
+        "options": dict(DEFAULT_OPTIONS)
+    }
+    if output_format == "json":
+        payload["prompt"] = USER_TASK_JSON
+        payload["format"] = VERDICT_SCHEMA
+        if num_predict:
+            payload["options"]["num_predict"] = num_predict
+    return payload
+
+
+def parse_verdict(raw_text: str) -> Tuple[bool, str]:
+    # --- 核心解析逻辑 Start ---
+
+    # 1. 移除 <think> 标签及其内容
+    # 这是为了防止模型在思考过程中提到 "TRUE" (比如 "Is this TRUE? No.") 导致误判
+    clean_text = re.sub(r'<think>.*?(?:</think>|$)', '', raw_text, flags=re.DOTALL).strip()
+
+    # 2. 提取结果 (优先匹配标准格式)
+    result_bool = False
+    # 匹配 "结果：TRUE" 或 "Result: TRUE"
+    if re.search(r'(结果|Result)[:：]\s*TRUE', clean_text, re.IGNORECASE):
+        result_bool = True
+    elif re.search(r'(结果|Result)[:：]\s*FALSE', clean_text, re.IGNORECASE):
+        result_bool = False
+    else:
+        # 兜底匹配：只在清洗后的文本中找单词
+        if "TRUE" in clean_text.upper():
+            result_bool = True
+        elif "FALSE" in clean_text.upper():
+            result_bool = False
+        else:
+            logger.warning(f"⚠️ 解析失败: {clean_text[:50]}...")
+            return False, "Parse Error"
+
+    # 3. 提取理由
+    clean_reason = "Model provided no details."
+    # 尝试提取 "理由：" 后面的内容
+    reason_match = re.search(r'(理由|Reason)[:：](.*?)(?=(结果|Result)|$)', clean_text, re.DOTALL | re.IGNORECASE)
+    if reason_match:
+        clean_reason = reason_match.group(2).strip()
+    else:
+        # 如果没找到标准理由格式，就用去掉结果后的剩余文本
+        clean_reason = re.sub(r'(结果|Result)[:：]\s*(TRUE|FALSE)', '', clean_text, flags=re.IGNORECASE).strip()
+
+    # --- 核心解析逻辑 End ---
+
+    return result_bool, clean_reason
+
+
+def parse_json_verdict(raw_text: str) -> Tuple[bool, str]:
+    """JSON 输出模式的解析；被 num_predict 截断等导致 JSON 不完整时退回文本解析"""
+    clean_text = re.sub(r'<think>.*?(?:</think>|$)', '', raw_text, flags=re.DOTALL).strip()
+    try:
+        data = json.loads(clean_text)
+        if isinstance(data, dict) and isinstance(data.get("result"), bool):
+            return data["result"], str(data.get("reason", "")).strip() or "Model provided no details."
+    except ValueError:
+        pass
+    logger.warning(f"⚠️ JSON 解析失败，回退文本解析: {clean_text[:50]}...")
+    return parse_verdict(raw_text)
+
+
+def verdict_ready(raw_text: str) -> bool:
+    """流式生成时判断是否已经输出了完整的 理由 + 结果，可以提前断开"""
+    # 思考没结束时 clean_text 为空，不会被思考过程里的 TRUE/FALSE 误触发
+    clean_text = re.sub(r'<think>.*?(?:</think>|$)', '', raw_text, flags=re.DOTALL)
+    result_match = re.search(r'(结果|Result)[:：]\s*(TRUE|FALSE)\b', clean_text, re.IGNORECASE)
+    if not result_match:
+        return False
+    reason_match = re.search(r'(理由|Reason)[:：](.*?)(结果|Result|\n)', clean_text, re.DOTALL | re.IGNORECASE)
+    return bool(reason_match and reason_match.group(2).strip())
+
+
+class OllamaClient:
+    """
+    Ollama /api/generate 客户端，async 与 sync 两套调用共用同一套 payload 与解析逻辑。
+    - generate(): 原生 async，共享 httpx.AsyncClient 连接池 (keep-alive)，支持单次超时与取消
+    - generate_stream(): 流式生成，解析到完整的 理由/结果 后立即断开，不再为多余 token 占用 GPU
+    - generate_sync(): 同步调用，共享 httpx.Client 连接池，供 run_test.py 等脚本使用
+    output_format: "text" 为 理由/结果 自由文本；"json" 为 schema 约束的 JSON，配合 num_predict 限制生成长度
+    pool: 多后端时的 OllamaPool，每次请求按它的选路结果发往某台后端，失败时换台；为 None 时只用 url
+    """
+
+    def __init__(self, url: str, model: str, max_connections: int = 8, timeout: float = 120.0, stream: bool = False,
+                 output_format: str = "text", pool=None):
+        self.url = url
+        self.pool = pool
+        self.model = model
+        self.timeout = timeout
+        self.stream = stream
+        self.output_format = output_format
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._sync_client: Optional[httpx.Client] = None
+
+    def _timeout(self, timeout: Optional[float]) -> httpx.Timeout:
+        # 连接阶段给短超时，读超时跟随推理耗时
+        return httpx.Timeout(timeout or self.timeout, connect=10.0)
+
+    def get_async_client(self) -> httpx.AsyncClient:
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(limits=self.limits, timeout=self._timeout(None))
+        return self._async_client
+
+    def get_sync_client(self) -> httpx.Client:
+        if self._sync_client is None or self._sync_client.is_closed:
+            self._sync_client = httpx.Client(limits=self.limits, timeout=self._timeout(None))
+        return self._sync_client
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+    def _handle_response(self, response: httpx.Response) -> Tuple[bool, str]:
+        if response.status_code != 200:
+            logger.critical(f"❌ OLLAMA API ERROR: {response.status_code}")
+            return False, f"HTTP Error {response.status_code}"
+
+        data = response.json()
+        if data.get("eval_count") and data.get("eval_duration"):
+            INFER_TOKENS.inc(data["eval_count"], mode="full")
+            INFER_TOKENS_PER_SECOND.observe(data["eval_count"] / (data["eval_duration"] / 1e9))
+        raw_text = data.get("response", "").strip()
+        # 记录原始输出以便调试
+        logger.info(f"🤖 Raw Output: {raw_text[:200]}...")
+        if self.output_format == "json":
+            return parse_json_verdict(raw_text)
+        return parse_verdict(raw_text)
+
+    async def generate(self, image_base64: str, current_prompt: str, timeout: Optional[float] = None,
+                       num_predict: Optional[int] = None, affinity: Optional[str] = None) -> Tuple[bool, str]:
+        """affinity: 亲和键 (任务类型)，多后端且开启亲和时同一个键尽量打到同一台"""
+        start = time.perf_counter()
+        if self.pool is None:
+            result_bool, reason = await self._generate(image_base64, current_prompt, timeout, num_predict)
+        else:
+            result_bool, reason = await self._generate_routed(image_base64, current_prompt, timeout, num_predict, affinity)
+        mode = "stream" if self.stream and self.output_format != "json" else self.output_format
+        INFER_SECONDS.observe(time.perf_counter() - start, mode=mode, outcome=outcome_of(reason))
+        return result_bool, reason
+
+    async def _generate_routed(self, image_base64: str, current_prompt: str, timeout: Optional[float],
+                               num_predict: Optional[int], affinity: Optional[str]) -> Tuple[bool, str]:
+        result = (False, "Connection Refused: no Ollama backend")
+        for backend in self.pool.route(affinity):
+            with self.pool.track(backend):
+                result = await self._generate(image_base64, current_prompt, timeout, num_predict, backend.generate_url)
+            if not self.pool.should_failover(result[1]):
+                return result
+            self.pool.mark_failed(backend, result[1])
+        return result
+
+    async def _generate(self, image_base64: str, current_prompt: str, timeout: Optional[float],
+                        num_predict: Optional[int], url: Optional[str] = None) -> Tuple[bool, str]:
+        if not image_base64:
+            logger.error("❌ ABORTING: Image data is empty!")
+            return False, "Image Error: No base64 data"
+
+        # JSON 模式输出很短且由 schema 收尾，不需要流式提前断开
+        if self.stream and self.output_format != "json":
+            result_bool, reason, meta = await self.generate_stream(image_base64, current_prompt, timeout, url)
+            if meta["ttft"] is not None:
+                INFER_TTFT_SECONDS.observe(meta["ttft"])
+            if meta["ttv"] is not None:
+                INFER_TTV_SECONDS.observe(meta["ttv"], early_stop=str(meta["early_stop"]).lower())
+            return result_bool, reason
+
+        payload = build_payload(self.model, image_base64, current_prompt,
+                                output_format=self.output_format, num_predict=num_predict)
+        try:
+            response = await self.get_async_client().post(url or self.url, json=payload, timeout=self._timeout(timeout))
+            return self._handle_response(response)
+        except asyncio.CancelledError:
+            # 取消时 httpx 会关闭这条连接，Ollama 侧随之中止生成
+            logger.warning("⚠️ Inference cancelled")
+            raise
+        except httpx.ConnectError:
+            logger.critical(f"❌ CONNECTION DEAD: Check Ollama.")
+            return False, "Connection Refused"
+        except httpx.TimeoutException:
+            logger.error(f"❌ TIMEOUT: Ollama took longer than {timeout or self.timeout}s")
+            return False, "Timeout: Model too slow"
+        except Exception as e:
+            logger.error(f"❌ CRASH: {str(e)}")
+            return False, f"Exception: {str(e)}"
+
+    async def generate_stream(self, image_base64: str, current_prompt: str,
+                              timeout: Optional[float] = None, url: Optional[str] = None) -> Tuple[bool, str, dict]:
+        """
+        流式调用 /api/generate，逐 token 累积并检测结论。
+        返回 (结果, 理由, meta)，meta 包含 ttft (首 token 耗时)、ttv (出结论耗时)、tokens、early_stop。
+        """
+        meta = {"ttft": None, "ttv": None, "tokens": 0, "early_stop": False}
+        if not image_base64:
+            logger.error("❌ ABORTING: Image data is empty!")
+            return False, "Image Error: No base64 data", meta
+
+        payload = build_payload(self.model, image_base64, current_prompt, stream=True)
+        start = time.monotonic()
+        chunks = []
+        try:
+            async with self.get_async_client().stream("POST", url or self.url, json=payload,
+                                                      timeout=self._timeout(timeout)) as response:
+                if response.status_code != 200:
+                    logger.critical(f"❌ OLLAMA API ERROR: {response.status_code}")
+                    return False, f"HTTP Error {response.status_code}", meta
+
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    piece = chunk.get("response", "")
+                    if piece:
+                        if meta["ttft"] is None:
+                            meta["ttft"] = time.monotonic() - start
+                        meta["tokens"] += 1
+                        chunks.append(piece)
+                        # 只在可能补全结论的 token 上检查，避免每个 token 都跑一遍正则
+                        if piece.strip() and verdict_ready("".join(chunks)):
+                            meta["early_stop"] = not chunk.get("done", False)
+                            break
+                    if chunk.get("done"):
+                        break
+            # 离开 async with 即关闭连接，Ollama 侧检测到断开会停止生成
+        except asyncio.CancelledError:
+            logger.warning("⚠️ Inference cancelled")
+            raise
+        except httpx.ConnectError:
+            logger.critical(f"❌ CONNECTION DEAD: Check Ollama.")
+            return False, "Connection Refused", meta
+        except httpx.TimeoutException:
+            logger.error(f"❌ TIMEOUT: Ollama took longer than {timeout or self.timeout}s")
+            return False, "Timeout: Model too slow", meta
+        except Exception as e:
+            logger.error(f"❌ CRASH: {str(e)}")
+            return False, f"Exception: {str(e)}", meta
+
+        meta["ttv"] = time.monotonic() - start
+        INFER_TOKENS.inc(meta["tokens"], mode="stream")
+        if meta["early_stop"]:
+            INFER_EARLY_STOPS.inc()
+        if meta["tokens"] > 1 and meta["ttft"] is not None and meta["ttv"] > meta["ttft"]:
+            INFER_TOKENS_PER_SECOND.observe((meta["tokens"] - 1) / (meta["ttv"] - meta["ttft"]))
+        raw_text = "".join(chunks).strip()
+        logger.info(f"🤖 Raw Output: {raw_text[:200]}...")
+        logger.info(f"⏱️ Verdict in {meta['ttv']:.2f}s (first token {meta['ttft'] or 0:.2f}s, "
+                    f"{meta['tokens']} tokens, early_stop={meta['early_stop']})")
+        result_bool, reason = parse_verdict(raw_text)
+        return result_bool, reason, meta
+
+    def generate_sync(self, image_base64: str, current_prompt: str, timeout: Optional[float] = None,
+                      num_predict: Optional[int] = None) -> Tuple[bool, str]:
+        if self.pool is None:
+            return self._generate_sync(image_base64, current_prompt, timeout, num_predict)
+        result = (False, "Connection Refused: no Ollama backend")
+        for backend in self.pool.route():
+            with self.pool.track(backend):
+                result = self._generate_sync(image_base64, current_prompt, timeout, num_predict, backend.generate_url)
+            if not self.pool.should_failover(result[1]):
+                return result
+            self.pool.mark_failed(backend, result[1])
+        return result
+
+    def _generate_sync(self, image_base64: str, current_prompt: str, timeout: Optional[float] = None,
+                       num_predict: Optional[int] = None, url: Optional[str] = None) -> Tuple[bool, str]:
+        if not image_base64:
+            logger.error("❌ ABORTING: Image data is empty!")
+            return False, "Image Error: No base64 data"
+
+        payload = build_payload(self.model, image_base64, current_prompt,
+                                output_format=self.output_format, num_predict=num_predict)
+        try:
+            response = self.get_sync_client().post(url or self.url, json=payload, timeout=self._timeout(timeout))
+            return self._handle_response(response)
+        except httpx.ConnectError:
+            logger.critical(f"❌ CONNECTION DEAD: Check Ollama.")
+            return False, "Connection Refused"
+        except httpx.TimeoutException:
+            logger.error(f"❌ TIMEOUT: Ollama took longer than {timeout or self.timeout}s")
+            return False, "Timeout: Model too slow"
+        except Exception as e:
+            logger.error(f"❌ CRASH: {str(e)}")
+            return False, f"Exception: {str(e)}"
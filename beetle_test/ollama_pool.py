@@ -0,0 +1,245 @@
+import time
+import asyncio
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Iterable, List, Optional
+
+import httpx
+
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+OLLAMA_FAILOVERS = Counter("beetle_ollama_failovers_total", "Requests retried on another Ollama backend", ["backend"])
+
+# 这些失败说明是后端本身不可用，换一台重试；超时可能只是模型慢，重试会加倍负载，不换
+FAILOVER_PREFIXES = ("Connection Refused", "HTTP Error 5", "Exception")
+
+
+def base_url(url: str) -> str:
+    """http://gpu1:11434/api/generate -> http://gpu1:11434"""
+    url = url.strip().rstrip("/")
+    return url[:-len("/api/generate")] if url.endswith("/api/generate") else url
+
+
+class OllamaBackend:
+    def __init__(self, url: str):
+        self.url = base_url(url)
+        self.generate_url = f"{self.url}/api/generate"
+        # 没检查过之前当作可用，同步脚本里不跑健康检查也能直接用
+        self.healthy = True
+        self.model_loaded = False
+        self.outstanding = 0
+        self.failures = 0
+        self.last_error: Optional[str] = None
+        self.checked_at = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "model_loaded": self.model_loaded,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+class OllamaPool:
+    """
+    多个 Ollama 后端的选路：
+    - 后台定期 GET /api/ps：能响应即健康，列表里有本模型即已加载 (不用冷启动加载权重)
+    - 默认按在途请求数最少选 (least outstanding)，同等负载优先已加载模型的后端
+    - affinity=True 时同一任务类型固定打到同一台 (rendezvous hash)，长系统提示词留在那台的 prompt cache 里；
+      那台比最空闲的后端多出 affinity_slack 个在途请求时临时溢出到最空闲的，避免热点类型压垮一台
+    - 请求失败 (连接失败 / 5xx) 时标记不健康并按顺序换下一台，健康检查恢复后重新参与选路
+    """
+
+    def __init__(self, urls: Iterable[str], model: str, check_interval: float = 10.0, affinity: bool = False,
+                 affinity_slack: int = 1, check_timeout: float = 3.0):
+        self.backends = [OllamaBackend(url) for url in urls if url.strip()]
+        if not self.backends:
+            raise ValueError("OllamaPool needs at least one backend URL")
+        self.model = model
+        self.check_interval = check_interval
+        self.affinity = affinity
+        self.affinity_slack = max(1, affinity_slack)
+        self.check_timeout = check_timeout
+        self._task: Optional[asyncio.Task] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._rr = 0
+
+    def __len__(self):
+        return len(self.backends)
+
+    # ---------- 选路 ----------
+
+    def _affinity_rank(self, key: str, backend: OllamaBackend) -> str:
+        return hashlib.sha1(f"{key}|{backend.url}".encode("utf-8")).hexdigest()
+
+    def route(self, affinity_key: Optional[str] = None) -> List[OllamaBackend]:
+        """返回本次请求依次尝试的后端；全部不健康时仍按负载返回全部，由请求本身去验证"""
+        healthy = [b for b in self.backends if b.healthy]
+        candidates = healthy or list(self.backends)
+        # 负载相同时轮流，不总是打到列表里第一台
+        self._rr = (self._rr + 1) % len(self.backends)
+        order = {id(b): (i - self._rr) % len(self.backends) for i, b in enumerate(self.backends)}
+        ordered = sorted(candidates, key=lambda b: (b.outstanding, not b.model_loaded, order[id(b)]))
+
+        if self.affinity and affinity_key:
+            home = max(candidates, key=lambda b: self._affinity_rank(affinity_key, b))
+            if home.outstanding - ordered[0].outstanding < self.affinity_slack:
+                ordered.remove(home)
+                ordered.insert(0, home)
+        rest = [b for b in self.backends if b not in ordered]
+        return ordered + rest
+
+    @contextmanager
+    def track(self, backend: OllamaBackend):
+        backend.outstanding += 1
+        try:
+            yield
+        finally:
+            backend.outstanding -= 1
+
+    def should_failover(self, reason: str) -> bool:
+        return reason.startswith(FAILOVER_PREFIXES)
+
+    def mark_failed(self, backend: OllamaBackend, reason: str):
+        backend.failures += 1
+        backend.last_error = reason
+        OLLAMA_FAILOVERS.inc(backend=backend.url)
+        if backend.healthy:
+            logger.warning(f"⚠️ Ollama backend {backend.url} marked down: {reason}")
+        backend.healthy = False
+
+    # ---------- 健康检查 ----------
+
+    async def check(self, backend: OllamaBackend):
+        try:
+            response = await self._client.get(f"{backend.url}/api/ps", timeout=self.check_timeout)
+            if response.status_code == 404:
+                # 老版本 Ollama 没有 /api/ps：能响应就算健康，加载状态未知
+                response = None
+            else:
+                response.raise_for_status()
+            names = {m.get("name", "") for m in response.json().get("models", [])} if response is not None else set()
+            names |= {name.rsplit(":", 1)[0] for name in names}
+            loaded = self.model in names
+            if not backend.healthy:
+                logger.info(f"✅ Ollama backend {backend.url} is back")
+            backend.healthy, backend.model_loaded, backend.last_error = True, loaded, None
+        except Exception as e:
+            if backend.healthy:
+                logger.warning(f"⚠️ Ollama backend {backend.url} health check failed: {e}")
+            backend.healthy, backend.model_loaded, backend.last_error = False, False, str(e) or type(e).__name__
+        backend.checked_at = time.time()
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(b) for b in self.backends))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Ollama health loop error: {e}")
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._client = httpx.AsyncClient()
+        await self.check_all()
+        self._task = asyncio.create_task(self._run())
+        states = ", ".join(f"{b.url} ({'up' if b.healthy else 'down'})" for b in self.backends)
+        logger.info(f"🧭 Ollama pool: {states}{' | affinity on' if self.affinity else ''}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> List[dict]:
+        return [b.stats() for b in self.backends]
+
+
+# --- 本地桩服务自检：python ollama_pool.py ---
+
+async def self_check():
+    import json
+    import threading
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from ollama_client import OllamaClient
+
+    hits = {}
+
+    def make_stub(name: str, status: int, loaded: bool):
+        class Stub(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, code: int, body: dict):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._reply(200, {"models": [{"name": "stub-model:latest"}] if loaded else []})
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                hits[name] = hits.get(name, 0) + 1
+                time.sleep(0.02)
+                self._reply(status, {"response": "理由：桩\n结果：TRUE", "done": True})
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Stub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+    a, url_a = make_stub("a", 200, loaded=True)
+    b, url_b = make_stub("b", 200, loaded=False)
+    c, url_c = make_stub("c", 503, loaded=True)
+    # 第四台没有进程监听，健康检查应判定为不可用
+    probe = ThreadingHTTPServer(("127.0.0.1", 0), BaseHTTPRequestHandler)
+    url_d = f"http://127.0.0.1:{probe.server_address[1]}"
+    probe.server_close()
+
+    pool = OllamaPool([url_a, url_b, url_c, url_d], "stub-model", check_interval=60)
+    client = OllamaClient(url_a, "stub-model", pool=pool)
+    try:
+        await pool.start()
+        assert [bk.healthy for bk in pool.backends] == [True, True, True, False], pool.stats()
+        assert [bk.model_loaded for bk in pool.backends] == [True, False, True, False], pool.stats()
+
+        # 最少在途：并发请求摊到所有健康后端；503 的那台失败后自动换台，请求全部成功
+        results = await asyncio.gather(*(client.generate("aW1n", "p") for _ in range(40)))
+        assert all(ok for ok, _ in results), results
+        assert not pool.backends[2].healthy and hits.get("c", 0) >= 1, pool.stats()
+        assert hits.get("a", 0) > 5 and hits.get("b", 0) > 5, hits
+        print(f"✅ least-outstanding + failover: {hits}")
+
+        # 亲和：同一类型只打到一台
+        pool.affinity = True
+        hits.clear()
+        for _ in range(10):
+            await client.generate("aW1n", "p", affinity="is_spill")
+        assert len(hits) == 1, hits
+        print(f"✅ affinity: {hits}")
+        print("✅ ollama pool self-check passed")
+    finally:
+        await client.aclose()
+        await pool.close()
+        for server in (a, b, c):
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(self_check())
@@ -0,0 +1,146 @@
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RecentResults:
+    """
+    最近任务状态的内存索引，状态查询 / 长轮询 / SSE 都从这里读，不打 SQLite：
+    - mission_entry 时登记为 PENDING，result_monitor 落库后更新为 COMPLETED，回调投递后更新 callbackStatus
+    - 有上限的 LRU，淘汰掉的老任务由调用方回源数据库
+    - 数据库里也查不到的 taskSerial 记一个 miss_ttl 秒的否定缓存，轮询不存在的 ID 不会反复打 SQLite；
+      之后登记的同名任务会清掉这个标记
+    - wait() 挂起直到任务完成或超时；subscribe() 为每个订阅者建一个有界队列，推送完成事件
+    """
+
+    def __init__(self, max_size: int = 10000, subscriber_queue_size: int = 1000, miss_ttl: float = 5.0):
+        self.max_size = max_size
+        self.subscriber_queue_size = subscriber_queue_size
+        self.miss_ttl = miss_ttl
+        self._data: "OrderedDict[str, dict]" = OrderedDict()
+        self._missing: "OrderedDict[str, float]" = OrderedDict()  # taskSerial -> 否定缓存过期时间 (monotonic)
+        self._waiters: Dict[str, list] = {}  # taskSerial -> [Event, 等待者数]
+        self._subscribers = set()
+
+    def _put(self, task_serial: str, entry: dict):
+        self._missing.pop(task_serial, None)
+        self._data[task_serial] = entry
+        self._data.move_to_end(task_serial)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, task_serial: str) -> Optional[dict]:
+        entry = self._data.get(task_serial)
+        if entry is not None:
+            self._data.move_to_end(task_serial)
+        return entry
+
+    def put(self, entry: dict):
+        """回源数据库得到的条目也放进来，下次直接命中"""
+        self._put(entry["taskSerial"], entry)
+
+    # ---------- 否定缓存 ----------
+
+    def is_missing(self, task_serial: str) -> bool:
+        expires = self._missing.get(task_serial)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            del self._missing[task_serial]
+            return False
+        return True
+
+    def record_missing(self, task_serial: str):
+        if self.miss_ttl <= 0:
+            return
+        self._missing[task_serial] = time.monotonic() + self.miss_ttl
+        self._missing.move_to_end(task_serial)
+        while len(self._missing) > self.max_size:
+            self._missing.popitem(last=False)
+
+    # ---------- 状态变更 ----------
+
+    def record_pending(self, task_serial: str, mission_type: str, pic_ids: Iterable[str]):
+        self._put(task_serial, {
+            "taskSerial": task_serial,
+            "type": mission_type,
+            "status": "PENDING",
+            "callbackStatus": "WAITING",
+            "pictures": [{"picId": pic_id, "result": None, "reason": None} for pic_id in pic_ids],
+        })
+
+    def record_result(self, payload: dict):
+        """payload 为回调结构 {taskSerial, type, data: [{picId, result, reason}]}"""
+        task_serial = payload["taskSerial"]
+        previous = self._data.get(task_serial) or {}
+        entry = {
+            "taskSerial": task_serial,
+            "type": payload["type"],
+            "status": "COMPLETED",
+            "callbackStatus": previous.get("callbackStatus", "WAITING"),
+            "pictures": [{"picId": item["picId"], "result": item["result"], "reason": item["reason"]}
+                         for item in payload["data"]],
+        }
+        self._put(task_serial, entry)
+
+        waiter = self._waiters.pop(task_serial, None)
+        if waiter is not None:
+            waiter[0].set()
+        self._publish(entry)
+
+    def record_callback_status(self, task_serial: str, status: str):
+        entry = self._data.get(task_serial)
+        if entry is not None:
+            entry["callbackStatus"] = status
+
+    # ---------- 长轮询 ----------
+
+    async def wait(self, task_serial: str, timeout: float) -> Optional[dict]:
+        """等到任务完成返回条目；超时返回当前条目 (可能仍是 PENDING 或 None)"""
+        entry = self._data.get(task_serial)
+        if (entry is not None and entry["status"] == "COMPLETED") or timeout <= 0:
+            return entry
+        waiter = self._waiters.setdefault(task_serial, [asyncio.Event(), 0])
+        waiter[1] += 1
+        try:
+            await asyncio.wait_for(waiter[0].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            waiter[1] -= 1
+            if waiter[1] <= 0 and self._waiters.get(task_serial) is waiter:
+                del self._waiters[task_serial]
+        return self._data.get(task_serial)
+
+    # ---------- SSE 订阅 ----------
+
+    @contextmanager
+    def subscribe(self, task_serials: Optional[List[str]] = None):
+        """返回一个 asyncio.Queue，只接收 task_serials 中的任务 (为空时接收全部)"""
+        queue = asyncio.Queue(maxsize=self.subscriber_queue_size)
+        subscriber = (queue, frozenset(task_serials or ()))
+        self._subscribers.add(subscriber)
+        try:
+            yield queue
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def _publish(self, entry: dict):
+        for queue, wanted in self._subscribers:
+            if wanted and entry["taskSerial"] not in wanted:
+                continue
+            try:
+                queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                # 慢订阅者丢事件，不拖住结果处理
+                logger.warning(f"SSE subscriber queue full, dropping result {entry['taskSerial']}")
+
+
+def sse_event(entry: dict, event: str = "result") -> str:
+    return f"event: {event}\ndata: {json.dumps(entry, ensure_ascii=False)}\n\n"
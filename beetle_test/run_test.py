@@ -1,13 +1,17 @@
 import asyncio
 import os
 import sys
+import csv
+import json
+import time
+import hashlib
 import argparse
 
-# --- 关键修改：导入 sync 函数 ---
+# --- 关键修改：导入 async 的预处理与推理 ---
 try:
-    # 你的 client_test.py 里只有 call_ollama_sync
-    from client_test import process_image_sync, call_ollama_sync, OLLAMA_MODEL
+    from client_test import IMAGE_ENGINE, OLLAMA_MODEL, OLLAMA_CLIENT, OLLAMA_NUM_PARALLEL, INFER_ERROR_PREFIXES
     from Prompt_loader import PromptLoader
+    from timeline import percentile
 except ImportError as e:
     print(f"❌ 导入错误: {e}")
     sys.exit(1)
@@ -16,13 +20,105 @@ except ImportError as e:
 TEST_IMAGE_DIR = "./workspace/images"
 PROMPT_YAML_PATH = "./promot/spill_promot.yaml"
 CURRENT_TEST_TYPE = "is_spill"
+RESULTS_DIR = "./workspace/eval"
 
 class Colors:
     GREEN = '\033[92m'
     RED = '\033[91m'
+    YELLOW = '\033[93m'
     RESET = '\033[0m'
 
-async def run_prompt_test(filter_keyword):
+def parse_label(value) -> bool:
+    text = str(value).strip().lower()
+    if text in ("1", "true", "t", "yes", "y"):
+        return True
+    if text in ("0", "false", "f", "no", "n"):
+        return False
+    raise ValueError(f"无法识别的标签: {value}")
+
+def load_labels(path: str) -> dict:
+    """标注文件：JSON 对象 {图片名: true/false}，或 CSV/TSV 每行 图片名,标签 (可带表头)"""
+    if path.endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            return {name: parse_label(label) for name, label in json.load(f).items()}
+    labels = {}
+    with open(path, encoding="utf-8", newline="") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        dialect = csv.Sniffer().sniff(sample, delimiters=",\t") if sample else csv.excel
+        for row in csv.reader(f, dialect):
+            if len(row) < 2 or not row[0].strip():
+                continue
+            try:
+                labels[row[0].strip()] = parse_label(row[1])
+            except ValueError:
+                if labels:  # 只容忍第一行是表头
+                    raise
+    return labels
+
+def run_key(prompt_version: str, output_format: str) -> str:
+    """提示词版本 (含 token 上限) / 模型 / 输出格式任一变化，旧的检查点结果就不能复用"""
+    raw = json.dumps([OLLAMA_MODEL, prompt_version, output_format])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:12]
+
+def load_checkpoint(path: str, key: str) -> dict:
+    """读取已完成的结果 {图片名: 记录}；失败的记录不算完成，续跑时会重试"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 中断时写了半行
+            if record.get("key") == key and not record.get("error"):
+                done[record["image"]] = record
+    return done
+
+def report(records: list, labels: dict):
+    stats = {"TRUE": 0, "FALSE": 0, "ERROR": 0}
+    tp = fp = tn = fn = 0
+    wrong = []
+    for record in records:
+        if record.get("error"):
+            stats["ERROR"] += 1
+            continue
+        stats["TRUE" if record["result"] else "FALSE"] += 1
+        label = labels.get(record["image"])
+        if label is None:
+            continue
+        if record["result"] and label:
+            tp += 1
+        elif record["result"]:
+            fp += 1
+        elif label:
+            fn += 1
+        else:
+            tn += 1
+        if record["result"] != label:
+            wrong.append(record)
+
+    print("=" * 60)
+    print(f"✅ 统计: TRUE={stats['TRUE']} | FALSE={stats['FALSE']} | ERRORS={stats['ERROR']}")
+    latencies = sorted(r["latency"] for r in records if not r.get("error") and r.get("latency") is not None)
+    if latencies:
+        print(f"⏱️ 单张延迟: p50={percentile(latencies, 0.5):.2f}s  p90={percentile(latencies, 0.9):.2f}s  "
+              f"p99={percentile(latencies, 0.99):.2f}s  max={latencies[-1]:.2f}s")
+    labelled = tp + fp + tn + fn
+    if labelled:
+        precision = tp / (tp + fp) if tp + fp else 0.0
+        recall = tp / (tp + fn) if tp + fn else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        print(f"🎯 已标注 {labelled} 张 | accuracy={(tp + tn) / labelled:.3f}  precision={precision:.3f}  "
+              f"recall={recall:.3f}  f1={f1:.3f}")
+        print(f"   混淆矩阵: TP={tp} FP={fp} TN={tn} FN={fn}")
+        for record in wrong:
+            kind = "FP" if record["result"] else "FN"
+            print(f"   {Colors.YELLOW}{kind}{Colors.RESET} {record['image'][:40]:<40} | 💡 {record['reason']}")
+
+async def run_prompt_test(filter_keyword, output_format="text", concurrency=OLLAMA_NUM_PARALLEL,
+                          labels_path="", results_path="", fresh=False):
     # 检查图片目录
     if not os.path.exists(TEST_IMAGE_DIR):
         print(f"❌ 找不到图片文件夹: {TEST_IMAGE_DIR}")
@@ -31,69 +127,102 @@ async def run_prompt_test(filter_keyword):
     # 加载提示词
     try:
         loader = PromptLoader(PROMPT_YAML_PATH)
-        system_prompt = loader.system_prompt_get(CURRENT_TEST_TYPE)
+        system_prompt, num_predict, prompt_version = loader.get(CURRENT_TEST_TYPE)
+        if not system_prompt:
+            raise ValueError(loader.last_error or "empty prompt")
     except Exception as e:
         print(f"❌ 提示词加载失败: {e}")
         return
 
+    labels = {}
+    if labels_path:
+        try:
+            labels = load_labels(labels_path)
+        except Exception as e:
+            print(f"❌ 标注文件加载失败: {e}")
+            return
+
     # 获取文件列表
     all_files = os.listdir(TEST_IMAGE_DIR)
     image_files = [
-        f for f in all_files 
-        if filter_keyword in f 
+        f for f in all_files
+        if filter_keyword in f
         and f.lower().endswith(('.png', '.jpg', '.jpeg'))
     ]
     image_files.sort()
 
-    print(f"🚀 开始测试 | 模型: {OLLAMA_MODEL} | 图片数: {len(image_files)} | 关键词: '{filter_keyword}'")
+    # 检查点：每张图片的原始结果追加写入 JSONL，中断后续跑只推理缺的
+    key = run_key(prompt_version, output_format)
+    if not results_path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        results_path = os.path.join(RESULTS_DIR, f"{CURRENT_TEST_TYPE}_{output_format}_{key}.jsonl")
+    if fresh and os.path.exists(results_path):
+        os.remove(results_path)
+    done = load_checkpoint(results_path, key)
+    pending = [name for name in image_files if name not in done]
+
+    OLLAMA_CLIENT.output_format = output_format
+    print(f"🚀 开始测试 | 模型: {OLLAMA_MODEL} | 提示词版本: {prompt_version[:8]} | 输出格式: {output_format} | 图片数: {len(image_files)} | 关键词: '{filter_keyword}'")
+    print(f"   并发: {concurrency} | 已完成可复用: {len(image_files) - len(pending)} | 待推理: {len(pending)} | 结果文件: {results_path}")
     print("=" * 60)
 
-    stats = {"TRUE": 0, "FALSE": 0, "ERROR": 0}
+    sem = asyncio.Semaphore(concurrency)
+    finished = 0
 
-    # --- 循环测试 ---
-    for idx, img_name in enumerate(image_files):
+    async def evaluate(img_name, out):
+        nonlocal finished
         img_path = os.path.join(TEST_IMAGE_DIR, img_name)
-        
-        print(f"[{idx+1}/{len(image_files)}] 分析中: {img_name} ...", end="\r")
-
-        # 1. 图片转码 (放入线程池)
-        b64_data = await asyncio.to_thread(process_image_sync, img_path)
-        
-        if not b64_data:
-            print(f"❌ 读取失败: {img_name}" + " " * 40)
-            stats["ERROR"] += 1
-            continue
+        record = {"key": key, "image": img_name, "result": None, "reason": None, "latency": None, "error": None}
+        async with sem:
+            # 1. 图片转码
+            b64_data = await IMAGE_ENGINE.process(img_path)
+            if not b64_data:
+                record["error"] = "Image Error"
+            else:
+                # 2. 调用模型
+                start = time.perf_counter()
+                try:
+                    result_bool, reason = await OLLAMA_CLIENT.generate(b64_data, system_prompt, num_predict=num_predict)
+                    record.update(result=result_bool, reason=reason, latency=round(time.perf_counter() - start, 3))
+                    if reason.startswith(INFER_ERROR_PREFIXES):
+                        record["error"] = reason
+                except Exception as e:
+                    record["error"] = f"Exception: {e}"
 
-        # 2. 调用模型 (关键修改：使用 to_thread 调用同步函数)
-        # 注意：call_ollama_sync 不需要 client 参数
-        try:
-            result_bool, reason = await asyncio.to_thread(call_ollama_sync, b64_data, system_prompt)
-        except Exception as e:
-            print(f"❌ 调用出错: {e}")
-            stats["ERROR"] += 1
-            continue
+        # 3. 落检查点并打印结果
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+        finished += 1
+        progress = f"[{finished}/{len(pending)}]"
+        if record["error"]:
+            print(f"{progress} ❌ {img_name[:30]:<30} -> {record['error']}")
+            return record
+        color, res_str = (Colors.GREEN, "TRUE ") if record["result"] else (Colors.RED, "FALSE")
+        label = labels.get(img_name)
+        mark = "" if label is None else (" ✔" if label == record["result"] else " ✘")
+        print(f"{progress} 🖼️  {img_name[:30]:<30} -> {color}{res_str}{Colors.RESET}{mark} | 💡 {record['reason']}")
+        return record
 
-        # 3. 打印结果
-        print(" " * 80, end="\r") 
-        
-        if result_bool:
-            color = Colors.GREEN
-            res_str = "TRUE "
-            stats["TRUE"] += 1
-        else:
-            color = Colors.RED
-            res_str = "FALSE"
-            stats["FALSE"] += 1
-        
-        # 格式化输出
-        print(f"🖼️  {img_name[:30]:<30} -> {color}{res_str}{Colors.RESET} | 💡 {reason}")
+    # --- 并发测试 ---
+    try:
+        with open(results_path, "a", encoding="utf-8") as out:
+            new_records = await asyncio.gather(*[evaluate(name, out) for name in pending])
+    finally:
+        IMAGE_ENGINE.shutdown()
+        await OLLAMA_CLIENT.aclose()
 
-    print("=" * 60)
-    print(f"✅ 统计: TRUE={stats['TRUE']} | FALSE={stats['FALSE']} | ERRORS={stats['ERROR']}")
+    by_name = dict(done)
+    by_name.update({r["image"]: r for r in new_records})
+    report([by_name[name] for name in image_files if name in by_name], labels)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-m", type=str, default="", help="图片名关键词")
+    parser.add_argument("-f", "--format", type=str, default="text", choices=["text", "json"], help="模型输出格式")
+    parser.add_argument("-j", "--concurrency", type=int, default=max(1, OLLAMA_NUM_PARALLEL), help="同时推理的图片数")
+    parser.add_argument("-l", "--labels", type=str, default="", help="标注文件 (JSON 或 CSV: 图片名,true/false)")
+    parser.add_argument("-o", "--results", type=str, default="", help="结果检查点文件 (JSONL)，默认按提示词哈希放在 workspace/eval 下")
+    parser.add_argument("--fresh", action="store_true", help="忽略已有检查点，全部重新推理")
     args = parser.parse_args()
-    
-    asyncio.run(run_prompt_test(args.m))
+
+    asyncio.run(run_prompt_test(args.m, args.format, args.concurrency, args.labels, args.results, args.fresh))
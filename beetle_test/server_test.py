@@ -1,28 +1,122 @@
 import uvicorn
-from fastapi import FastAPI, Request
-from pydantic import BaseModel, Field
-from typing import List, Optional, Any
+from fastapi import FastAPI, Request, Response, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from typing import Dict, List, Optional, Any
+from collections import OrderedDict
 import aiosqlite
-import httpx
 import logging
-#加上出入队列时间，便于追踪import time
+#加上出入队列时间，便于追踪
+import time
 import asyncio
+import os
 import json
 import redis.asyncio as redis
 
+from stream_transport import make_transport
+from sqlite_writer import SQLiteWriter, SQLiteReadPool
+from callback_client import CallbackClient
+from callback_outbox import CallbackOutbox
+from admission import AdmissionController
+from lanes import LaneRouter
+from metrics import REGISTRY, Collector, Counter
+from bulk_ingest import iter_json_items
+from result_index import RecentResults, sse_event
+from db_migrations import migrate, archive_batch, purge_archive_batch, SCHEMA_VERSION
+from timeline import report_queries, summarize, parse_window
+
 # --- 配置 ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - [SERVER] - %(message)s')
 logger = logging.getLogger(__name__)
 
 DB_NAME = "missions.db"
+# 单一写连接组提交 + 只读连接池
+DB_WRITER = SQLiteWriter(DB_NAME, max_batch=int(os.getenv("DB_MAX_BATCH", "256")),
+                         max_delay=float(os.getenv("DB_COMMIT_DELAY_MS", "5")) / 1000,
+                         synchronous=os.getenv("DB_SYNCHRONOUS") or None)
+DB_READ_POOL = SQLiteReadPool(DB_NAME, size=int(os.getenv("DB_READ_POOL_SIZE", "4")))
 # 连接宿主机 Redis 6380
-REDIS_URL = "redis://localhost:6380"
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6380")
 TASK_QUEUE = "queue:missions"
 RESULT_QUEUE = "queue:results"
 
+# 大任务切片：图片数超过阈值的任务按 SHARD_SIZE 切成多个分片，任意 worker 都可以领取
+SHARD_THRESHOLD = int(os.getenv("SHARD_THRESHOLD", "50"))
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", "20"))
+SHARD_KEY_PREFIX = "shards:"
+SHARD_TTL = 24 * 3600
+# 合并锁的租期：落库失败时会主动释放；进程崩溃没释放的锁过期后，重新投递的分片可以再次合并
+SHARD_MERGE_LEASE = 60
+
+# 批量导入：每攒够 BULK_BATCH_SIZE 条任务落一次库、批量推一次队列
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "200"))
+
+# 历史数据保留：完成超过 RETENTION_DAYS 天的任务挪进归档表，归档超过 ARCHIVE_RETENTION_DAYS 天的删除 (0 表示不处理)
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "30"))
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", "0"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+
+# 结果批量消费：一次最多取出并落库的结果条数
+RESULT_BATCH_SIZE = int(os.getenv("RESULT_BATCH_SIZE", "100"))
+CALLBACK_URL_CACHE_SIZE = int(os.getenv("CALLBACK_URL_CACHE_SIZE", "10000"))
+
+# 最近任务状态的内存索引：状态查询、长轮询和 SSE 都从这里读
+RESULT_INDEX = RecentResults(max_size=int(os.getenv("RESULT_INDEX_SIZE", "10000")),
+                             miss_ttl=float(os.getenv("RESULT_INDEX_MISS_TTL", "5")))
+LONGPOLL_MAX_WAIT = float(os.getenv("LONGPOLL_MAX_WAIT", "60"))
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", "15"))
+
 USER_FORWARDING_LIMIT = asyncio.Semaphore(50)
+# 应用级共享回调客户端：keep-alive 连接池 + 可选 HTTP/2 (每主机并发上限在 CALLBACK_OUTBOX 里)
+CALLBACK_CLIENT = CallbackClient(
+    max_connections=int(os.getenv("CALLBACK_MAX_CONNECTIONS", "100")),
+    timeout=float(os.getenv("CALLBACK_TIMEOUT", "10")),
+    connect_timeout=float(os.getenv("CALLBACK_CONNECT_TIMEOUT", "5")),
+    http2=os.getenv("CALLBACK_HTTP2", "0") == "1",
+)
+# 持久化回调发件箱：结果与待投递回调同事务落库，失败指数退避重试，超过次数进死信
+CALLBACK_OUTBOX = CallbackOutbox(
+    DB_WRITER, DB_READ_POOL, CALLBACK_CLIENT, USER_FORWARDING_LIMIT,
+    max_attempts=int(os.getenv("CALLBACK_MAX_ATTEMPTS", "8")),
+    base_backoff=float(os.getenv("CALLBACK_BASE_BACKOFF", "2")),
+    max_backoff=float(os.getenv("CALLBACK_MAX_BACKOFF", "600")),
+    per_host_limit=int(os.getenv("CALLBACK_PER_HOST_LIMIT", "10")),
+    global_host_share=int(os.getenv("CALLBACK_GLOBAL_HOST_SHARE", "5")),
+    on_status=RESULT_INDEX.record_callback_status,
+)
 beetle_server = FastAPI(title="Dispatch Server")
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+# QUEUE_TRANSPORT=stream 时走 Redis Streams 消费组 (需与 worker 一致)
+transport = make_transport(redis_client, group="servers")
+# 优先级通道：任务按 (priority, type, 调用方) 分通道入队，worker 加权公平地取
+LANES = LaneRouter(redis_client, transport, TASK_QUEUE)
+# 准入控制：积压超过上限或预计完成时间超过 SLO 时拒绝并给出 Retry-After (0 表示不限制)
+ADMISSION = AdmissionController(
+    LANES.backlog,
+    max_backlog=int(os.getenv("ADMISSION_MAX_BACKLOG", "10000")),
+    slo_seconds=float(os.getenv("ADMISSION_SLO_SECONDS", "0")),
+    window=float(os.getenv("ADMISSION_WINDOW", "60")),
+)
+
+# --- 监控指标 (/metrics) ---
+MISSIONS_RECEIVED = Counter("beetle_missions_received_total", "Missions accepted at intake", ["type", "priority"])
+MISSIONS_REJECTED = Counter("beetle_missions_rejected_total", "Missions rejected by admission control", ["cause"])
+MISSIONS_COMPLETED = Counter("beetle_missions_completed_total", "Missions with all results recorded", ["type"])
+PICTURES_COMPLETED = Counter("beetle_pictures_completed_total", "Picture verdicts recorded", ["type", "result"])
+SERVER_ERRORS = Counter("beetle_server_errors_total", "Server errors by component and reason", ["component", "reason"])
+
+async def queue_depths() -> dict:
+    depths = {(RESULT_QUEUE,): await transport.backlog(RESULT_QUEUE), (TASK_QUEUE,): await transport.backlog(TASK_QUEUE)}
+    for lane in await LANES.lanes():
+        depths[(lane,)] = await transport.backlog(lane)
+    return depths
+
+Collector("beetle_queue_depth", "Messages waiting in each Redis queue / priority lane", "gauge", queue_depths, ["queue"])
+Collector("beetle_worker_throughput", "Result messages per second over the admission window", "gauge",
+          lambda: {(): ADMISSION.throughput() or 0.0})
+Collector("beetle_callbacks_inflight", "Callback deliveries in flight", "gauge",
+          lambda: {(): CALLBACK_OUTBOX.inflight})
 
 # --- 数据模型定义 ---
 
@@ -40,6 +134,13 @@ class MissionRequest(BaseModel):
     type: str
     callbackurl: str
     pictureList: List[PictureItem]
+    # 优先级：high / normal / low，缺省为 normal
+    priority: Optional[str] = None
+    # 分片信息，仅在服务端切片后的队列消息中出现
+    shardIndex: Optional[int] = None
+    shardCount: Optional[int] = None
+    # 阶段时间戳：接收时记 accepted，落库入队时记 enqueued (epoch 秒)；队列消息里只带 enqueued，worker 原样带回
+    timeline: Optional[Dict[str, float]] = None
 
 # 新增：标准API返回结构
 class StandardResponse(BaseModel):
@@ -59,137 +160,399 @@ class CallbackPayload(BaseModel):
     type: str
     data: List[CallbackItem]
 
+# 死信重放：不带条件时重放全部死信
+class ReplayRequest(BaseModel):
+    ids: Optional[List[int]] = None
+    taskSerial: Optional[str] = None
+
+# --- 回调地址缓存 ---
+
+class CallbackUrlCache:
+    """mission_entry 时记录 taskSerial -> callbackurl，结果回来时免去一次 SELECT；有上限的 LRU"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+
+    def put(self, task_serial: str, url: str):
+        self._data[task_serial] = url
+        self._data.move_to_end(task_serial)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def get(self, task_serial: str) -> Optional[str]:
+        url = self._data.get(task_serial)
+        if url is not None:
+            self._data.move_to_end(task_serial)
+        return url
+
+CALLBACK_URLS = CallbackUrlCache(CALLBACK_URL_CACHE_SIZE)
+
 # --- 数据库操作 ---
 
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
+    # isolation_level=None: 迁移脚本自己管理事务
+    async with aiosqlite.connect(DB_NAME, isolation_level=None) as db:
         await db.execute("PRAGMA journal_mode=WAL;")
-        # 任务表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS missions (
-                task_serial TEXT PRIMARY KEY,
-                type TEXT,
-                callbackurl TEXT,
-                callback_status TEXT, 
-                status TEXT, 
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # 图片表
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS pictures (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                task_serial TEXT,
-                pic_id TEXT,
-                download_url TEXT,
-                result BOOLEAN, 
-                reason TEXT,
-                FOREIGN KEY(task_serial) REFERENCES missions(task_serial)
-            )
-        """)
-        await db.commit()
+        previous = await migrate(db)
+    if previous != SCHEMA_VERSION:
+        logger.info(f"🗄️ Database schema v{previous} -> v{SCHEMA_VERSION}")
 
 async def save_mission_initial(mission: MissionRequest):
-    async with aiosqlite.connect(DB_NAME) as db:
-        # 插入任务
-        await db.execute(
-            "INSERT OR REPLACE INTO missions (task_serial, type, callbackurl, callback_status, status) VALUES (?, ?, ?, ?, ?)",
-            (mission.taskSerial, mission.type, mission.callbackurl, "WAITING", "PENDING")
-        )
-        # 插入图片
-        pic_tuples = [(mission.taskSerial, p.picId, p.get_url()) for p in mission.pictureList]
-        await db.executemany(
-            "INSERT INTO pictures (task_serial, pic_id, download_url) VALUES (?, ?, ?)",
-            pic_tuples
-        )
-        await db.commit()
+    await save_missions_initial([mission])
+
+async def save_missions_initial(missions: List[MissionRequest]):
+    """一批任务在同一个事务里落库；入队时间在这里确定并随任务落库，卡在队列里的任务也能看出等了多久"""
+    enqueued = time.time()
+    for mission in missions:
+        mission.timeline = {"accepted": (mission.timeline or {}).get("accepted", enqueued), "enqueued": enqueued}
+
+    async def job(db):
+        for mission in missions:
+            await insert_mission(db, mission)
+    await DB_WRITER.run(job)
+    for mission in missions:
+        CALLBACK_URLS.put(mission.taskSerial, mission.callbackurl)
+        MISSIONS_RECEIVED.inc(type=mission.type, priority=mission.priority or "normal")
+        RESULT_INDEX.record_pending(mission.taskSerial, mission.type, (p.picId for p in mission.pictureList))
+
+async def insert_mission(db, mission: MissionRequest):
+    # 插入任务；重复提交时原地重置状态和阶段时间戳，保留 created_at
+    stamps = mission.timeline or {}
+    now = time.time()
+    await db.execute(
+        "INSERT INTO missions (task_serial, type, callbackurl, callback_status, status, accepted_at, enqueued_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(task_serial) DO UPDATE SET type = excluded.type, callbackurl = excluded.callbackurl, "
+        "callback_status = excluded.callback_status, status = excluded.status, updated_at = CURRENT_TIMESTAMP, "
+        "accepted_at = excluded.accepted_at, enqueued_at = excluded.enqueued_at, result_received_at = NULL, "
+        "callback_delivered_at = NULL",
+        (mission.taskSerial, mission.type, mission.callbackurl, "WAITING", "PENDING",
+         stamps.get("accepted", now), stamps.get("enqueued", now))
+    )
+    # 插入图片；重复提交以新的图片列表为准，不再追加重复行
+    await db.execute("DELETE FROM pictures WHERE task_serial = ?", (mission.taskSerial,))
+    pic_tuples = [(mission.taskSerial, p.picId, p.get_url()) for p in mission.pictureList]
+    await db.executemany(
+        "INSERT OR REPLACE INTO pictures (task_serial, pic_id, download_url) VALUES (?, ?, ?)",
+        pic_tuples
+    )
 
 async def update_mission_result(payload: CallbackPayload):
-    async with aiosqlite.connect(DB_NAME) as db:
+    await update_mission_results([payload])
+
+async def update_mission_results(payloads: List[CallbackPayload], callback_rows: Optional[List[tuple]] = None,
+                                 timelines: Optional[Dict[str, dict]] = None):
+    """
+    一批结果在同一个事务里落库；callback_rows 同事务写入回调发件箱，结果落库即不会丢回调。
+    timelines 为 {taskSerial: {"pictures": {picId: 阶段时间戳}}}，见 pop_timeline；入队时间已在接收时落库
+    """
+    timelines = timelines or {}
+    received = time.time()
+
+    async def job(db):
         # 更新主任务状态
-        await db.execute("UPDATE missions SET status = 'COMPLETED', updated_at = CURRENT_TIMESTAMP WHERE task_serial = ?", (payload.taskSerial,))
-        # 更新每张图片的结果和理由
-        result_tuples = [(p.result, p.reason, payload.taskSerial, p.picId) for p in payload.data]
-        await db.executemany("UPDATE pictures SET result = ?, reason = ? WHERE task_serial = ? AND pic_id = ?", result_tuples)
-        await db.commit()
+        await db.executemany(
+            "UPDATE missions SET status = 'COMPLETED', updated_at = CURRENT_TIMESTAMP, "
+            "result_received_at = ? WHERE task_serial = ?",
+            [(received, payload.taskSerial) for payload in payloads]
+        )
+        # 更新每张图片的结果、理由和各阶段时间戳
+        result_tuples = []
+        for payload in payloads:
+            stamps_by_pic = timelines.get(payload.taskSerial, {}).get("pictures", {})
+            for p in payload.data:
+                stamps = stamps_by_pic.get(p.picId, {})
+                result_tuples.append((p.result, p.reason, stamps.get("worker"), stamps.get("prompt_version"),
+                                      *(stamps.get(stage) for stage in PICTURE_STAGES),
+                                      payload.taskSerial, p.picId))
+        await db.executemany(
+            "UPDATE pictures SET result = ?, reason = ?, worker = ?, prompt_version = ?, dequeued_at = ?, "
+            "download_done_at = ?, preprocess_done_at = ?, inference_start_at = ?, inference_end_at = ? "
+            "WHERE task_serial = ? AND pic_id = ?",
+            result_tuples
+        )
+        if callback_rows:
+            await CallbackOutbox.enqueue(db, callback_rows)
+    await DB_WRITER.run(job)
 
 async def get_user_callback_url(task_serial: str):
-    async with aiosqlite.connect(DB_NAME) as db:
+    url = CALLBACK_URLS.get(task_serial)
+    if url is not None:
+        return url
+    # 缓存未命中 (如 server 重启过) 才查库
+    async with DB_READ_POOL.connection() as db:
         async with db.execute("SELECT callbackurl FROM missions WHERE task_serial=?", (task_serial,)) as cursor:
             row = await cursor.fetchone()
-            return row[0] if row else None
+    if row and row[0]:
+        CALLBACK_URLS.put(task_serial, row[0])
+    return row[0] if row else None
 
-async def update_callback_status(task_serial: str, status: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("UPDATE missions SET callback_status = ? WHERE task_serial = ?", (status, task_serial))
-        await db.commit()
+async def load_mission_status(task_serial: str) -> Optional[dict]:
+    """内存索引未命中时回源数据库 (含归档表)，查到后放回索引；查不到的短时间内不再回源"""
+    if RESULT_INDEX.is_missing(task_serial):
+        return None
+    async with DB_READ_POOL.connection() as db:
+        for missions_table, pictures_table in (("missions", "pictures"), ("missions_archive", "pictures_archive")):
+            async with db.execute(
+                f"SELECT type, status, callback_status FROM {missions_table} WHERE task_serial = ?", (task_serial,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                continue
+            async with db.execute(
+                f"SELECT pic_id, result, reason FROM {pictures_table} WHERE task_serial = ? ORDER BY id", (task_serial,)
+            ) as cursor:
+                pictures = await cursor.fetchall()
+            entry = {
+                "taskSerial": task_serial,
+                "type": row[0],
+                "status": row[1],
+                "callbackStatus": row[2],
+                "pictures": [{"picId": p[0], "result": None if p[1] is None else bool(p[1]), "reason": p[2]}
+                             for p in pictures],
+            }
+            RESULT_INDEX.put(entry)
+            return entry
+    RESULT_INDEX.record_missing(task_serial)
+    return None
 
-# --- 后台监听与回调逻辑 ---
+async def get_mission_status(task_serial: str, wait: float = 0.0) -> Optional[dict]:
+    entry = RESULT_INDEX.get(task_serial)
+    if entry is None:
+        entry = await load_mission_status(task_serial)
+    if entry is not None and entry["status"] != "COMPLETED" and wait > 0:
+        entry = await RESULT_INDEX.wait(task_serial, min(wait, LONGPOLL_MAX_WAIT))
+    return entry
 
-async def handle_forwarding(user_url: str, payload: CallbackPayload):
-    logger.info(f"Callback posting to {user_url}")
-    is_success = await forward_to_user(user_url, payload)
-    final_status = "SUCCESS" if is_success else "FAILED"
-    await update_callback_status(payload.taskSerial, final_status)
+# --- 大任务切片与合并 ---
 
-async def forward_to_user(user_url: str, payload: CallbackPayload):
-    async with USER_FORWARDING_LIMIT:
-        async with httpx.AsyncClient() as client:
-            try:
-                # 发送符合接口文档的 JSON
-                resp = await client.post(user_url, json=payload.dict(), timeout=10.0)
-                logger.info(f"User response code: {resp.status_code}")
-                # 只要对方回 200 就认为成功
-                return resp.status_code == 200
-            except Exception as e:
-                logger.error(f"Callback failed: {e}")
-                return False
+def shard_count(mission: MissionRequest) -> int:
+    pictures = len(mission.pictureList)
+    return 1 if pictures <= SHARD_THRESHOLD else -(-pictures // SHARD_SIZE)
+
+def split_mission(mission: MissionRequest) -> List[str]:
+    """返回要推入任务队列的消息；小任务原样一条，大任务按 SHARD_SIZE 切片。消息里带上落库时确定的入队时间"""
+    enqueued = (mission.timeline or {}).get("enqueued") or time.time()
+    mission = mission.copy(update={"timeline": {"enqueued": enqueued}})
+    pictures = mission.pictureList
+    if len(pictures) <= SHARD_THRESHOLD:
+        return [mission.json(exclude_none=True)]
+    chunks = [pictures[i:i + SHARD_SIZE] for i in range(0, len(pictures), SHARD_SIZE)]
+    return [
+        mission.copy(update={"pictureList": chunk, "shardIndex": idx, "shardCount": len(chunks)}).json(exclude_none=True)
+        for idx, chunk in enumerate(chunks)
+    ]
+
+# worker 回传的每图阶段时间戳，对应 pictures 表的 {stage}_at 列
+PICTURE_STAGES = ("dequeued", "download_done", "preprocess_done", "inference_start", "inference_end")
+
+def pop_timeline(data_dict: dict) -> dict:
+    """
+    从 worker 结果里取出阶段时间戳和提示词版本 (不转发给用户)，
+    返回 {"pictures": {picId: {阶段时间戳..., "prompt_version": ...}}}
+    """
+    data_dict.pop("timeline", None)
+    pictures = {}
+    for item in data_dict.get("data", []):
+        stamps = item.pop("timeline", None) or {}
+        prompt_version = item.pop("promptVersion", None)
+        if prompt_version:
+            stamps["prompt_version"] = prompt_version
+        if stamps:
+            pictures[item["picId"]] = stamps
+    return {"pictures": pictures}
+
+async def collect_shard(data_dict: dict) -> Optional[dict]:
+    """
+    分片结果先暂存在 Redis hash (shards:{taskSerial})，全部分片到齐后合并成一个完整结果返回；
+    未到齐返回 None。HSETNX 去重，合并前用带租期的锁 (shards:{taskSerial}:merging) 保证同一时间只合并一次。
+    暂存的分片在落库成功后由 finish_shards 删除：落库失败、消息被重新投递时分片仍然齐全，可以再次合并。
+    """
+    shard_index = data_dict.pop("shardIndex", None)
+    shard_count = data_dict.pop("shardCount", None)
+    if shard_count is None:
+        return data_dict
+
+    key = SHARD_KEY_PREFIX + data_dict["taskSerial"]
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hsetnx(key, str(shard_index), json.dumps(data_dict["data"]))
+        pipe.expire(key, SHARD_TTL)
+        pipe.hlen(key)
+        _, _, received = await pipe.execute()
+
+    logger.info(f"🧩 Shard {shard_index + 1}/{shard_count} for {data_dict['taskSerial']} ({received} received)")
+    if received < shard_count:
+        return None
+    if not await redis_client.set(key + ":merging", "1", nx=True, ex=SHARD_MERGE_LEASE):
+        # 其他投递已经在合并 (或刚合并完) 这个任务
+        return None
+
+    parts = await redis_client.hgetall(key)
+    data_dict["data"] = [item for idx in sorted(parts, key=int) for item in json.loads(parts[idx])]
+    return data_dict
+
+async def finish_shards(task_serials: List[str], committed: bool):
+    """合并结果落库后删掉分片暂存和合并锁；落库失败时只释放合并锁"""
+    if not task_serials:
+        return
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for task_serial in task_serials:
+                key = SHARD_KEY_PREFIX + task_serial
+                if committed:
+                    pipe.delete(key, key + ":merging")
+                else:
+                    pipe.delete(key + ":merging")
+            await pipe.execute()
+    except Exception as e:
+        # 清理失败不影响确认：合并锁到期自动释放，暂存的分片 SHARD_TTL 后过期
+        logger.warning(f"Shard cleanup failed for {len(task_serials)} mission(s): {e}")
+
+# --- 后台监听与回调逻辑 ---
 
 async def result_monitor():
     logger.info("Result Monitor started (Listening Redis)...")
     while True:
         try:
-            # 阻塞等待结果
-            result = await redis_client.brpop(RESULT_QUEUE, timeout=0)
-            if result:
-                json_data = result[1]
-                data_dict = json.loads(json_data)
-                payload = CallbackPayload(**data_dict)
-                
-                logger.info(f"Received Result for: {payload.taskSerial}")
-                
-                # 1. 存库
-                await update_mission_result(payload)
-                
-                # 2. 触发回调
-                user_url = await get_user_callback_url(payload.taskSerial)
-                if user_url:
-                    asyncio.create_task(handle_forwarding(user_url, payload))
-                else:
-                    logger.warning(f"No callback URL found for {payload.taskSerial}")
+            # 阻塞等到第一条结果，再顺带取走已积压的结果，整批处理
+            messages = await transport.pop_batch(RESULT_QUEUE, RESULT_BATCH_SIZE)
+            payloads = []
+            handled = []
+            timelines = {}
+            merged_shards = []
+            try:
+                for message in messages:
+                    try:
+                        data_dict = json.loads(message.data)
+                        sharded = data_dict.get("shardCount") is not None
+                        data_dict = await collect_shard(data_dict)
+                    except Exception as e:
+                        # 单条坏数据不影响整批；stream 模式下不确认，超过投递次数后进死信
+                        logger.error(f"Bad result message: {e}")
+                        SERVER_ERRORS.inc(component="result_monitor", reason="bad_message")
+                        continue
+                    handled.append(message)
+                    if data_dict is None:
+                        # 分片未到齐，等其余分片
+                        continue
+                    if sharded:
+                        merged_shards.append(data_dict["taskSerial"])
+                    timelines[data_dict["taskSerial"]] = pop_timeline(data_dict)
+                    payloads.append(CallbackPayload(**data_dict))
+
+                if payloads:
+                    logger.info(f"Received {len(payloads)} result(s): {', '.join(p.taskSerial for p in payloads[:5])}"
+                                f"{' ...' if len(payloads) > 5 else ''}")
+
+                    # 1. 整批存库，回调同事务写入发件箱
+                    callback_rows = []
+                    for payload in payloads:
+                        user_url = await get_user_callback_url(payload.taskSerial)
+                        if user_url:
+                            callback_rows.append((payload.taskSerial, user_url, payload.json()))
+                        else:
+                            logger.warning(f"No callback URL found for {payload.taskSerial}")
+                    await update_mission_results(payloads, callback_rows, timelines)
+            except Exception:
+                # 没落库：保留暂存的分片，重新投递时再合并
+                await finish_shards(merged_shards, committed=False)
+                raise
+            await finish_shards(merged_shards, committed=True)
+
+            if payloads:
+                for payload in payloads:
+                    RESULT_INDEX.record_result(payload.dict())
+                    MISSIONS_COMPLETED.inc(type=payload.type)
+                    for item in payload.data:
+                        PICTURES_COMPLETED.inc(type=payload.type, result=str(item.result).lower())
+
+                # 2. 唤醒 dispatcher 投递回调
+                CALLBACK_OUTBOX.notify()
+
+            # 3. 落库后确认 (stream 模式)，server 重启时未确认的结果会被重新消费
+            for message in handled:
+                await transport.ack(RESULT_QUEUE, message)
+            ADMISSION.record_completed(len(handled))
         except Exception as e:
             logger.error(f"Monitor Error: {e}")
+            SERVER_ERRORS.inc(component="result_monitor", reason=type(e).__name__)
             await asyncio.sleep(1)
 
+async def retention_monitor():
+    """定期把旧任务分批归档；每批一个写事务，批与批之间让出写连接"""
+    logger.info("Retention job started...")
+    while True:
+        try:
+            archived = purged = 0
+            while RETENTION_DAYS > 0:
+                count = await DB_WRITER.run(lambda db: archive_batch(db, RETENTION_DAYS, RETENTION_BATCH_SIZE))
+                archived += count
+                if count < RETENTION_BATCH_SIZE:
+                    break
+                await asyncio.sleep(0.1)
+            while ARCHIVE_RETENTION_DAYS > 0:
+                count = await DB_WRITER.run(lambda db: purge_archive_batch(db, ARCHIVE_RETENTION_DAYS, RETENTION_BATCH_SIZE))
+                purged += count
+                if count < RETENTION_BATCH_SIZE:
+                    break
+                await asyncio.sleep(0.1)
+            if archived or purged:
+                logger.info(f"🗄️ Archived {archived} mission(s), purged {purged} archived mission(s)")
+        except Exception as e:
+            logger.error(f"Retention Error: {e}")
+            SERVER_ERRORS.inc(component="retention", reason=type(e).__name__)
+        await asyncio.sleep(RETENTION_INTERVAL)
+
 # --- 启动与API ---
 
 @beetle_server.on_event("startup")
 async def startup():
     await init_db()
+    await DB_WRITER.start()
+    await DB_READ_POOL.start()
+    await CALLBACK_CLIENT.start()
+    # 启动回调投递 (含重启前未投递完的回调)
+    CALLBACK_OUTBOX.start()
     # 启动后台监听任务
     asyncio.create_task(result_monitor())
+    asyncio.create_task(retention_monitor())
+
+@beetle_server.on_event("shutdown")
+async def shutdown():
+    await CALLBACK_OUTBOX.close()
+    await DB_WRITER.close()
+    await DB_READ_POOL.close()
+    await CALLBACK_CLIENT.close()
+
+@beetle_server.get("/metrics")
+async def metrics():
+    return PlainTextResponse(await REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 @beetle_server.post("/mission_entry", response_model=StandardResponse)
-async def mission_entry(request: MissionRequest):
+async def mission_entry(request: MissionRequest, response: Response):
+    request.timeline = {"accepted": time.time()}
     try:
+        # 0. 准入控制：队列积压过多时直接拒绝，调用方按 Retry-After 重试
+        decision = await ADMISSION.admit(shard_count(request))
+        if not decision.accepted:
+            logger.warning(f"🚦 Rejected {request.taskSerial}: {decision.reason}")
+            MISSIONS_REJECTED.inc(cause=decision.cause)
+            response.status_code = 429
+            response.headers["Retry-After"] = str(decision.retry_after)
+            return StandardResponse(status=429, error_msg=decision.reason, data={"retryAfter": decision.retry_after})
+
         # 1. 存库
         await save_mission_initial(request)
         
-        # 2. 推送 Redis 任务队列
-        await redis_client.lpush(TASK_QUEUE, request.json())
+        # 2. 推送到对应的优先级通道 (大任务切片后分别入队)
+        shards = split_mission(request)
+        lane = LANES.lane(request.priority, request.type, request.callbackurl)
+        await LANES.push_many(lane, shards, request.priority, request.type)
         
-        logger.info(f"📨 Queued: {request.taskSerial}")
+        logger.info(f"📨 Queued: {request.taskSerial} ({len(shards)} shard(s))")
+        if decision.eta is not None:
+            response.headers["X-Estimated-Completion"] = str(round(decision.eta))
         
         # 3. 返回标准结构
         return StandardResponse(
@@ -199,6 +562,168 @@ async def mission_entry(request: MissionRequest):
         )
     except Exception as e:
         logger.error(f"API Error: {e}")
+        SERVER_ERRORS.inc(component="api", reason=type(e).__name__)
+        return StandardResponse(status=500, error_msg=str(e), data="Server Error")
+
+@beetle_server.get("/callbacks/dead", response_model=StandardResponse)
+async def list_dead_callbacks(limit: int = 100):
+    try:
+        return StandardResponse(status=200, error_msg="", data=await CALLBACK_OUTBOX.list_dead(limit))
+    except Exception as e:
+        logger.error(f"API Error: {e}")
+        SERVER_ERRORS.inc(component="api", reason=type(e).__name__)
+        return StandardResponse(status=500, error_msg=str(e), data="Server Error")
+
+@beetle_server.post("/callbacks/replay", response_model=StandardResponse)
+async def replay_dead_callbacks(request: ReplayRequest):
+    try:
+        count = await CALLBACK_OUTBOX.replay(request.ids, request.taskSerial)
+        logger.info(f"♻️ Replaying {count} dead callback(s)")
+        return StandardResponse(status=200, error_msg="", data={"replayed": count})
+    except Exception as e:
+        logger.error(f"API Error: {e}")
+        SERVER_ERRORS.inc(component="api", reason=type(e).__name__)
+        return StandardResponse(status=500, error_msg=str(e), data="Server Error")
+
+@beetle_server.post("/mission_bulk", response_model=StandardResponse)
+async def mission_bulk(request: Request):
+    """
+    批量导入：请求体为 MissionRequest 的 JSON 数组，或每行一个的 NDJSON (边收边解析)。
+    逐条校验，攒批落库并批量入队，返回每条的处理结果。
+    """
+    items = []
+    batch = []
+
+    async def flush():
+        if not batch:
+            return
+        try:
+            await save_missions_initial([mission for _, mission in batch])
+            by_lane = {}
+            for _, mission in batch:
+                lane = LANES.lane(mission.priority, mission.type, mission.callbackurl)
+                by_lane.setdefault(lane, (mission, []))[1].extend(split_mission(mission))
+            for lane, (mission, shards) in by_lane.items():
+                await LANES.push_many(lane, shards, mission.priority, mission.type)
+            items.extend({"index": idx, "taskSerial": mission.taskSerial, "status": 200, "error_msg": ""}
+                         for idx, mission in batch)
+        except Exception as e:
+            logger.error(f"Bulk batch failed: {e}")
+            SERVER_ERRORS.inc(component="bulk", reason=type(e).__name__)
+            items.extend({"index": idx, "taskSerial": mission.taskSerial, "status": 500, "error_msg": str(e)}
+                         for idx, mission in batch)
+        batch.clear()
+
+    try:
+        async for idx, obj, error in iter_json_items(request.stream()):
+            if error is None:
+                try:
+                    if not isinstance(obj, dict):
+                        raise ValueError("item must be a JSON object")
+                    mission = MissionRequest(**obj)
+                    mission.timeline = {"accepted": time.time()}
+                except (ValidationError, ValueError) as e:
+                    error = str(e)
+                else:
+                    decision = await ADMISSION.admit(shard_count(mission))
+                    if decision.accepted:
+                        batch.append((idx, mission))
+                    else:
+                        MISSIONS_REJECTED.inc(cause=decision.cause)
+                        items.append({"index": idx, "taskSerial": mission.taskSerial, "status": 429,
+                                      "error_msg": decision.reason, "retryAfter": decision.retry_after})
+            if error is not None:
+                task_serial = obj.get("taskSerial") if isinstance(obj, dict) else None
+                items.append({"index": idx, "taskSerial": task_serial, "status": 400, "error_msg": error})
+            if len(batch) >= BULK_BATCH_SIZE:
+                await flush()
+        await flush()
+    except Exception as e:
+        # 连接中断等：已经落库入队的照常返回，剩下的不再处理
+        await flush()
+        logger.error(f"Bulk API Error: {e}")
+        SERVER_ERRORS.inc(component="api", reason=type(e).__name__)
+        return StandardResponse(status=500, error_msg=str(e), data={"items": sorted(items, key=lambda x: x["index"])})
+
+    accepted = sum(1 for item in items if item["status"] == 200)
+    logger.info(f"📨 Bulk queued: {accepted}/{len(items)} mission(s)")
+    return StandardResponse(
+        status=200,
+        error_msg="",
+        data={"accepted": accepted, "rejected": len(items) - accepted, "items": sorted(items, key=lambda x: x["index"])}
+    )
+
+@beetle_server.get("/missions/{task_serial}", response_model=StandardResponse)
+async def mission_status(task_serial: str, wait: float = 0.0):
+    """任务状态与每张图片结果；wait > 0 时长轮询，任务完成或超时后返回"""
+    try:
+        entry = await get_mission_status(task_serial, wait)
+        if entry is None:
+            return StandardResponse(status=404, error_msg="mission not found", data=None)
+        return StandardResponse(status=200, error_msg="", data=entry)
+    except Exception as e:
+        logger.error(f"API Error: {e}")
+        SERVER_ERRORS.inc(component="api", reason=type(e).__name__)
+        return StandardResponse(status=500, error_msg=str(e), data="Server Error")
+
+@beetle_server.get("/missions/{task_serial}/pictures/{pic_id}", response_model=StandardResponse)
+async def picture_status(task_serial: str, pic_id: str, wait: float = 0.0):
+    try:
+        entry = await get_mission_status(task_serial, wait)
+        picture = next((p for p in entry["pictures"] if p["picId"] == pic_id), None) if entry else None
+        if picture is None:
+            return StandardResponse(status=404, error_msg="picture not found", data=None)
+        return StandardResponse(status=200, error_msg="", data=dict(picture, taskSerial=task_serial, status=entry["status"]))
+    except Exception as e:
+        logger.error(f"API Error: {e}")
+        SERVER_ERRORS.inc(component="api", reason=type(e).__name__)
+        return StandardResponse(status=500, error_msg=str(e), data="Server Error")
+
+@beetle_server.get("/results/stream")
+async def results_stream(request: Request, taskSerial: Optional[List[str]] = Query(None)):
+    """
+    SSE 推送结果：result_monitor 每记录一个完成的任务推送一条 event: result。
+    指定 taskSerial (可多个) 时只推送这些任务，已完成的立即推送，全部推送完后关闭连接。
+    """
+    wanted = set(taskSerial or ())
+
+    async def events():
+        with RESULT_INDEX.subscribe(list(wanted)) as queue:
+            for task_serial in list(wanted):
+                entry = RESULT_INDEX.get(task_serial) or await load_mission_status(task_serial)
+                if entry is not None and entry["status"] == "COMPLETED":
+                    wanted.discard(task_serial)
+                    yield sse_event(entry)
+            while taskSerial is None or wanted:
+                if await request.is_disconnected():
+                    break
+                try:
+                    entry = await asyncio.wait_for(queue.get(), SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if entry["taskSerial"] in wanted or taskSerial is None:
+                    wanted.discard(entry["taskSerial"])
+                    yield sse_event(entry)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@beetle_server.get("/timeline/report", response_model=StandardResponse)
+async def timeline_report(window: str = "24h", mission_type: Optional[str] = Query(None, alias="type")):
+    """最近 window 内接收的任务各阶段耗时分位数 (秒)，按任务类型和 all 汇总；命令行版见 timeline.py"""
+    try:
+        (mission_sql, params), (picture_sql, _) = report_queries(parse_window(window), mission_type)
+        async with DB_READ_POOL.connection() as db:
+            async with db.execute(mission_sql, params) as cursor:
+                missions = await cursor.fetchall()
+            async with db.execute(picture_sql, params) as cursor:
+                pictures = await cursor.fetchall()
+        return StandardResponse(status=200, error_msg="", data=summarize(missions, pictures))
+    except ValueError as e:
+        return StandardResponse(status=400, error_msg=str(e), data=None)
+    except Exception as e:
+        logger.error(f"API Error: {e}")
+        SERVER_ERRORS.inc(component="api", reason=type(e).__name__)
         return StandardResponse(status=500, error_msg=str(e), data="Server Error")
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Optional
+
+import aiosqlite
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+DB_COMMIT_SECONDS = Histogram("beetle_db_commit_seconds", "Group-commit transaction latency (BEGIN..COMMIT)")
+DB_BATCH_JOBS = Histogram("beetle_db_batch_jobs", "Write jobs per group commit",
+                          buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+
+class SQLiteWriter:
+    """
+    单一常驻写连接 + 组提交 (group commit)。
+    各请求把写操作 (async def job(db)) 提交到内部队列，写协程一次取出一批，
+    在同一个事务里执行后只 COMMIT 一次，多个请求分摊一次 fsync。
+    每个 job 包在 SAVEPOINT 里，单个 job 出错只回滚它自己，不影响同批其他请求。
+    synchronous 默认不设置 (WAL 下为 FULL，每次提交都 fsync)；设为 NORMAL 提交更快，
+    但机器断电时可能丢失最近提交的事务 (任务结果、待投递回调)，需要显式开启。
+    """
+
+    def __init__(self, db_name: str, max_batch: int = 256, max_delay: float = 0.005,
+                 synchronous: Optional[str] = None):
+        if synchronous and synchronous.upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+            raise ValueError(f"invalid synchronous mode: {synchronous}")
+        self.db_name = db_name
+        self.synchronous = synchronous.upper() if synchronous else None
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._db: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"commits": 0, "jobs": 0, "errors": 0}
+
+    async def start(self):
+        # isolation_level=None: 由这里显式 BEGIN / COMMIT
+        self._db = await aiosqlite.connect(self.db_name, isolation_level=None)
+        await self._db.execute("PRAGMA journal_mode=WAL;")
+        if self.synchronous:
+            # PRAGMA 不支持参数绑定，取值已在构造时校验
+            await self._db.execute(f"PRAGMA synchronous={self.synchronous};")
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def run(self, job: Callable[[aiosqlite.Connection], Awaitable]):
+        """提交一个写操作，等到它所在的批次提交后返回 job 的返回值"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((job, future))
+        return await future
+
+    async def _next_batch(self) -> List:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # 把已经排队的也顺带带上，不再额外等待
+        while len(batch) < self.max_batch and not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            results = []
+            start = time.perf_counter()
+            try:
+                await self._db.execute("BEGIN")
+                for idx, (job, future) in enumerate(batch):
+                    await self._db.execute(f"SAVEPOINT job_{idx}")
+                    try:
+                        results.append((future, await job(self._db), None))
+                        await self._db.execute(f"RELEASE job_{idx}")
+                    except Exception as e:
+                        await self._db.execute(f"ROLLBACK TO job_{idx}")
+                        await self._db.execute(f"RELEASE job_{idx}")
+                        results.append((future, None, e))
+                await self._db.execute("COMMIT")
+            except Exception as e:
+                # 整批提交失败：所有等待者都拿到异常
+                logger.error(f"DB commit failed for batch of {len(batch)}: {e}")
+                self.stats["errors"] += len(batch)
+                try:
+                    await self._db.execute("ROLLBACK")
+                except Exception:
+                    pass
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - start)
+            DB_BATCH_JOBS.observe(len(batch))
+            self.stats["commits"] += 1
+            self.stats["jobs"] += len(batch)
+            for future, value, error in results:
+                if future.done():
+                    continue
+                if error is not None:
+                    self.stats["errors"] += 1
+                    future.set_exception(error)
+                else:
+                    future.set_result(value)
+
+
+class SQLiteReadPool:
+    """只读连接池，WAL 模式下读不阻塞写"""
+
+    def __init__(self, db_name: str, size: int = 4):
+        self.db_name = db_name
+        self.size = size
+        self._pool: asyncio.Queue = asyncio.Queue()
+        self._conns = []
+
+    async def start(self):
+        for _ in range(self.size):
+            db = await aiosqlite.connect(self.db_name)
+            self._conns.append(db)
+            self._pool.put_nowait(db)
+
+    async def close(self):
+        for db in self._conns:
+            await db.close()
+        self._conns = []
+
+    @asynccontextmanager
+    async def connection(self):
+        db = await self._pool.get()
+        try:
+            yield db
+        finally:
+            self._pool.put_nowait(db)
@@ -0,0 +1,343 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+import argparse
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueMessage:
+    def __init__(self, data: str, msg_id: Optional[str] = None, queue: Optional[str] = None):
+        self.data = data
+        self.msg_id = msg_id  # list 模式下为 None
+        self.queue = queue    # 消息来自哪个队列，多队列 (优先级通道) 时用于确认
+
+
+def default_consumer_name() -> str:
+    return os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class ListTransport:
+    """原来的 LPUSH / BRPOP 队列，取出即删除，没有确认机制"""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+
+    async def push(self, queue: str, data: str):
+        await self.redis_client.lpush(queue, data)
+
+    async def push_many(self, queue: str, datas: List[str]):
+        """一次 LPUSH 多个值，出队顺序与列表顺序一致"""
+        if datas:
+            await self.redis_client.lpush(queue, *datas)
+
+    async def backlog(self, queue: str) -> int:
+        return await self.redis_client.llen(queue)
+
+    async def pop(self, queue: str) -> QueueMessage:
+        while True:
+            result = await self.redis_client.brpop(queue, timeout=0)
+            if result:
+                return QueueMessage(result[1], queue=queue)
+
+    async def pop_nowait(self, queue: str) -> Optional[QueueMessage]:
+        data = await self.redis_client.rpop(queue)
+        return QueueMessage(data, queue=queue) if data is not None else None
+
+    async def pop_any(self, queues: List[str], timeout: float) -> Optional[QueueMessage]:
+        """BRPOP 同时阻塞在多个队列上，按 queues 的顺序优先"""
+        result = await self.redis_client.brpop(queues, timeout=max(1, int(timeout)))
+        return QueueMessage(result[1], queue=result[0]) if result else None
+
+    async def pop_batch(self, queue: str, max_count: int) -> List[QueueMessage]:
+        """阻塞取到第一条后，用 RPOP count 一次性取走已积压的其余消息"""
+        first = await self.pop(queue)
+        rest = await self.redis_client.rpop(queue, max_count - 1) if max_count > 1 else None
+        return [first] + [QueueMessage(data, queue=queue) for data in (rest or [])]
+
+    async def ack(self, queue: str, message: QueueMessage):
+        pass
+
+    @asynccontextmanager
+    async def keepalive(self, queue: str, message: QueueMessage):
+        yield
+
+
+class StreamTransport:
+    """
+    基于 Redis Streams 消费组的队列：
+    - XADD 入队，XREADGROUP 出队，处理完 XACK；worker 挂掉时消息留在 PEL (pending entries list)
+    - 空闲超过 idle_timeout 的 pending 消息由其他消费者 XAUTOCLAIM 接管
+    - 投递次数超过 max_deliveries 的消息转入死信流并确认，避免毒消息无限重试
+    - 处理耗时较长的消息用 keepalive() 定期 XCLAIM 给自己，刷新空闲时间，防止被误接管；
+      pop_any 暂存的消息也在 keepalive 里一起续约，取出时确认仍归自己所有再返回
+    - backlog() 用消费组的 lag (Redis 7+)；旧版本没有 lag 时数 last-delivered-id 之后的条目，最多数 backlog_scan_limit 条
+    队列名沿用 queue:xxx，对应的 stream key 为 stream:xxx，死信为 stream:xxx:dead。
+    """
+
+    def __init__(self, redis_client, group: str, consumer: Optional[str] = None, idle_timeout: float = 300.0,
+                 max_deliveries: int = 5, maxlen: int = 100000, block: float = 5.0, backlog_scan_limit: int = 10000):
+        self.redis_client = redis_client
+        self.group = group
+        self.consumer = consumer or default_consumer_name()
+        self.idle_timeout_ms = int(idle_timeout * 1000)
+        self.max_deliveries = max_deliveries
+        self.maxlen = maxlen
+        self.block_ms = int(block * 1000)
+        self.backlog_scan_limit = backlog_scan_limit
+        self._ready = set()
+        self._last_reclaim = {}
+        # 多 stream 的 XREADGROUP 每个 stream 都可能返回一条，已进入本消费者 PEL 的多余消息暂存在这里，
+        # 后续的 pop 优先返回，不会滞留到空闲超时后被接管 (还白白消耗一次投递次数)
+        self._buffered: Dict[str, Deque[QueueMessage]] = {}
+
+    @staticmethod
+    def stream_key(queue: str) -> str:
+        return "stream:" + queue.split(":", 1)[-1]
+
+    async def _ensure_group(self, key: str):
+        if key in self._ready:
+            return
+        try:
+            await self.redis_client.xgroup_create(key, self.group, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._ready.add(key)
+
+    async def push(self, queue: str, data: str):
+        await self.redis_client.xadd(self.stream_key(queue), {"data": data}, maxlen=self.maxlen, approximate=True)
+
+    async def push_many(self, queue: str, datas: List[str]):
+        """pipeline 批量 XADD，一次往返"""
+        if not datas:
+            return
+        key = self.stream_key(queue)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for data in datas:
+                pipe.xadd(key, {"data": data}, maxlen=self.maxlen, approximate=True)
+            await pipe.execute()
+
+    async def backlog(self, queue: str) -> int:
+        """尚未被确认的消息数：各消费组 lag + pending 的最大值 (lag 需要 Redis 7，旧版本只计 pending)"""
+        key = self.stream_key(queue)
+        try:
+            groups = await self.redis_client.xinfo_groups(key)
+        except Exception:
+            return 0  # stream 还不存在
+        if not groups:
+            return await self.redis_client.xlen(key)
+        backlog = 0
+        for group in groups:
+            lag = group.get("lag")
+            if lag is None:
+                # Redis 7 之前没有 lag：数还没投递给该组的条目，积压很大时只数到上限
+                undelivered = await self.redis_client.xrange(key, "(" + group["last-delivered-id"], "+",
+                                                             count=self.backlog_scan_limit)
+                lag = len(undelivered)
+            backlog = max(backlog, lag + group.get("pending", 0))
+        return backlog
+
+    async def _reclaim(self, key: str) -> Optional[QueueMessage]:
+        """接管其他消费者空闲过久的 pending 消息"""
+        now = time.monotonic()
+        if now - self._last_reclaim.get(key, 0.0) < self.block_ms / 1000:
+            return None
+        self._last_reclaim[key] = now
+
+        while True:
+            result = await self.redis_client.xautoclaim(key, self.group, self.consumer,
+                                                        min_idle_time=self.idle_timeout_ms, start_id="0-0", count=1)
+            claimed = result[1]
+            if not claimed:
+                return None
+            msg_id, fields = claimed[0]
+            if not fields:
+                # 消息体已被 MAXLEN 裁掉，只能确认丢弃
+                await self.redis_client.xack(key, self.group, msg_id)
+                continue
+
+            pending = await self.redis_client.xpending_range(key, self.group, min=msg_id, max=msg_id, count=1)
+            deliveries = pending[0]["times_delivered"] if pending else 1
+            if deliveries > self.max_deliveries:
+                logger.error(f"☠️ Dead-lettering {key} {msg_id} after {deliveries} deliveries")
+                await self.redis_client.xadd(f"{key}:dead", dict(fields, deliveries=str(deliveries)))
+                await self.redis_client.xack(key, self.group, msg_id)
+                continue
+
+            logger.warning(f"♻️ Reclaimed {key} {msg_id} (delivery #{deliveries})")
+            return QueueMessage(fields["data"], msg_id)
+
+    async def _renew(self, queue: str, messages: List[QueueMessage]) -> List[QueueMessage]:
+        """刷新暂存消息的空闲时间，返回仍归本消费者的消息 (已被其他消费者接管的不再处理)"""
+        key = self.stream_key(queue)
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for message in messages:
+                pipe.xpending_range(key, self.group, min=message.msg_id, max=message.msg_id, count=1,
+                                    consumername=self.consumer)
+            owned = [message for message, pending in zip(messages, await pipe.execute()) if pending]
+        if owned:
+            # JUSTID 不增加投递次数
+            await self.redis_client.xclaim(key, self.group, self.consumer, 0, [m.msg_id for m in owned], justid=True)
+        for message in messages:
+            if message not in owned:
+                logger.warning(f"Buffered {key} {message.msg_id} was taken over by another consumer, skipping")
+        return owned
+
+    async def _renew_buffered(self):
+        for queue, buffered in list(self._buffered.items()):
+            if not buffered:
+                continue
+            owned = await self._renew(queue, list(buffered))
+            for message in list(buffered):
+                if message not in owned:
+                    buffered.remove(message)
+
+    async def _take_buffered(self, queues: List[str], renew: bool = True) -> Optional[QueueMessage]:
+        """renew=False 用于刚读出来的消息，不必再确认归属"""
+        for queue in queues:
+            buffered = self._buffered.get(queue)
+            while buffered:
+                message = buffered.popleft()
+                if not renew or await self._renew(queue, [message]):
+                    return message
+        return None
+
+    async def pop_nowait(self, queue: str) -> Optional[QueueMessage]:
+        message = await self._take_buffered([queue])
+        if message is not None:
+            return message
+        key = self.stream_key(queue)
+        await self._ensure_group(key)
+        message = await self._reclaim(key)
+        if message is None:
+            result = await self.redis_client.xreadgroup(self.group, self.consumer, {key: ">"}, count=1)
+            if not result:
+                return None
+            msg_id, fields = result[0][1][0]
+            message = QueueMessage(fields["data"], msg_id)
+        message.queue = queue
+        return message
+
+    async def pop_any(self, queues: List[str], timeout: float) -> Optional[QueueMessage]:
+        """XREADGROUP 同时阻塞在多个 stream 上 (只读新消息，pending 的接管由 pop_nowait 负责)"""
+        message = await self._take_buffered(queues)
+        if message is not None:
+            return message
+        keys = {self.stream_key(queue): queue for queue in queues}
+        for key in keys:
+            await self._ensure_group(key)
+        result = await self.redis_client.xreadgroup(self.group, self.consumer, {key: ">" for key in keys},
+                                                    count=1, block=int(timeout * 1000))
+        if not result:
+            return None
+        # 结果按 queues 的顺序排列，返回第一条，其余的暂存
+        for key, messages in result:
+            for msg_id, fields in messages:
+                queue = keys[key]
+                self._buffered.setdefault(queue, deque()).append(QueueMessage(fields["data"], msg_id, queue=queue))
+        return await self._take_buffered(queues, renew=False)
+
+    async def pop(self, queue: str) -> QueueMessage:
+        return (await self.pop_batch(queue, 1))[0]
+
+    async def pop_batch(self, queue: str, max_count: int) -> List[QueueMessage]:
+        message = await self._take_buffered([queue])
+        if message is not None:
+            return [message]
+        key = self.stream_key(queue)
+        await self._ensure_group(key)
+        while True:
+            message = await self._reclaim(key)
+            if message:
+                message.queue = queue
+                return [message]
+            result = await self.redis_client.xreadgroup(self.group, self.consumer, {key: ">"},
+                                                        count=max_count, block=self.block_ms)
+            if result:
+                return [QueueMessage(fields["data"], msg_id, queue=queue) for msg_id, fields in result[0][1]]
+
+    async def ack(self, queue: str, message: QueueMessage):
+        await self.redis_client.xack(self.stream_key(queue), self.group, message.msg_id)
+
+    @asynccontextmanager
+    async def keepalive(self, queue: str, message: QueueMessage):
+        key = self.stream_key(queue)
+
+        async def beat():
+            while True:
+                await asyncio.sleep(self.idle_timeout_ms / 3000)
+                try:
+                    # 重新认领给自己以刷新空闲时间 (JUSTID 不增加投递次数)
+                    await self.redis_client.xclaim(key, self.group, self.consumer, 0, [message.msg_id], justid=True)
+                    # 处理期间 pop_any 暂存的消息还没开始处理，同样需要续约
+                    await self._renew_buffered()
+                except Exception as e:
+                    logger.warning(f"Keepalive failed for {message.msg_id}: {e}")
+
+        task = asyncio.create_task(beat())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+
+def make_transport(redis_client, group: str, kind: Optional[str] = None):
+    """QUEUE_TRANSPORT=list (默认) / stream，server 与 worker 需配置一致"""
+    kind = kind or os.getenv("QUEUE_TRANSPORT", "list")
+    if kind == "stream":
+        return StreamTransport(
+            redis_client, group,
+            idle_timeout=float(os.getenv("STREAM_IDLE_TIMEOUT", "300")),
+            max_deliveries=int(os.getenv("STREAM_MAX_DELIVERIES", "5")),
+            maxlen=int(os.getenv("STREAM_MAXLEN", "100000")),
+        )
+    return ListTransport(redis_client)
+
+
+# --- 本地 Redis 自检：python stream_transport.py --redis redis://localhost:6380 ---
+
+async def self_check(redis_url: str):
+    import redis.asyncio as redis
+
+    client = redis.from_url(redis_url, decode_responses=True)
+    queue = f"queue:selfcheck:{os.getpid()}"
+    key = StreamTransport.stream_key(queue)
+    a = StreamTransport(client, "selfcheck", consumer="a", idle_timeout=0.2, max_deliveries=2, block=0.1)
+    b = StreamTransport(client, "selfcheck", consumer="b", idle_timeout=0.2, max_deliveries=2, block=0.1)
+    try:
+        await a.push(queue, "m1")
+        msg = await a.pop(queue)
+        assert msg.data == "m1"
+        # a 没有确认就 "挂掉"，b 在空闲超时后接管
+        await asyncio.sleep(0.3)
+        reclaimed = await b.pop(queue)
+        assert reclaimed.msg_id == msg.msg_id, "pending message was not reclaimed"
+        await b.ack(queue, reclaimed)
+        assert (await client.xpending(key, "selfcheck"))["pending"] == 0
+        # 超过最大投递次数进入死信
+        await a.push(queue, "poison")
+        await a.pop(queue)
+        await asyncio.sleep(0.3)
+        await b.pop(queue)
+        await asyncio.sleep(0.3)
+        await b.push(queue, "after")
+        assert (await a.pop(queue)).data == "after"
+        assert await client.xlen(f"{key}:dead") == 1, "poison message was not dead-lettered"
+        print("✅ stream transport self-check passed")
+    finally:
+        await client.delete(key, f"{key}:dead")
+        await client.aclose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--redis", type=str, default="redis://localhost:6380", help="Redis 地址")
+    args = parser.parse_args()
+
+    asyncio.run(self_check(args.redis))
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# beetle_test 下的模块按脚本方式互相导入 (from stream_transport import ...)，测试里同样从这个目录导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
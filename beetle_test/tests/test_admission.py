@@ -0,0 +1,64 @@
+import asyncio
+
+from admission import AdmissionController
+
+
+class Backlog:
+    """可调的队列积压，记录被查询的次数"""
+
+    def __init__(self, value: int = 0):
+        self.value = value
+        self.calls = 0
+
+    async def __call__(self) -> int:
+        self.calls += 1
+        return self.value
+
+
+def admit(controller, messages=1):
+    return asyncio.run(controller.admit(messages))
+
+
+def test_rejects_over_backlog_with_retry_after_from_throughput():
+    controller = AdmissionController(Backlog(95), max_backlog=100)
+    controller.record_completed(60)  # 刚启动时按 1 秒算：60 条/秒
+    decision = admit(controller, 10)
+    assert not decision.accepted
+    assert decision.cause == "backlog"
+    assert decision.retry_after == 1  # 超出 5 条 / 60 条每秒，按下限取整
+    assert admit(controller, 5).accepted
+
+
+def test_empty_queue_always_accepts_large_mission():
+    controller = AdmissionController(Backlog(0), max_backlog=10)
+    assert admit(controller, 50).accepted
+
+
+def test_accepted_messages_count_until_next_refresh():
+    backlog = Backlog(0)
+    controller = AdmissionController(backlog, max_backlog=10, refresh_interval=60)
+
+    async def run():
+        return [(await controller.admit(4)).accepted for _ in range(4)]
+
+    # 两次查询之间的突发请求也计入本地积压
+    assert asyncio.run(run()) == [True, True, False, False]
+    assert backlog.calls == 1
+    assert controller.stats == {"accepted": 2, "rejected": 2}
+
+
+def test_rejects_when_eta_exceeds_slo():
+    controller = AdmissionController(Backlog(50), max_backlog=0, slo_seconds=10)
+    controller.record_completed(4)
+    decision = admit(controller, 1)
+    assert not decision.accepted and decision.cause == "slo"
+    assert decision.eta > 10
+    # 积压降到 SLO 以内 (4 条/秒 * 10 秒) 大约需要的时间
+    assert decision.retry_after == 3
+
+
+def test_without_throughput_uses_default_retry_after():
+    controller = AdmissionController(Backlog(10), max_backlog=5, default_retry_after=30)
+    decision = admit(controller)
+    assert not decision.accepted and decision.eta is None
+    assert decision.retry_after == 30
@@ -0,0 +1,53 @@
+import asyncio
+
+from bulk_ingest import iter_json_items
+
+
+def parse(body: bytes, chunk_size: int = 0, max_item_bytes: int = 1024 * 1024):
+    async def chunks():
+        step = chunk_size or len(body) or 1
+        for i in range(0, len(body), step):
+            yield body[i:i + step]
+
+    async def collect():
+        return [item async for item in iter_json_items(chunks(), max_item_bytes)]
+    return asyncio.run(collect())
+
+
+def test_ndjson_bad_line_only_affects_itself():
+    body = b'{"a": 1}\n{bad\n\n{"a": 3}\n'
+    items = parse(body)
+    assert [(idx, obj) for idx, obj, err in items if err is None] == [(0, {"a": 1}), (2, {"a": 3})]
+    assert items[1][0] == 1 and items[1][2].startswith("invalid JSON")
+
+
+def test_ndjson_last_line_without_newline():
+    assert parse(b'{"a": 1}\n{"a": 2}') == [(0, {"a": 1}, None), (1, {"a": 2}, None)]
+
+
+def test_array_split_across_chunks():
+    body = '  [{"a": 1}, {"b": "汉字"}, 12345]'.encode("utf-8")
+    # 逐字节送入：多字节字符和数字都会被截断在块边界上
+    assert parse(body, chunk_size=1) == [(0, {"a": 1}, None), (1, {"b": "汉字"}, None), (2, 12345, None)]
+
+
+def test_array_trailing_comma_rejected():
+    items = parse(b'[{"a": 1}, ]')
+    assert items[0] == (0, {"a": 1}, None)
+    assert items[1][2] == "trailing ',' before ']'"
+
+
+def test_array_missing_comma_and_truncation():
+    assert parse(b'[{"a": 1} {"a": 2}]')[-1][2] == "expected ',' between array items"
+    assert parse(b'[{"a": 1}, {"a"')[-1][2].startswith("invalid JSON")
+    assert parse(b'[{"a": 1}')[-1][2] == "unexpected end of array"
+
+
+def test_empty_bodies():
+    assert parse(b"") == []
+    assert parse(b"  []  ") == []
+
+
+def test_oversized_ndjson_line():
+    items = parse(b'{"a": "' + b"x" * 100 + b'"}\n', chunk_size=10, max_item_bytes=50)
+    assert items == [(0, None, "line exceeds 50 bytes")]
@@ -0,0 +1,256 @@
+import asyncio
+import time
+
+import aiosqlite
+
+from callback_outbox import CallbackOutbox
+from db_migrations import migrate
+from sqlite_writer import SQLiteReadPool, SQLiteWriter
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+
+class FakeClient:
+    """按主机返回固定状态码；hang 中的主机一直不返回"""
+
+    def __init__(self, codes: dict, hang=()):
+        self.codes = codes
+        self.hang = set(hang)
+        self.posts = []
+        self._never = asyncio.Event()
+
+    async def post(self, url, json=None):
+        self.posts.append(url)
+        host = url.split("/")[2]
+        if host in self.hang:
+            await self._never.wait()
+        return FakeResponse(self.codes.get(host, 200))
+
+
+async def open_outbox(db_path, client, **kwargs):
+    db = await aiosqlite.connect(db_path, isolation_level=None)
+    await migrate(db)
+    await db.close()
+    writer, pool = SQLiteWriter(str(db_path)), SQLiteReadPool(str(db_path), size=2)
+    await writer.start()
+    await pool.start()
+    outbox = CallbackOutbox(writer, pool, client, asyncio.Semaphore(50), poll_interval=0.01, **kwargs)
+    return outbox, writer, pool
+
+
+async def add_callbacks(writer, rows):
+    async def job(db):
+        for task_serial, _, _ in rows:
+            await db.execute("INSERT OR IGNORE INTO missions (task_serial, callback_status, status) "
+                             "VALUES (?, 'WAITING', 'COMPLETED')", (task_serial,))
+        await CallbackOutbox.enqueue(db, rows)
+    await writer.run(job)
+
+
+async def fetch(pool, sql, params=()):
+    async with pool.connection() as db:
+        async with db.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+
+async def wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await predicate():
+            return True
+        await asyncio.sleep(0.01)
+    return False
+
+
+def test_backoff_grows_with_jitter_and_cap():
+    outbox = CallbackOutbox(None, None, None, None, base_backoff=2.0, max_backoff=600.0)
+    for attempts in range(12):
+        expected = min(600.0, 2.0 * 2 ** attempts)
+        delay = outbox.backoff(attempts)
+        assert expected * 0.5 <= delay <= expected * 1.5
+
+
+def test_delivery_marks_success(tmp_path):
+    async def run():
+        outbox, writer, pool = await open_outbox(tmp_path / "m.db", FakeClient({}))
+        try:
+            await add_callbacks(writer, [("T1", "http://ok:1/cb", "{}")])
+            outbox.start()
+            assert await wait_for(lambda: _status(pool, "T1", "DELIVERED"))
+            return await fetch(pool, "SELECT callback_status, callback_delivered_at FROM missions")
+        finally:
+            await outbox.close()
+            await writer.close()
+            await pool.close()
+
+    [(status, delivered_at)] = asyncio.run(run())
+    assert status == "SUCCESS" and delivered_at is not None
+
+
+def test_failure_backs_off_then_dead_letters_and_replays(tmp_path):
+    async def run():
+        client = FakeClient({"bad:1": 500})
+        outbox, writer, pool = await open_outbox(tmp_path / "m.db", client, max_attempts=3, base_backoff=0.05,
+                                                 max_backoff=0.05)
+        try:
+            await add_callbacks(writer, [("T1", "http://bad:1/cb", "{}")])
+            outbox.start()
+            # 第一次失败后排到退避时间之后重试
+            assert await wait_for(lambda: _attempts(pool, 1))
+            (next_at, mission_status), = await fetch(
+                pool, "SELECT o.next_attempt_at, m.callback_status FROM callback_outbox o "
+                      "JOIN missions m ON m.task_serial = o.task_serial")
+            assert mission_status == "RETRYING" and next_at > time.time() - 0.05
+
+            assert await wait_for(lambda: _status(pool, "T1", "DEAD"))
+            dead = await outbox.list_dead()
+            mission = await fetch(pool, "SELECT callback_status FROM missions")
+            posts = len(client.posts)
+
+            # 重放后恢复投递
+            client.codes.clear()
+            replayed = await outbox.replay(task_serial="T1")
+            assert await wait_for(lambda: _status(pool, "T1", "DELIVERED"))
+            return dead, mission, posts, replayed
+        finally:
+            await outbox.close()
+            await writer.close()
+            await pool.close()
+
+    dead, mission, posts, replayed = asyncio.run(run())
+    assert posts == 3
+    assert [(d["taskSerial"], d["attempts"], d["lastError"]) for d in dead] == [("T1", 3, "HTTP 500")]
+    assert mission == [("DEAD",)]
+    assert replayed == 1
+
+
+def test_saturated_host_does_not_block_other_hosts(tmp_path):
+    async def run():
+        client = FakeClient({}, hang={"hung:1"})
+        outbox, writer, pool = await open_outbox(tmp_path / "m.db", client, per_host_limit=2, batch_size=5)
+        try:
+            await add_callbacks(writer, [(f"H{i}", "http://hung:1/cb", "{}") for i in range(50)])
+            await add_callbacks(writer, [("GOOD", "http://ok:1/cb", "{}")])
+            outbox.start()
+            delivered = await wait_for(lambda: _status(pool, "GOOD", "DELIVERED"))
+            return delivered, outbox.inflight
+        finally:
+            await outbox.close()
+            await writer.close()
+            await pool.close()
+
+    delivered, inflight = asyncio.run(run())
+    assert delivered
+    assert inflight == 2  # 挂住的主机只占 per_host_limit 个投递
+
+
+def test_hung_hosts_cannot_take_every_global_slot(tmp_path):
+    async def run():
+        client = FakeClient({}, hang={"hung1:1", "hung2:1", "hung3:1"})
+        outbox, writer, pool = await open_outbox(tmp_path / "m.db", client, per_host_limit=10, global_host_share=3)
+        outbox.global_limit = asyncio.Semaphore(10)
+        try:
+            for host in ("hung1:1", "hung2:1", "hung3:1"):
+                await add_callbacks(writer, [(f"{host}-{i}", f"http://{host}/cb", "{}") for i in range(20)])
+            await add_callbacks(writer, [("GOOD", "http://ok:1/cb", "{}")])
+            outbox.start()
+            delivered = await wait_for(lambda: _status(pool, "GOOD", "DELIVERED"))
+            return delivered, outbox.inflight
+        finally:
+            await outbox.close()
+            await writer.close()
+            await pool.close()
+
+    delivered, inflight = asyncio.run(run())
+    assert delivered
+    assert inflight == 9  # 3 个挂住的主机各占 global_host_share 个全局名额，还剩 1 个给健康主机
+
+
+def test_failing_host_is_probed_one_at_a_time(tmp_path):
+    async def run():
+        client = FakeClient({"bad:1": 500})
+        outbox, writer, pool = await open_outbox(tmp_path / "m.db", client, per_host_limit=4, base_backoff=10)
+        try:
+            await add_callbacks(writer, [("T1", "http://bad:1/cb", "{}")])
+            outbox.start()
+            assert await wait_for(lambda: _attempts(pool, 1))
+            failing = outbox._host_limit("bad:1")
+            # 对方恢复后把重试时间提前，成功一次即恢复并发
+            client.codes.clear()
+            await writer.run(lambda db: db.execute("UPDATE callback_outbox SET next_attempt_at = 0"))
+            outbox.notify()
+            assert await wait_for(lambda: _status(pool, "T1", "DELIVERED"))
+            return failing, outbox._host_limit("bad:1")
+        finally:
+            await outbox.close()
+            await writer.close()
+            await pool.close()
+
+    assert asyncio.run(run()) == (1, 4)
+
+
+class FlakyWriter:
+    """前 failures 次写入失败，模拟落库出错"""
+
+    def __init__(self, writer, failures: int):
+        self.writer = writer
+        self.failures = failures
+
+    async def run(self, job):
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        return await self.writer.run(job)
+
+
+def test_delivered_callback_is_not_resent_when_status_update_fails(tmp_path):
+    async def run():
+        client = FakeClient({})
+        outbox, writer, pool = await open_outbox(tmp_path / "m.db", client)
+        try:
+            await add_callbacks(writer, [("T1", "http://ok:1/cb", "{}")])
+            outbox.writer = FlakyWriter(writer, failures=2)
+            outbox.start()
+            assert await wait_for(lambda: _status(pool, "T1", "DELIVERED"), timeout=5)
+            return len(client.posts)
+        finally:
+            await outbox.close()
+            await writer.close()
+            await pool.close()
+
+    assert asyncio.run(run()) == 1
+
+
+def test_replay_reports_status(tmp_path):
+    async def run():
+        statuses = []
+        outbox, writer, pool = await open_outbox(tmp_path / "m.db", FakeClient({"bad:1": 500}), max_attempts=1,
+                                                 on_status=lambda serial, status: statuses.append((serial, status)))
+        try:
+            await add_callbacks(writer, [("T1", "http://bad:1/cb", "{}")])
+            outbox.start()
+            assert await wait_for(lambda: _status(pool, "T1", "DEAD"))
+            await outbox.close()
+            assert await outbox.replay() == 1
+            return statuses, await fetch(pool, "SELECT callback_status FROM missions")
+        finally:
+            await outbox.close()
+            await writer.close()
+            await pool.close()
+
+    statuses, mission = asyncio.run(run())
+    assert statuses == [("T1", "DEAD"), ("T1", "WAITING")]
+    assert mission == [("WAITING",)]
+
+
+async def _status(pool, task_serial, status):
+    rows = await fetch(pool, "SELECT status FROM callback_outbox WHERE task_serial = ?", (task_serial,))
+    return rows == [(status,)]
+
+
+async def _attempts(pool, attempts):
+    rows = await fetch(pool, "SELECT attempts FROM callback_outbox")
+    return bool(rows) and rows[0][0] >= attempts
@@ -0,0 +1,115 @@
+import asyncio
+
+import aiosqlite
+
+from db_migrations import MIGRATIONS, SCHEMA_VERSION, archive_batch, migrate
+
+
+async def connect(path):
+    return await aiosqlite.connect(path, isolation_level=None)
+
+
+async def columns(db, table):
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+
+async def scalar(db, sql, params=()):
+    async with db.execute(sql, params) as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def make_v1(path):
+    """按 v1 的表结构建库，并写入老版本会产生的重复图片行"""
+    db = await connect(path)
+    for sql in MIGRATIONS[0][2]:
+        await db.execute(sql)
+    await db.execute("PRAGMA user_version = 1")
+    await db.execute("INSERT INTO missions (task_serial, type, callbackurl, callback_status, status) "
+                     "VALUES ('T1', 'is_spill', 'http://h:1/cb?x=1', 'WAITING', 'COMPLETED')")
+    await db.executemany("INSERT INTO pictures (task_serial, pic_id, download_url, result, reason) "
+                         "VALUES ('T1', ?, 'http://img', ?, ?)",
+                         [("p1", 0, "old"), ("p1", 1, "new"), ("p2", 0, "only")])
+    await db.execute("INSERT INTO callback_outbox (task_serial, url, payload, status, next_attempt_at) "
+                     "VALUES ('T1', 'http://h:1/cb?x=1', '{}', 'PENDING', 0)")
+    return db
+
+
+def test_fresh_database_reaches_latest_version(tmp_path):
+    async def run():
+        db = await connect(tmp_path / "m.db")
+        try:
+            before = await migrate(db)
+            return before, await scalar(db, "PRAGMA user_version"), await migrate(db)
+        finally:
+            await db.close()
+
+    assert asyncio.run(run()) == (0, SCHEMA_VERSION, SCHEMA_VERSION)
+
+
+def test_upgrade_from_v1(tmp_path):
+    async def run():
+        db = await make_v1(tmp_path / "m.db")
+        try:
+            before = await migrate(db)
+            async with db.execute("SELECT pic_id, reason FROM pictures ORDER BY pic_id") as cursor:
+                pictures = await cursor.fetchall()
+            return (before, await scalar(db, "PRAGMA user_version"), pictures,
+                    await columns(db, "missions"), await columns(db, "pictures"),
+                    await scalar(db, "SELECT host FROM callback_outbox"))
+        finally:
+            await db.close()
+
+    before, version, pictures, mission_cols, picture_cols, host = asyncio.run(run())
+    assert (before, version) == (1, SCHEMA_VERSION)
+    # 重复的 (task_serial, pic_id) 只保留最新一行
+    assert pictures == [("p1", "new"), ("p2", "only")]
+    assert {"accepted_at", "enqueued_at", "result_received_at", "callback_delivered_at"} <= mission_cols
+    assert {"worker", "dequeued_at", "inference_end_at", "prompt_version"} <= picture_cols
+    assert host == "h:1"
+
+
+def test_unique_index_rejects_duplicate_pictures(tmp_path):
+    async def run():
+        db = await connect(tmp_path / "m.db")
+        try:
+            await migrate(db)
+            await db.execute("INSERT INTO pictures (task_serial, pic_id) VALUES ('T1', 'p1')")
+            try:
+                await db.execute("INSERT INTO pictures (task_serial, pic_id) VALUES ('T1', 'p1')")
+            except aiosqlite.IntegrityError:
+                return True
+            return False
+        finally:
+            await db.close()
+
+    assert asyncio.run(run())
+
+
+def test_archive_batch_moves_completed_missions(tmp_path):
+    async def run():
+        db = await make_v1(tmp_path / "m.db")
+        try:
+            await migrate(db)
+            await db.execute("UPDATE missions SET updated_at = datetime('now', '-10 days'), accepted_at = 1.5")
+            await db.execute("UPDATE pictures SET worker = 'w1', prompt_version = 'v1'")
+            # 还有待投递回调的任务不归档
+            pending = await archive_batch(db, retention_days=7, limit=10)
+            await db.execute("UPDATE callback_outbox SET status = 'DELIVERED'")
+            moved = await archive_batch(db, retention_days=7, limit=10)
+            async with db.execute("SELECT accepted_at FROM missions_archive") as cursor:
+                archived = await cursor.fetchall()
+            async with db.execute("SELECT pic_id, worker, prompt_version FROM pictures_archive "
+                                  "ORDER BY pic_id") as cursor:
+                archived_pictures = await cursor.fetchall()
+            left = [await scalar(db, f"SELECT COUNT(*) FROM {table}")
+                    for table in ("missions", "pictures", "callback_outbox")]
+            return pending, moved, archived, archived_pictures, left
+        finally:
+            await db.close()
+
+    pending, moved, archived, archived_pictures, left = asyncio.run(run())
+    assert (pending, moved) == (0, 1)
+    assert archived == [(1.5,)]
+    assert archived_pictures == [("p1", "w1", "v1"), ("p2", "w1", "v1")]
+    assert left == [0, 0, 0]
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from infer_scheduler import InferScheduler
+
+
+def settle(scheduler, latency_at, rounds=2000):
+    """按当前档位给出延迟，模拟一直有请求排队的后端，返回最后 500 次观测里出现过的档位"""
+    seen = []
+    for _ in range(rounds):
+        level = int(scheduler.limit)
+        scheduler._observe(latency_at(level), True, True)
+        seen.append(int(scheduler.limit))
+    return sorted(set(seen[-500:]))
+
+
+def test_latency_rising_with_throughput_uses_all_slots():
+    # 每多一个槽位单请求延迟 +35%，但总吞吐仍在涨
+    scheduler = InferScheduler(max_parallel=4)
+    assert settle(scheduler, lambda k: 0.01 * (1 + 0.35 * (k - 1))) == [4]
+
+
+@pytest.mark.parametrize("latency_at, best", [
+    (lambda k: 0.01 * k ** 1.5, 1),                   # 并发越高吞吐越低
+    (lambda k: 0.01 * max(1.0, k / 2) ** 1.3, 2),     # 两个槽位之后开始变差
+])
+def test_settles_at_best_throughput_level(latency_at, best):
+    scheduler = InferScheduler(max_parallel=4)
+    assert settle(scheduler, latency_at) == [best]
+
+
+def test_latency_spike_at_same_level_decreases():
+    scheduler = InferScheduler(max_parallel=4)
+    settle(scheduler, lambda k: 0.01)
+    assert int(scheduler.limit) == 4
+    for _ in range(10):
+        scheduler._observe(0.05, True, True)
+    assert int(scheduler.limit) < 4
+
+
+def test_error_decreases_and_non_adaptive_stays_fixed():
+    scheduler = InferScheduler(max_parallel=4)
+    settle(scheduler, lambda k: 0.01)
+    scheduler._observe(0.01, False, True)
+    assert int(scheduler.limit) == 2
+
+    fixed = InferScheduler(max_parallel=4, adaptive=False)
+    fixed._observe(1.0, False, True)
+    assert int(fixed.limit) == 4
+
+
+def test_cancelled_inference_does_not_shrink_limit():
+    async def run():
+        scheduler = InferScheduler(max_parallel=4)
+        settle(scheduler, lambda k: 0.01)
+
+        async def infer():
+            async with scheduler.slot():
+                await asyncio.sleep(10)
+
+        tasks = [asyncio.create_task(infer()) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return int(scheduler.limit), scheduler.inflight
+
+    assert asyncio.run(run()) == (4, 0)
+
+
+def test_limit_bounds_concurrent_slots():
+    async def run():
+        scheduler = InferScheduler(max_parallel=2, adaptive=False)
+        peak = current = 0
+
+        async def infer():
+            nonlocal peak, current
+            async with scheduler.slot():
+                current += 1
+                peak = max(peak, current)
+                await asyncio.sleep(0.01)
+                current -= 1
+
+        await asyncio.gather(*(infer() for _ in range(6)))
+        return peak, scheduler.inflight
+
+    assert asyncio.run(run()) == (2, 0)
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import Counter
+
+import pytest
+
+from lanes import LaneRouter, LaneScheduler, caller_of
+from stream_transport import ListTransport
+
+fakeredis = pytest.importorskip("fakeredis")
+
+BASE = "queue:missions"
+
+
+def setup():
+    client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    transport = ListTransport(client)
+    return client, LaneRouter(client, transport, BASE), LaneScheduler(client, transport, BASE, idle_block=0.1)
+
+
+def hosts_in_different_buckets():
+    first = "a.example:80"
+    for n in range(100):
+        host = f"h{n}.example:80"
+        if caller_of(f"http://{host}/cb", 4) != caller_of(f"http://{first}/cb", 4):
+            return first, host
+
+
+def test_caller_buckets():
+    assert caller_of("http://a.example/cb", 4) == caller_of("http://a.example/other", 4)
+    assert {caller_of(f"http://h{n}.example/cb", 4) for n in range(50)} <= {"c0", "c1", "c2", "c3"}
+    assert caller_of("http://a.example/cb", 0) == "all"
+
+
+def test_weighted_round_robin_between_priorities():
+    async def run():
+        _, router, scheduler = setup()
+        for priority in ("high", "low"):
+            lane = router.lane(priority, "is_spill", "http://a.example/cb")
+            await router.push_many(lane, [priority] * 100, priority, "is_spill")
+        return Counter([(await scheduler.pop()).data for _ in range(90)])
+
+    counts = asyncio.run(run())
+    # 权重 high=8 / low=1：低优先级按比例分到份额，不会被饿死
+    assert counts["high"] + counts["low"] == 90
+    assert 8 <= counts["low"] <= 11
+
+
+def test_small_caller_is_not_stuck_behind_bulk_caller():
+    async def run():
+        _, router, scheduler = setup()
+        bulk, small = hosts_in_different_buckets()
+        for host, count in ((bulk, 100), (small, 5)):
+            url = f"http://{host}/cb"
+            await router.push_many(router.lane("normal", "is_spill", url), [host] * count, "normal", "is_spill")
+        return [(await scheduler.pop()).data for _ in range(10)], small
+
+    popped, small = asyncio.run(run())
+    # 同一优先级和类型下不同调用方权重相同，轮流取
+    assert popped.count(small) == 5
+
+
+def test_legacy_queue_is_still_consumed():
+    async def run():
+        client, _, scheduler = setup()
+        await client.lpush(BASE, "legacy")
+        return (await scheduler.pop()).data
+
+    assert asyncio.run(run()) == "legacy"
+
+
+def test_idle_empty_lane_is_pruned_but_busy_lane_kept():
+    async def run():
+        client, router, scheduler = setup()
+        old = f"normal is_spill {time.time() - 2 * scheduler.idle_ttl:.0f}"
+        await client.hset(router.registry, mapping={f"{BASE}:normal:is_spill:c0": old,
+                                                    f"{BASE}:normal:is_spill:c1": old})
+        await client.lpush(f"{BASE}:normal:is_spill:c1", "waiting")
+        await scheduler._refresh()
+        return sorted(await router.lanes()), (await scheduler.pop()).data
+
+    lanes, popped = asyncio.run(run())
+    assert lanes == [f"{BASE}:normal:is_spill:c1"]
+    assert popped == "waiting"
@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from ollama_client import INFER_TTV_SECONDS, OllamaClient, verdict_ready
+
+URL = "http://ollama:11434/api/generate"
+
+
+def make_client(handler, **kwargs) -> OllamaClient:
+    client = OllamaClient(URL, "beetle", **kwargs)
+    client._async_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def test_generate_posts_payload_and_parses_verdict():
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"response": "<think>结果：TRUE?</think>理由：路面沥青补丁\n结果：FALSE"})
+
+    async def run():
+        client = make_client(handler)
+        first_client = client.get_async_client()
+        results = [await client.generate("aW1n", "system prompt") for _ in range(2)]
+        # 连接池复用同一个 AsyncClient
+        same = client.get_async_client() is first_client
+        await client.aclose()
+        return results, same
+
+    results, same = asyncio.run(run())
+    assert results == [(False, "路面沥青补丁")] * 2
+    assert same
+    payload = requests[0]
+    assert payload["model"] == "beetle" and payload["system"] == "system prompt"
+    assert payload["images"] == ["aW1n"] and payload["stream"] is False
+
+
+def test_json_mode_sends_schema_and_budget():
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, json={"response": '{"reason": "纸箱", "result": true}'})
+
+    async def run():
+        client = make_client(handler, output_format="json")
+        return await client.generate("aW1n", "p", num_predict=64)
+
+    assert asyncio.run(run()) == (True, "纸箱")
+    assert requests[0]["format"]["required"] == ["reason", "result"]
+    assert requests[0]["options"]["num_predict"] == 64
+
+
+def test_generate_reports_failures():
+    async def run(handler, image="aW1n"):
+        return await make_client(handler).generate(image, "p")
+
+    def connect_error(request):
+        raise httpx.ConnectError("refused", request=request)
+
+    def read_timeout(request):
+        raise httpx.ReadTimeout("slow", request=request)
+
+    assert asyncio.run(run(lambda request: httpx.Response(503))) == (False, "HTTP Error 503")
+    assert asyncio.run(run(connect_error)) == (False, "Connection Refused")
+    assert asyncio.run(run(read_timeout)) == (False, "Timeout: Model too slow")
+    empty_image = asyncio.run(run(lambda request: httpx.Response(200), image=""))
+    assert empty_image == (False, "Image Error: No base64 data")
+
+
+@pytest.mark.parametrize("text, ready", [
+    ("<think>结果：TRUE 看起来像", False),                      # 思考没结束
+    ("<think>结果：TRUE?</think>理由：纸箱\n结果：", False),      # 结论还没出来
+    ("理由：\n结果：TRUE", False),                              # 理由为空
+    ("<think>嗯</think>理由：有阴影的纸箱\n结果：TRUE", True),
+    ("Reason: tyre debris\nResult: false", True),
+])
+def test_verdict_ready(text, ready):
+    assert verdict_ready(text) is ready
+
+
+class StreamBody(httpx.AsyncByteStream):
+    """逐行吐出 NDJSON，记录被读走了多少行"""
+
+    def __init__(self, pieces):
+        self.lines = [json.dumps({"response": p, "done": False}) + "\n" for p in pieces]
+        self.lines.append(json.dumps({"response": "", "done": True}) + "\n")
+        self.sent = 0
+
+    async def __aiter__(self):
+        for line in self.lines:
+            self.sent += 1
+            yield line.encode("utf-8")
+
+
+def test_stream_stops_as_soon_as_verdict_is_parsed():
+    pieces = ["<think>", "结果：TRUE?", "</think>", "理由：", "有阴影的", "纸箱", "\n", "结果：", "TRUE", "\n"]
+    body = StreamBody(pieces + ["多余的解释"] * 50)
+
+    async def run():
+        client = make_client(lambda request: httpx.Response(200, stream=body), stream=True)
+        return await client.generate_stream("aW1n", "p")
+
+    result, reason, meta = asyncio.run(run())
+    assert (result, reason) == (True, "有阴影的纸箱")
+    assert meta["early_stop"] and meta["tokens"] == len(pieces) - 1
+    assert meta["ttft"] is not None and meta["ttv"] >= meta["ttft"]
+    assert body.sent < len(body.lines)
+
+
+def test_stream_without_verdict_reads_to_done_and_records_ttv():
+    body = StreamBody(["理由：看不清", "\n", "结论不明"])
+    before = sum(state[-1] for state in INFER_TTV_SECONDS._values.values())
+
+    async def run():
+        client = make_client(lambda request: httpx.Response(200, stream=body), stream=True)
+        return await client.generate("aW1n", "p")
+
+    assert asyncio.run(run()) == (False, "Parse Error")
+    assert body.sent == len(body.lines)
+    assert sum(state[-1] for state in INFER_TTV_SECONDS._values.values()) == before + 1
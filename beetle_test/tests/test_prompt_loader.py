@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from Prompt_loader import DEFAULT_TYPE, PromptLoader, parse_config
+
+GOOD = """
+is_spill: 判断是否为抛洒物
+is_vehicle: 判断是否为车辆
+token_budget:
+  default: 256
+  is_vehicle: 128
+"""
+
+
+@pytest.mark.parametrize("text, message", [
+    ("- a\n- b\n", "top level"),
+    ("is_spill: x\ntoken_budget: [1, 2]\n", "token_budget must be a mapping"),
+    ("is_spill: x\ntoken_budget:\n  default: 0\n", "token_budget.default"),
+    ("is_spill: x\ntoken_budget:\n  default: -5\n", "token_budget.default"),
+    ("is_spill: x\ntoken_budget:\n  default: '256'\n", "token_budget.default"),
+    ("is_spill: x\ntoken_budget:\n  default: 1.5\n", "token_budget.default"),
+    ("is_spill: x\ntoken_budget:\n  default: true\n", "token_budget.default"),
+    ("is_spill: x\nis_vehicle: '   '\n", "is_vehicle"),
+    ("is_spill: x\nis_vehicle: 42\n", "is_vehicle"),
+    ("is_vehicle: x\n", DEFAULT_TYPE),
+])
+def test_parse_config_rejects(text, message):
+    with pytest.raises(ValueError, match=message):
+        parse_config(text, "digest")
+
+
+def test_parse_config_budget_and_version():
+    config = parse_config(GOOD, "digest")
+    assert config.types["is_spill"].num_predict == 256
+    assert config.types["is_vehicle"].num_predict == 128
+    assert config.types["is_spill"].version != config.types["is_vehicle"].version
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf-8")
+    # 保证 mtime 变化，reload_if_changed 才会重新读
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+
+def test_loader_keeps_last_good_version(tmp_path):
+    path = tmp_path / "prompts.yaml"
+    write(path, GOOD)
+    loader = PromptLoader(str(path))
+    before = loader.get("is_vehicle")
+
+    write(path, "is_vehicle: [broken\n")
+    assert loader.reload_if_changed() is False
+    assert loader.last_error
+    assert loader.get("is_vehicle") == before
+
+    write(path, GOOD.replace("判断是否为车辆", "判断是否为机动车"))
+    assert loader.reload_if_changed() is True
+    assert loader.last_error is None
+    after = loader.get("is_vehicle")
+    assert after.prompt == "判断是否为机动车"
+    assert after.version != before.version
+    # 没改的类型版本不变
+    assert loader.version_get("is_spill") == parse_config(GOOD, "").types["is_spill"].version
+
+
+def test_unknown_type_falls_back_to_default(tmp_path):
+    path = tmp_path / "prompts.yaml"
+    write(path, GOOD)
+    loader = PromptLoader(str(path))
+    assert loader.get("is_unknown") == loader.get(DEFAULT_TYPE)
+    assert loader.token_budget_get("is_unknown") == 256
+
+
+def test_missing_file_fails_at_startup(tmp_path):
+    with pytest.raises(ValueError, match="not loaded"):
+        PromptLoader(str(tmp_path / "missing.yaml"))
+
+
+def test_deleted_file_keeps_last_good_version(tmp_path):
+    path = tmp_path / "prompts.yaml"
+    write(path, GOOD)
+    loader = PromptLoader(str(path))
+    before = loader.get("is_vehicle")
+
+    path.unlink()
+    assert loader.reload_if_changed() is False
+    assert loader.last_error
+    assert loader.get("is_vehicle") == before
+
+    # 原样放回后错误清除
+    write(path, GOOD)
+    assert loader.reload_if_changed() is False
+    assert loader.last_error is None
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import server_test  # noqa: E402
+
+
+@pytest.fixture
+def redis_client(monkeypatch):
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(server_test, "redis_client", client)
+    return client
+
+
+def shard(index: int, count: int, pic_ids):
+    return {"taskSerial": "T1", "type": "is_spill", "shardIndex": index, "shardCount": count,
+            "data": [{"picId": p, "result": True, "reason": "r"} for p in pic_ids]}
+
+
+def test_unsharded_result_passes_through(redis_client):
+    payload = {"taskSerial": "T0", "type": "is_spill", "data": []}
+    assert asyncio.run(server_test.collect_shard(dict(payload))) == payload
+
+
+def test_shards_merge_in_index_order_once(redis_client):
+    async def run():
+        results = [
+            await server_test.collect_shard(shard(2, 3, ["e"])),
+            await server_test.collect_shard(shard(0, 3, ["a", "b"])),
+            # 重复投递的分片不计数，也不会提前触发合并
+            await server_test.collect_shard(shard(0, 3, ["a", "b"])),
+            await server_test.collect_shard(shard(1, 3, ["c", "d"])),
+        ]
+        await server_test.finish_shards(["T1"], committed=True)
+        return results, await redis_client.exists("shards:T1", "shards:T1:merging")
+
+    results, leftover = asyncio.run(run())
+    assert results[:3] == [None, None, None]
+    merged = results[3]
+    assert [item["picId"] for item in merged["data"]] == ["a", "b", "c", "d", "e"]
+    assert "shardIndex" not in merged and "shardCount" not in merged
+    assert leftover == 0
+
+
+def test_duplicate_of_last_shard_does_not_merge_twice(redis_client):
+    async def run():
+        first = await server_test.collect_shard(shard(0, 2, ["a"]))
+        # 最后一个分片被投递两次，合并落库之前第二次到达：合并锁还在，不会再合并一次
+        merged = await server_test.collect_shard(shard(1, 2, ["b"]))
+        duplicate = await server_test.collect_shard(shard(1, 2, ["b"]))
+        return first, merged, duplicate
+
+    first, merged, duplicate = asyncio.run(run())
+    assert first is None and duplicate is None
+    assert [item["picId"] for item in merged["data"]] == ["a", "b"]
+
+
+def test_failed_commit_keeps_shards_for_redelivery(redis_client):
+    async def run():
+        await server_test.collect_shard(shard(0, 2, ["a"]))
+        assert await server_test.collect_shard(shard(1, 2, ["b"])) is not None
+        # 落库失败：只释放合并锁，重新投递的最后一个分片再次触发合并
+        await server_test.finish_shards(["T1"], committed=False)
+        return await server_test.collect_shard(shard(1, 2, ["b"]))
+
+    merged = asyncio.run(run())
+    assert [item["picId"] for item in merged["data"]] == ["a", "b"]
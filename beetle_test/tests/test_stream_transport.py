@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from stream_transport import StreamTransport
+
+fakeredis = pytest.importorskip("fakeredis")
+
+QUEUE = "queue:test"
+KEY = StreamTransport.stream_key(QUEUE)
+
+
+def transports(client, **kwargs):
+    # 与 self_check 相同的参数：空闲 0.2s 即可被接管，最多投递 2 次
+    options = dict(idle_timeout=0.2, max_deliveries=2, block=0.1)
+    options.update(kwargs)
+    return (StreamTransport(client, "g", consumer="a", **options),
+            StreamTransport(client, "g", consumer="b", **options))
+
+
+def test_push_pop_ack():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        a, _ = transports(client)
+        await a.push_many(QUEUE, ["m1", "m2"])
+        assert await a.backlog(QUEUE) == 2
+        batch = await a.pop_batch(QUEUE, 10)
+        for message in batch:
+            await a.ack(QUEUE, message)
+        return [m.data for m in batch], (await client.xpending(KEY, "g"))["pending"]
+
+    assert asyncio.run(run()) == (["m1", "m2"], 0)
+
+
+def test_idle_pending_message_is_reclaimed():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        a, b = transports(client)
+        await a.push(QUEUE, "m1")
+        msg = await a.pop(QUEUE)
+        # a 没有确认就 "挂掉"；空闲时间未到时 b 拿不到
+        assert await b.pop_nowait(QUEUE) is None
+        await asyncio.sleep(0.3)
+        reclaimed = await b.pop(QUEUE)
+        await b.ack(QUEUE, reclaimed)
+        return msg, reclaimed, (await client.xpending(KEY, "g"))["pending"]
+
+    msg, reclaimed, pending = asyncio.run(run())
+    assert (reclaimed.msg_id, reclaimed.data, reclaimed.queue) == (msg.msg_id, "m1", QUEUE)
+    assert pending == 0
+
+
+def test_poison_message_is_dead_lettered():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        a, b = transports(client)
+        await a.push(QUEUE, "poison")
+        await a.pop(QUEUE)
+        await asyncio.sleep(0.3)
+        await b.pop(QUEUE)  # 第 2 次投递
+        await asyncio.sleep(0.3)
+        await b.push(QUEUE, "after")
+        after = await a.pop(QUEUE)
+        dead = await client.xrange(f"{KEY}:dead")
+        await a.ack(QUEUE, after)
+        return after.data, dead, (await client.xpending(KEY, "g"))["pending"]
+
+    after, dead, pending = asyncio.run(run())
+    assert after == "after"
+    assert [(fields["data"], fields["deliveries"]) for _, fields in dead] == [("poison", "3")]
+    assert pending == 0
+
+
+def test_pop_any_buffers_extra_entries():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        a, b = transports(client)
+        queues = ["queue:high", "queue:low"]
+        await a.push("queue:low", "low")
+        await a.push("queue:high", "high")
+        first = await a.pop_any(queues, timeout=0.1)
+        # low 那条已进入 a 的 PEL，b 读不到新消息；a 下一次直接返回它，不必等空闲超时后被接管
+        assert await b.pop_nowait("queue:low") is None
+        second = await a.pop_any(queues, timeout=0.1)
+        for message in (first, second):
+            await a.ack(message.queue, message)
+        pending = [(await client.xpending(StreamTransport.stream_key(q), "g"))["pending"] for q in queues]
+        return (first.data, first.queue), (second.data, second.queue), pending
+
+    first, second, pending = asyncio.run(run())
+    assert first == ("high", "queue:high")
+    assert second == ("low", "queue:low")
+    assert pending == [0, 0]
+
+
+def test_keepalive_renews_buffered_entries():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        a, b = transports(client)
+        queues = ["queue:high", "queue:low"]
+        await a.push("queue:low", "low")
+        await a.push("queue:high", "high")
+        first = await a.pop_any(queues, timeout=0.1)
+        # 处理 high 的时间超过空闲超时，暂存的 low 随 keepalive 一起续约，b 接管不了
+        async with a.keepalive(first.queue, first):
+            await asyncio.sleep(0.4)
+            stolen = await b.pop_nowait("queue:low")
+        second = await a.pop_any(queues, timeout=0.1)
+        return stolen, second.data
+
+    assert asyncio.run(run()) == (None, "low")
+
+
+def test_buffered_entry_taken_over_is_skipped():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        a, b = transports(client)
+        await a.push("queue:low", "low")
+        await a.push("queue:high", "high")
+        await a.pop_any(["queue:high", "queue:low"], timeout=0.1)
+        # 没有续约，超时后被 b 接管；a 不能再处理同一条
+        await asyncio.sleep(0.3)
+        reclaimed = await b.pop_nowait("queue:low")
+        return reclaimed.data, await a.pop_nowait("queue:low")
+
+    assert asyncio.run(run()) == ("low", None)
+
+
+def test_backlog_without_lag_counts_undelivered_entries(monkeypatch):
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        a, _ = transports(client)
+        await a.push_many(QUEUE, ["m1", "m2", "m3"])
+        await a.pop(QUEUE)
+        with_lag = await a.backlog(QUEUE)
+
+        # 模拟 Redis 7 之前的 XINFO GROUPS (没有 lag 字段)
+        xinfo_groups = client.xinfo_groups
+
+        async def legacy_xinfo_groups(key):
+            return [{k: v for k, v in group.items() if k not in ("lag", "entries-read")}
+                    for group in await xinfo_groups(key)]
+        monkeypatch.setattr(client, "xinfo_groups", legacy_xinfo_groups)
+        return with_lag, await a.backlog(QUEUE)
+
+    assert asyncio.run(run()) == (3, 3)
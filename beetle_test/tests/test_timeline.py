@@ -0,0 +1,58 @@
+import asyncio
+import sqlite3
+import time
+
+import aiosqlite
+
+from db_migrations import migrate
+from timeline import parse_window, percentile, report_queries, summarize
+
+
+def test_parse_window():
+    assert [parse_window(text) for text in ("90", "30m", "24h", "7d")] == [90, 1800, 86400, 604800]
+
+
+def test_percentile_picks_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert (percentile(values, 0.5), percentile(values, 0.99), percentile([3.0], 0.9)) == (51.0, 99.0, 3.0)
+
+
+def test_summarize_stages_per_type_and_all():
+    missions = [
+        ("is_spill", 100.0, 100.5, 110.0, 111.0),
+        ("is_vehicle", 200.0, 200.1, 205.0, None),  # 回调还没投递
+    ]
+    pictures = [("is_spill", 100.5, 101.0, 101.5, 102.0, 103.0, 108.0, 110.0)]
+    report = summarize(missions, pictures)
+
+    spill = report["is_spill"]
+    assert list(spill) == ["intake", "queue_wait", "download", "preprocess", "infer_wait", "inference",
+                           "result_return", "end_to_end", "callback"]
+    assert (spill["queue_wait"]["p50"], spill["inference"]["max"], spill["callback"]["count"]) == (0.5, 5.0, 1)
+    assert "callback" not in report["is_vehicle"]
+    assert report["all"]["end_to_end"]["count"] == 2
+    assert report["all"]["end_to_end"]["max"] == 10.0
+
+
+def test_report_queries_filter_window_and_type(tmp_path):
+    path = str(tmp_path / "m.db")
+
+    async def init():
+        db = await aiosqlite.connect(path, isolation_level=None)
+        await migrate(db)
+        await db.close()
+    asyncio.run(init())
+
+    with sqlite3.connect(path) as conn:
+        now = time.time()
+        conn.executemany("INSERT INTO missions (task_serial, type, accepted_at, enqueued_at) VALUES (?, ?, ?, ?)",
+                         [("T1", "is_spill", now - 10, now - 9), ("T2", "is_vehicle", now - 10, now - 9),
+                          ("OLD", "is_spill", now - 7200, now - 7199)])
+        conn.execute("INSERT INTO pictures (task_serial, pic_id, dequeued_at) VALUES ('T1', 'p1', ?)", (now - 8,))
+        (mission_sql, params), (picture_sql, _) = report_queries(3600, "is_spill")
+        missions = conn.execute(mission_sql, params).fetchall()
+        pictures = conn.execute(picture_sql, params).fetchall()
+
+    assert [row[0] for row in missions] == ["is_spill"]
+    assert len(pictures) == 1
+    assert summarize(missions, pictures)["is_spill"]["queue_wait"]["count"] == 1
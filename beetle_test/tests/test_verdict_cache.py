@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from verdict_cache import VerdictCache
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def ok(value):
+    return True
+
+
+def test_make_key_depends_on_image_prompt_model_and_variant():
+    cache = VerdictCache("model-a")
+    key = cache.make_key("img", "prompt")
+    assert key == cache.make_key("img", "prompt")
+    assert len({key, cache.make_key("img2", "prompt"), cache.make_key("img", "prompt2"),
+                VerdictCache("model-b").make_key("img", "prompt"), cache.make_key("img", "prompt", "json")}) == 5
+
+
+def test_miss_then_l1_then_l2_hit():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            return True, "纸箱"
+
+        cache = VerdictCache("m", client)
+        first = await cache.get_or_compute("k", compute, ok)
+        second = await cache.get_or_compute("k", compute, ok)
+        # 另一个 worker 进程：L1 为空，从 Redis 命中
+        other = VerdictCache("m", client)
+        third = await other.get_or_compute("k", compute, ok)
+        return first, second, third, len(calls), cache.counters, other.counters
+
+    first, second, third, computed, counters, other = asyncio.run(run())
+    assert first == second == third == (True, "纸箱")
+    assert computed == 1
+    assert (counters["misses"], counters["l1_hits"]) == (1, 1)
+    assert other["l2_hits"] == 1
+
+
+def test_failed_results_are_not_cached():
+    async def run():
+        cache = VerdictCache("m", fakeredis.FakeAsyncRedis(decode_responses=True))
+
+        async def compute():
+            return False, "Timeout: Model too slow"
+
+        await cache.get_or_compute("k", compute, lambda value: not value[1].startswith("Timeout"))
+        return await cache.get("k")
+
+    assert asyncio.run(run()) is None
+
+
+def test_concurrent_misses_compute_once():
+    async def run():
+        cache = VerdictCache("m")
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return False, "沥青补丁"
+
+        results = await asyncio.gather(*(cache.get_or_compute("k", compute, ok) for _ in range(5)))
+        return results, len(calls), cache.counters["shared"]
+
+    results, computed, shared = asyncio.run(run())
+    assert results == [(False, "沥青补丁")] * 5
+    assert (computed, shared) == (1, 4)
+
+
+def test_waiters_recompute_when_leader_fails():
+    async def run():
+        cache = VerdictCache("m")
+        calls = []
+
+        async def compute():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            if len(calls) == 1:
+                raise RuntimeError("backend down")
+            return True, "ok"
+
+        results = await asyncio.gather(cache.get_or_compute("k", compute, ok),
+                                       cache.get_or_compute("k", compute, ok), return_exceptions=True)
+        return results, len(calls)
+
+    (leader, waiter), computed = asyncio.run(run())
+    assert isinstance(leader, RuntimeError)
+    assert waiter == (True, "ok") and computed == 2
+
+
+def test_corrupt_l2_entry_is_dropped_as_miss():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        cache = VerdictCache("m", client)
+        await client.set("cache:verdict:k", "{not json")
+        await client.zadd(cache.index_key, {"k": 1})
+        value = await cache.get("k")
+        return (value, cache.counters["errors"], await client.exists("cache:verdict:k"),
+                await client.zscore(cache.index_key, "k"))
+
+    assert asyncio.run(run()) == (None, 1, 0, None)
+
+
+def test_index_evicts_oldest_and_prunes_expired():
+    async def run():
+        client = fakeredis.FakeAsyncRedis(decode_responses=True)
+        cache = VerdictCache("m", client, ttl=3600, max_entries=2)
+        # 已过 TTL 的索引条目写入时顺带清掉
+        await client.zadd(cache.index_key, {"expired": 1})
+        for key in ("a", "b", "c"):
+            await cache.put(key, (True, key))
+            await asyncio.sleep(0.01)
+        return await client.zrange(cache.index_key, 0, -1), await client.exists("cache:verdict:a")
+
+    assert asyncio.run(run()) == (["b", "c"], 0)
@@ -0,0 +1,115 @@
+import time
+import sqlite3
+import argparse
+from typing import Dict, List, Optional
+
+# 任务级阶段：(名称, 起点列, 终点列)，列来自 missions 表
+MISSION_STAGES = (
+    ("intake", "accepted_at", "enqueued_at"),
+    ("end_to_end", "accepted_at", "result_received_at"),
+    ("callback", "result_received_at", "callback_delivered_at"),
+)
+# 图片级阶段，enqueued_at 来自 missions，其余来自 pictures
+PICTURE_STAGES = (
+    ("queue_wait", "enqueued_at", "dequeued_at"),
+    ("download", "dequeued_at", "download_done_at"),
+    ("preprocess", "download_done_at", "preprocess_done_at"),
+    ("infer_wait", "preprocess_done_at", "inference_start_at"),
+    ("inference", "inference_start_at", "inference_end_at"),
+    ("result_return", "inference_end_at", "result_received_at"),
+)
+
+MISSION_SQL = (
+    "SELECT type, accepted_at, enqueued_at, result_received_at, callback_delivered_at "
+    "FROM missions WHERE accepted_at >= ?"
+)
+PICTURE_SQL = (
+    "SELECT m.type, m.enqueued_at, p.dequeued_at, p.download_done_at, p.preprocess_done_at, "
+    "p.inference_start_at, p.inference_end_at, m.result_received_at "
+    "FROM pictures p JOIN missions m ON m.task_serial = p.task_serial WHERE m.accepted_at >= ?"
+)
+MISSION_FIELDS = ("type", "accepted_at", "enqueued_at", "result_received_at", "callback_delivered_at")
+PICTURE_FIELDS = ("type", "enqueued_at", "dequeued_at", "download_done_at", "preprocess_done_at",
+                  "inference_start_at", "inference_end_at", "result_received_at")
+
+
+def report_queries(window: float, mission_type: Optional[str] = None):
+    """返回 [(sql, params), (sql, params)]，分别是任务级和图片级的查询"""
+    since = time.time() - window
+    type_filter = " AND type = ?" if mission_type else ""
+    params = (since, mission_type) if mission_type else (since,)
+    return [(MISSION_SQL + type_filter, params), (PICTURE_SQL + type_filter.replace("type", "m.type"), params)]
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    idx = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+def _collect(rows, fields, stages, out: Dict[str, Dict[str, list]]):
+    for row in rows:
+        record = dict(zip(fields, row))
+        for mission_type in (record["type"], "all"):
+            bucket = out.setdefault(mission_type, {})
+            for name, start, end in stages:
+                if record[start] is not None and record[end] is not None:
+                    bucket.setdefault(name, []).append(record[end] - record[start])
+
+
+def summarize(mission_rows, picture_rows) -> Dict[str, Dict[str, dict]]:
+    """{任务类型 (含 all): {阶段: {count, p50, p90, p99, max}}}，单位秒"""
+    durations: Dict[str, Dict[str, list]] = {}
+    _collect(mission_rows, MISSION_FIELDS, MISSION_STAGES, durations)
+    _collect(picture_rows, PICTURE_FIELDS, PICTURE_STAGES, durations)
+
+    order = [name for name, _, _ in MISSION_STAGES[:1] + PICTURE_STAGES + MISSION_STAGES[1:]]
+    report = {}
+    for mission_type, stages in durations.items():
+        for name in order:
+            values = sorted(stages.get(name, []))
+            if not values:
+                continue
+            report.setdefault(mission_type, {})[name] = {
+                "count": len(values),
+                "p50": round(percentile(values, 0.50), 3),
+                "p90": round(percentile(values, 0.90), 3),
+                "p99": round(percentile(values, 0.99), 3),
+                "max": round(values[-1], 3),
+            }
+    return report
+
+
+def parse_window(text: str) -> float:
+    """"90" / "30m" / "24h" / "7d" -> 秒"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def print_report(report: Dict[str, Dict[str, dict]]):
+    if not report:
+        print("⚠️ 时间窗口内没有带阶段时间戳的任务。")
+        return
+    for mission_type in sorted(report, key=lambda t: (t == "all", t)):
+        print(f"\n📊 {mission_type}")
+        print(f"{'stage':<14}{'count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}")
+        for name, row in report[mission_type].items():
+            print(f"{name:<14}{row['count']:>8}{row['p50']:>10.3f}{row['p90']:>10.3f}{row['p99']:>10.3f}{row['max']:>10.3f}")
+
+
+# --- 命令行：python timeline.py --db missions.db --window 24h [--type is_spill] ---
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=str, default="missions.db", help="数据库路径")
+    parser.add_argument("--window", type=str, default="24h", help="统计最近多长时间内接收的任务，如 30m / 24h / 7d")
+    parser.add_argument("--type", type=str, default=None, help="只统计某个任务类型")
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        (mission_sql, params), (picture_sql, _) = report_queries(parse_window(args.window), args.type)
+        missions = conn.execute(mission_sql, params).fetchall()
+        pictures = conn.execute(picture_sql, params).fetchall()
+    print(f"🔍 {args.db} | 最近 {args.window} | 任务 {len(missions)} 个, 图片 {len(pictures)} 张")
+    print_report(summarize(missions, pictures))
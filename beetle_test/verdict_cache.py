@@ -0,0 +1,175 @@
+import time
+import json
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class VerdictCache:
+    """
+    按内容寻址的推理结论缓存，key = sha256(预处理后的图片 + 提示词 + 模型名)。
+    - L1: 进程内 LRU
+    - L2: Redis (多个 worker 共享)，带 TTL；索引 zset 里已过 TTL 的条目写入时顺带清掉，
+      超过 max_entries 时按写入时间淘汰最旧的
+    同一 key 并发到达时只推理一次 (single-flight)，其余请求等待同一个结果。
+    """
+
+    def __init__(self, model: str, redis_client=None, lru_size: int = 2048, ttl: int = 7 * 24 * 3600,
+                 max_entries: int = 200000, prefix: str = "cache:verdict"):
+        self.model = model
+        self.redis_client = redis_client
+        self.lru_size = lru_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.index_key = f"{prefix}:index"
+
+        self._lru = OrderedDict()
+        self._inflight = {}
+        self.counters = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "shared": 0, "errors": 0}
+
+    def bind_redis(self, redis_client):
+        self.redis_client = redis_client
+
+    def make_key(self, image_base64: str, prompt: str, variant: str = "") -> str:
+        # variant 区分同一模型下不同的输出模式 (text / json)
+        h = hashlib.sha256()
+        h.update(image_base64.encode("utf-8"))
+        h.update(b"\0")
+        h.update(prompt.encode("utf-8"))
+        h.update(b"\0")
+        h.update(self.model.encode("utf-8"))
+        if variant:
+            h.update(b"\0")
+            h.update(variant.encode("utf-8"))
+        return h.hexdigest()
+
+    # ---------- 统计 ----------
+
+    def stats(self) -> dict:
+        hits = self.counters["l1_hits"] + self.counters["l2_hits"] + self.counters["shared"]
+        total = hits + self.counters["misses"]
+        return dict(self.counters, hit_rate=round(hits / total, 3) if total else 0.0, l1_size=len(self._lru))
+
+    # ---------- L1 ----------
+
+    def _lru_get(self, key: str):
+        value = self._lru.get(key)
+        if value is not None:
+            self._lru.move_to_end(key)
+        return value
+
+    def _lru_put(self, key: str, value: Tuple[bool, str]):
+        self._lru[key] = value
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    # ---------- L2 ----------
+
+    async def _redis_get(self, key: str):
+        if self.redis_client is None:
+            return None
+        try:
+            raw = await self.redis_client.get(f"{self.prefix}:{key}")
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.warning(f"Verdict cache read failed: {e}")
+            return None
+        if not raw:
+            return None
+        try:
+            data = json.loads(raw)
+            return bool(data["result"]), str(data["reason"])
+        except (ValueError, KeyError, TypeError) as e:
+            # 损坏或旧格式的条目当作未命中并删掉，不让它拖垮整个任务
+            self.counters["errors"] += 1
+            logger.warning(f"Verdict cache entry {key} unreadable, dropping: {e}")
+            await self._drop(key)
+            return None
+
+    async def _drop(self, key: str):
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.delete(f"{self.prefix}:{key}")
+                pipe.zrem(self.index_key, key)
+                await pipe.execute()
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.warning(f"Verdict cache delete failed: {e}")
+
+    async def _redis_put(self, key: str, value: Tuple[bool, str]):
+        if self.redis_client is None:
+            return
+        try:
+            now = time.time()
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                pipe.set(f"{self.prefix}:{key}", json.dumps({"result": value[0], "reason": value[1]}), ex=self.ttl)
+                pipe.zadd(self.index_key, {key: now})
+                # 索引分数是写入时间，早于 now - ttl 的 key 已经过期，不该再占 max_entries 的名额
+                pipe.zremrangebyscore(self.index_key, "-inf", now - self.ttl)
+                pipe.zcard(self.index_key)
+                results = await pipe.execute()
+            overflow = results[-1] - self.max_entries
+            if overflow > 0:
+                await self._evict(overflow)
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.warning(f"Verdict cache write failed: {e}")
+
+    async def _evict(self, count: int):
+        # 按写入时间淘汰最旧的条目，TTL 已过期的 key 删除时无副作用
+        oldest = await self.redis_client.zpopmin(self.index_key, count)
+        if oldest:
+            await self.redis_client.delete(*[f"{self.prefix}:{k}" for k, _ in oldest])
+
+    # ---------- 对外接口 ----------
+
+    async def get(self, key: str) -> Optional[Tuple[bool, str]]:
+        value = self._lru_get(key)
+        if value is not None:
+            self.counters["l1_hits"] += 1
+            return value
+        value = await self._redis_get(key)
+        if value is not None:
+            self.counters["l2_hits"] += 1
+            self._lru_put(key, value)
+            return value
+        return None
+
+    async def put(self, key: str, value: Tuple[bool, str]):
+        self._lru_put(key, value)
+        await self._redis_put(key, value)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Tuple[bool, str]]],
+                             cacheable: Callable[[Tuple[bool, str]], bool]) -> Tuple[bool, str]:
+        """命中直接返回；未命中时调用 compute 推理，cacheable 为真才写入缓存 (失败结果不缓存)"""
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            value = await asyncio.shield(pending)
+            if value is not None:
+                self.counters["shared"] += 1
+                return value
+            # 领头的那次推理失败或被取消，自己再算一次
+
+        self.counters["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        value = None
+        try:
+            value = await compute()
+        finally:
+            self._inflight.pop(key, None)
+            future.set_result(value)
+
+        if cacheable(value):
+            await self.put(key, value)
+        return value